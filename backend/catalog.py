@@ -0,0 +1,334 @@
+# catalog.py
+"""
+Process-local snapshot of the static catalog (dungeons, levels, questions).
+
+Catalog content only changes when an admin edits it, so it is loaded once at
+startup and served from memory. A background task keeps it fresh: it follows a
+Mongo change stream on the catalog collections when the deployment supports
+one (replica sets / Atlas), reopening it with backoff when it drops, and
+otherwise polls a cheap change signature: the `catalog_meta` version stamp
+plus each collection's document count, newest `_id` and newest
+`updated_at`. Edits that change none of these (an in-place update without
+`updated_at` or a version bump) are picked up by a full reload every
+CATALOG_FULL_RELOAD_SECONDS. Every reload that changes content produces a new immutable snapshot
+with a higher generation number; readers always see one consistent snapshot.
+An optional `prepare` hook derives per-snapshot data (pre-rendered responses)
+in a worker thread before the snapshot is swapped in.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from typing import AbstractSet, Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+CATALOG_COLLECTIONS = ("dungeons", "levels", "questions")
+CATALOG_POLL_SECONDS = float(os.getenv("CATALOG_POLL_SECONDS", "30"))
+CATALOG_FULL_RELOAD_SECONDS = float(os.getenv("CATALOG_FULL_RELOAD_SECONDS", "600"))
+# Coalesce bursts of admin edits into a single reload
+CATALOG_RELOAD_DEBOUNCE_SECONDS = float(os.getenv("CATALOG_RELOAD_DEBOUNCE_SECONDS", "0.5"))
+# Backoff between attempts to reopen a change stream that failed
+CATALOG_WATCH_RETRY_SECONDS = float(os.getenv("CATALOG_WATCH_RETRY_SECONDS", "1"))
+CATALOG_WATCH_MAX_RETRY_SECONDS = float(os.getenv("CATALOG_WATCH_MAX_RETRY_SECONDS", "60"))
+# OperationFailure codes meaning the server cannot run change streams at all
+CHANGE_STREAMS_UNSUPPORTED = {40573}
+
+# Orderings offered by /api/questions?sort=; None keeps catalog order
+DIFFICULTY_RANK = {"easy": 0, "medium": 1, "hard": 2}
+QUESTION_SORT_KEYS = {
+    "id": lambda q: int(q["id"]),
+    "xp": lambda q: (int(q.get("xp", 0) or 0), int(q["id"])),
+    "title": lambda q: (str(q.get("title", "")).lower(), int(q["id"])),
+    "difficulty": lambda q: (DIFFICULTY_RANK.get(str(q.get("difficulty", "")).lower(), len(DIFFICULTY_RANK)), int(q["id"])),
+}
+
+def _required_dungeon_key(value):
+    """int id of a question's required dungeon; unparseable values stay as-is and never unlock."""
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+class CatalogSnapshot:
+    """Immutable view of the catalog. Documents must be treated as read-only."""
+
+    def __init__(self, generation: int, dungeons: List[dict], levels: List[dict], questions: List[dict], version=None, fingerprint: str = ""):
+        self.generation = generation
+        self.version = version
+        self.fingerprint = fingerprint
+        self.loaded_at = datetime.utcnow().isoformat()
+        self.dungeons = dungeons
+        self.levels = levels
+        self.questions = questions
+        self.dungeon_by_id: Dict[int, dict] = {int(d["id"]): d for d in dungeons if d.get("id") is not None}
+        self.level_by_id: Dict[int, dict] = {int(l["id"]): l for l in levels if l.get("id") is not None}
+        self.question_by_id: Dict[int, dict] = {int(q["id"]): q for q in questions if q.get("id") is not None}
+        # Dungeon completion index: dungeon -> its level set, level -> dungeons containing it
+        self.dungeon_levels: Dict[int, frozenset] = {}
+        self.level_dungeons: Dict[Any, List[int]] = {}
+        for d_id, d in self.dungeon_by_id.items():
+            levels_of = frozenset(d.get("levels", []) or [])
+            if not levels_of:
+                continue
+            self.dungeon_levels[d_id] = levels_of
+            for l in levels_of:
+                self.level_dungeons.setdefault(l, []).append(d_id)
+        self._index_questions()
+        # Filled by Catalog's `prepare` hook (see prerender.render_catalog)
+        self.responses: Dict[Any, Any] = {}
+
+    def _index_questions(self):
+        """Inverted indexes over questions: lower-cased difficulty/category and required dungeon -> ids."""
+        by_difficulty: Dict[str, set] = {}
+        by_category: Dict[str, set] = {}
+        by_required: Dict[Any, set] = {}
+        # Status of questions without a required dungeon, before per-user completion
+        by_base_status: Dict[str, set] = {}
+        self.question_required: Dict[int, Any] = {}
+        self.question_base_status: Dict[int, str] = {}
+        for q_id, q in self.question_by_id.items():
+            by_difficulty.setdefault(str(q.get("difficulty", "")).lower(), set()).add(q_id)
+            by_category.setdefault(str(q.get("category", "")).lower(), set()).add(q_id)
+            required = _required_dungeon_key(q.get("required_dungeon"))
+            self.question_required[q_id] = required
+            if required is None:
+                base = q.get("status", "available")
+                self.question_base_status[q_id] = base
+                by_base_status.setdefault(str(base).lower(), set()).add(q_id)
+            else:
+                by_required.setdefault(required, set()).add(q_id)
+        freeze = lambda index: {k: frozenset(v) for k, v in index.items()}
+        self.questions_by_difficulty = freeze(by_difficulty)
+        self.questions_by_category = freeze(by_category)
+        self.questions_by_required_dungeon = freeze(by_required)
+        self.questions_by_base_status = freeze(by_base_status)
+        self.question_ids: FrozenSet[int] = frozenset(self.question_by_id)
+        catalog_order = tuple(dict.fromkeys(int(q["id"]) for q in self.questions if q.get("id") is not None))
+        self.question_orders: Dict[Optional[str], Tuple[int, ...]] = {None: catalog_order}
+        for name, key in QUESTION_SORT_KEYS.items():
+            self.question_orders[name] = tuple(int(q["id"]) for q in sorted(self.question_by_id.values(), key=key))
+
+    def question_status(self, q_id: int, completed_questions: AbstractSet, completed_dungeons: AbstractSet) -> str:
+        if q_id in completed_questions:
+            return "completed"
+        required = self.question_required[q_id]
+        if required is None:
+            return self.question_base_status[q_id]
+        return "available" if required in completed_dungeons else "locked"
+
+    def select_questions(
+        self,
+        completed_questions: AbstractSet,
+        completed_dungeons: AbstractSet,
+        difficulty: Optional[str] = None,
+        category: Optional[str] = None,
+        status: Optional[str] = None,
+    ) -> Optional[AbstractSet[int]]:
+        """Ids matching every given filter (case-insensitive), or None when no filter is given."""
+        selected: Optional[AbstractSet[int]] = None
+
+        def narrow(ids: AbstractSet[int]):
+            nonlocal selected
+            selected = ids if selected is None else selected & ids
+
+        if difficulty:
+            narrow(self.questions_by_difficulty.get(difficulty.lower(), frozenset()))
+        if category:
+            narrow(self.questions_by_category.get(category.lower(), frozenset()))
+        if status:
+            status = status.lower()
+            completed = self.question_ids & completed_questions
+            ids = set(self.questions_by_base_status.get(status, ()))
+            if status in ("available", "locked"):
+                unlocked = status == "available"
+                for required, q_ids in self.questions_by_required_dungeon.items():
+                    if (required in completed_dungeons) == unlocked:
+                        ids |= q_ids
+            ids -= completed
+            if status == "completed":
+                ids |= completed
+            narrow(ids)
+        return selected
+
+    def completed_dungeons(self, completed_levels: Iterable) -> List[int]:
+        """
+        Dungeons whose levels are all in `completed_levels`. Only dungeons
+        containing at least one completed level are examined.
+        """
+        done = set(completed_levels)
+        candidates = {d for l in done for d in self.level_dungeons.get(l, ())}
+        return sorted(d for d in candidates if self.dungeon_levels[d] <= done)
+
+    def dungeons_completed_by(self, level_id, completed_levels: Iterable) -> List[int]:
+        """Dungeons that become complete once `level_id` is added to `completed_levels`."""
+        done = set(completed_levels)
+        done.add(level_id)
+        return [d for d in self.level_dungeons.get(level_id, ()) if self.dungeon_levels[d] <= done]
+
+def _change_streams_unsupported(error: OperationFailure) -> bool:
+    return error.code in CHANGE_STREAMS_UNSUPPORTED or "replica set" in str(error).lower()
+
+class Catalog:
+    def __init__(self, db, clean_docs: Callable[[List[dict]], List[dict]], prepare: Optional[Callable[["CatalogSnapshot"], Dict]] = None):
+        self.db = db
+        self.clean_docs = clean_docs
+        self.prepare = prepare
+        self.snapshot: Optional[CatalogSnapshot] = None
+        self.mode = "none"
+        self.reloads = 0
+        self._task: Optional[asyncio.Task] = None
+        # Change events only mark the catalog dirty; one pending task reloads it
+        self._dirty = False
+        self._pending_reload: Optional[asyncio.Task] = None
+        self._reload_lock = asyncio.Lock()
+        # Called with (previous, new) snapshot after each swap
+        self.listeners: List[Callable[[Optional["CatalogSnapshot"], "CatalogSnapshot"], None]] = []
+
+    @property
+    def generation(self) -> int:
+        return self.snapshot.generation if self.snapshot else 0
+
+    async def _read_version(self):
+        meta = await self.db.catalog_meta.find_one({"_id": "catalog"})
+        return meta.get("version") if meta else None
+
+    async def _collection_signature(self, name: str) -> tuple:
+        collection = self.db[name]
+        count, newest, updated = await asyncio.gather(
+            collection.estimated_document_count(),
+            collection.find_one({}, {"_id": 1}, sort=[("_id", -1)]),
+            collection.find_one({"updated_at": {"$exists": True}}, {"updated_at": 1}, sort=[("updated_at", -1)]),
+        )
+        return (count, newest and newest["_id"], updated and updated["updated_at"])
+
+    async def _read_signature(self) -> tuple:
+        """What the poller compares between ticks, without reading the catalog itself."""
+        return tuple(await asyncio.gather(
+            self._read_version(), *(self._collection_signature(name) for name in CATALOG_COLLECTIONS)
+        ))
+
+    async def reload(self):
+        async with self._reload_lock:
+            version = await self._read_version()
+            dungeons, levels, questions = await asyncio.gather(
+                *(self.db[name].find({}).to_list(length=None) for name in CATALOG_COLLECTIONS)
+            )
+            dungeons, levels, questions = (self.clean_docs(docs) for docs in (dungeons, levels, questions))
+            fingerprint = hashlib.sha256(
+                json.dumps([dungeons, levels, questions], sort_keys=True, default=str).encode("utf-8")
+            ).hexdigest()
+            self.reloads += 1
+            if self.snapshot and self.snapshot.fingerprint == fingerprint:
+                # Nothing changed: keep the generation stable
+                self.snapshot.version = version
+                return
+            snapshot = CatalogSnapshot(
+                self.generation + 1,
+                dungeons,
+                levels,
+                questions,
+                version=version,
+                fingerprint=fingerprint,
+            )
+            if self.prepare is not None:
+                snapshot.responses = await asyncio.to_thread(self.prepare, snapshot)
+            previous, self.snapshot = self.snapshot, snapshot
+            for listener in self.listeners:
+                try:
+                    listener(previous, snapshot)
+                except Exception:
+                    logger.exception("Catalog listener failed")
+
+    async def start(self):
+        await self.reload()
+        self._task = asyncio.create_task(self._watch())
+
+    async def close(self):
+        for task in (self._task, self._pending_reload):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._task = self._pending_reload = None
+
+    def _request_reload(self):
+        self._dirty = True
+        if self._pending_reload is None or self._pending_reload.done():
+            self._pending_reload = asyncio.create_task(self._debounced_reload())
+
+    async def _debounced_reload(self):
+        # Events arriving during the sleep or the reload fold into the next pass
+        while self._dirty:
+            await asyncio.sleep(CATALOG_RELOAD_DEBOUNCE_SECONDS)
+            self._dirty = False
+            try:
+                await self.reload()
+            except PyMongoError as e:
+                logger.warning("Catalog reload failed: %s", e)
+
+    async def _watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(CATALOG_COLLECTIONS)}}}]
+        retry = CATALOG_WATCH_RETRY_SECONDS
+        while True:
+            try:
+                async with self.db.watch(pipeline) as stream:
+                    self.mode = "change_stream"
+                    # Pick up edits made before the stream (re)opened
+                    await self.reload()
+                    async for _ in stream:
+                        retry = CATALOG_WATCH_RETRY_SECONDS
+                        self._request_reload()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                if _change_streams_unsupported(e):
+                    # Standalone server: poll for the rest of the process
+                    logger.warning("Catalog change streams unsupported, polling instead: %s", e)
+                    break
+                logger.warning("Catalog change stream failed, reopening in %.0fs: %s", retry, e)
+            except PyMongoError as e:
+                # Stepdowns and network errors are transient
+                logger.warning("Catalog change stream failed, reopening in %.0fs: %s", retry, e)
+            self.mode = "change_stream_retry"
+            await asyncio.sleep(retry)
+            retry = min(retry * 2, CATALOG_WATCH_MAX_RETRY_SECONDS)
+        await self._poll()
+
+    async def _poll(self):
+        self.mode = "poll"
+        loop = asyncio.get_running_loop()
+        signature = None
+        full_reload_at = loop.time() + CATALOG_FULL_RELOAD_SECONDS
+        try:
+            signature = await self._read_signature()
+        except PyMongoError as e:
+            logger.warning("Catalog refresh failed: %s", e)
+        while True:
+            await asyncio.sleep(CATALOG_POLL_SECONDS)
+            try:
+                current = await self._read_signature()
+                if current != signature or loop.time() >= full_reload_at:
+                    await self.reload()
+                    full_reload_at = loop.time() + CATALOG_FULL_RELOAD_SECONDS
+                signature = current
+            except PyMongoError as e:
+                logger.warning("Catalog refresh failed: %s", e)
+
+    def stats(self) -> dict:
+        snap = self.snapshot
+        return {
+            "generation": self.generation,
+            "version": snap.version if snap else None,
+            "loaded_at": snap.loaded_at if snap else None,
+            "mode": self.mode,
+            "reloads": self.reloads,
+            "dungeons": len(snap.dungeons) if snap else 0,
+            "levels": len(snap.levels) if snap else 0,
+            "questions": len(snap.questions) if snap else 0,
+        }
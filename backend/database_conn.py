@@ -1,15 +1,184 @@
-from motor.motor_asyncio import AsyncIOMotorClient
+# database_conn.py
+"""
+The MongoDB client.
+
+The API process uses one client (created in main's startup, shared through
+app.state). Its pool and timeouts are configured from the environment;
+values given here override the same options in MONGO_URI:
+
+    MONGO_MAX_POOL_SIZE                connections per server (default 100)
+    MONGO_MIN_POOL_SIZE                connections kept open (default 10)
+    MONGO_MAX_IDLE_TIME_MS             idle connections are closed after this (default 300000)
+    MONGO_SERVER_SELECTION_TIMEOUT_MS  wait for a usable server (default 5000)
+    MONGO_CONNECT_TIMEOUT_MS           TCP connect + handshake (default 5000)
+    MONGO_SOCKET_TIMEOUT_MS            per operation on the socket (default 30000; 0 = none)
+    MONGO_READ_PREFERENCE              e.g. primaryPreferred (default primary; the API
+                                       reads its own writes, so keep reads on the primary
+                                       unless you know they don't need to)
+    MONGO_WRITE_CONCERN                w: a number or "majority" (default: server default)
+
+`PoolMonitor` listens to the driver's connection pool events and keeps
+per-server utilization (open and checked-out connections, checkout waits
+and failures). `warm_up` opens MONGO_WARMUP_CONNECTIONS connections (default
+MONGO_MIN_POOL_SIZE) before the app takes traffic.
+"""
+import asyncio
+import logging
 import os
+import threading
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MONGODB_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+DB_NAME = os.getenv("MONGODB_DB", "codedungeon")
+
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "30000"))
+MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE", "primary")
+MONGO_WRITE_CONCERN = os.getenv("MONGO_WRITE_CONCERN", "")
+MONGO_WARMUP_CONNECTIONS = int(os.getenv("MONGO_WARMUP_CONNECTIONS", str(MONGO_MIN_POOL_SIZE)))
+
+def client_options() -> dict:
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS or None,
+        "readPreference": MONGO_READ_PREFERENCE,
+    }
+    if MONGO_WRITE_CONCERN:
+        options["w"] = int(MONGO_WRITE_CONCERN) if MONGO_WRITE_CONCERN.isdigit() else MONGO_WRITE_CONCERN
+    return options
+
+def make_client(event_listeners: Optional[List] = None, **overrides) -> AsyncIOMotorClient:
+    """A client configured from the environment; `overrides` win (e.g. no socket timeout for maintenance jobs)."""
+    return AsyncIOMotorClient(MONGODB_URI, event_listeners=event_listeners or [], **{**client_options(), **overrides})
+
+class _ServerPool:
+    __slots__ = ("open", "checked_out", "max_checked_out", "checkouts", "failures", "wait_seconds", "max_wait_seconds", "cleared")
+
+    def __init__(self):
+        self.open = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.failures: Dict[str, int] = {}
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.cleared = 0
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Connection pool utilization per server. Events arrive on driver threads, hence the lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools: Dict[str, _ServerPool] = {}
+
+    def _pool(self, address) -> _ServerPool:
+        key = "%s:%s" % address
+        if key not in self._pools:
+            self._pools[key] = _ServerPool()
+        return self._pools[key]
+
+    def _waited(self, pool: _ServerPool, event):
+        # Time from checkout start to result, reported by pymongo 4.7+
+        duration = getattr(event, "duration", None)
+        if duration is not None:
+            pool.wait_seconds += duration
+            pool.max_wait_seconds = max(pool.max_wait_seconds, duration)
+
+    def connection_created(self, event):
+        with self._lock:
+            self._pool(event.address).open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self._pool(event.address).open -= 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool.checked_out += 1
+            pool.max_checked_out = max(pool.max_checked_out, pool.checked_out)
+            pool.checkouts += 1
+            self._waited(pool, event)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool.failures[event.reason] = pool.failures.get(event.reason, 0) + 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._pool(event.address).checked_out -= 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._pool(event.address).cleared += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
 
-MONGO_URI = os.getenv("MONGO_URI")
+    def pool_ready(self, event):
+        pass
 
-if not MONGO_URI:
-    # fallback for local testing
-    MONGO_URI = "mongodb://localhost:27017"
+    def pool_closed(self, event):
+        pass
 
-client = AsyncIOMotorClient(MONGO_URI)
-db = client[os.getenv("MONGODB_DB")]
+    def stats(self) -> dict:
+        with self._lock:
+            servers = {
+                address: {
+                    "open": pool.open,
+                    "checked_out": pool.checked_out,
+                    "max_checked_out": pool.max_checked_out,
+                    "utilization": round(pool.checked_out / MONGO_MAX_POOL_SIZE, 3) if MONGO_MAX_POOL_SIZE else None,
+                    "checkouts": pool.checkouts,
+                    "checkout_failures": dict(pool.failures),
+                    "avg_wait_ms": round(1000 * pool.wait_seconds / pool.checkouts, 3) if pool.checkouts else 0.0,
+                    "max_wait_ms": round(1000 * pool.max_wait_seconds, 3),
+                    "cleared": pool.cleared,
+                }
+                for address, pool in self._pools.items()
+            }
+        return {
+            "max_pool_size": MONGO_MAX_POOL_SIZE,
+            "min_pool_size": MONGO_MIN_POOL_SIZE,
+            "read_preference": MONGO_READ_PREFERENCE,
+            "write_concern": MONGO_WRITE_CONCERN or None,
+            "servers": servers,
+        }
 
-users_col = db["users"]
-questions_col = db["questions"]
-submissions_col = db["submissions"]
+async def warm_up(client: AsyncIOMotorClient, connections: int = MONGO_WARMUP_CONNECTIONS):
+    """
+    Open `connections` pooled connections up front by running that many
+    pings at once (each concurrent command checks out its own connection).
+    Failures are logged; the first requests then just connect lazily.
+    """
+    if connections <= 0:
+        return
+    # maxPoolSize=0 means unbounded
+    connections = min(connections, MONGO_MAX_POOL_SIZE or connections)
+    results = await asyncio.gather(*(client.admin.command("ping") for _ in range(connections)), return_exceptions=True)
+    failed = [r for r in results if isinstance(r, Exception)]
+    if failed:
+        logger.warning("MongoDB warm-up: %d of %d pings failed: %s", len(failed), len(results), failed[0])
@@ -0,0 +1,757 @@
+# generation.py
+"""
+Personalized-dungeon generation as background jobs.
+
+`POST /api/personalized_dungeons/generate` only enqueues a job; a fixed set
+of worker tasks performs the LLM calls with bounded concurrency through one
+shared async client. Job state is kept in memory for long-polling and
+mirrored to the `generation_jobs` collection so any API process can report
+it. Jobs a process leaves unfinished at shutdown are marked failed, and at
+startup jobs stuck `queued`/`running` for longer than any generation takes
+(left behind by a crashed process) are failed too, so pollers always see an
+end state. `LLM_BACKEND=fake` swaps Gemini for an offline stand-in so the whole
+pipeline can be load-tested without network access.
+
+Generated dungeons are cached by a fingerprint of the canonicalized mistake
+summary (DungeonCache): users with the same weak spots share one LLM call,
+and identical requests in flight at the same time are coalesced.
+
+In streaming mode (`stream_dungeon`) the model's token stream is scanned
+incrementally: each level is handed on as soon as its closing brace arrives,
+and job events let clients follow along over SSE. If the output is cut short
+or malformed, only the missing levels are requested again.
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "4"))
+GENERATION_QUEUE_DEPTH = int(os.getenv("GENERATION_QUEUE_DEPTH", "100"))
+FAKE_LLM_DELAY_SECONDS = float(os.getenv("FAKE_LLM_DELAY_SECONDS", "2"))
+# How often a long-poll for a job owned by another process re-reads Mongo
+JOB_POLL_SECONDS = 1.0
+# Finished jobs stay in memory this long, then are served from Mongo
+JOB_RETENTION_SECONDS = 300
+# Unfinished jobs older than this at startup belong to a process that died
+GENERATION_STALE_SECONDS = float(os.getenv("GENERATION_STALE_SECONDS", "900"))
+INTERRUPTED_ERROR = "Generation was interrupted, please try again"
+DUNGEON_CACHE_SIZE = int(os.getenv("DUNGEON_CACHE_SIZE", "256"))
+DUNGEON_CACHE_TTL_SECONDS = float(os.getenv("DUNGEON_CACHE_TTL_SECONDS", str(24 * 3600)))
+# Follow-up calls allowed for levels a streamed response failed to deliver
+GENERATION_REPAIR_ATTEMPTS = int(os.getenv("GENERATION_REPAIR_ATTEMPTS", "1"))
+# The prompt asks for 3-4 levels; fewer valid ones triggers a repair call
+MIN_LEVELS = 3
+# SSE comment sent when a job has had no events for this long
+EVENT_KEEPALIVE_SECONDS = 15
+
+SYSTEM_INSTRUCTION = "You are an expert programming educator. Always respond with valid JSON only."
+
+class GenerationError(Exception):
+    """Generation failed; the message is shown to the user."""
+
+class GenerationQueueFull(Exception):
+    """Raised when too many generation jobs are waiting."""
+
+# ============== PROMPT / PARSING ==============
+
+def summarize_mistakes(mistakes: List[dict]) -> List[str]:
+    """
+    One line per mistake, in canonical (sorted) order so that the same set of
+    mistakes always yields the same prompt and fingerprint.
+    """
+    mistake_summary = []
+    for m in mistakes:
+        if m["type"] == "mcq":
+            mistake_summary.append(
+                f"- MCQ mistake in dungeon '{m.get('dungeon_title', 'Unknown')}', level '{m.get('level_title', 'Unknown')}'"
+            )
+        else:
+            mistake_summary.append(
+                f"- Coding mistake in question '{m.get('question_title', 'Unknown')}' (category: {m.get('category', 'Unknown')})"
+            )
+    return sorted(mistake_summary)
+
+def mistake_fingerprint(mistakes: List[dict]) -> str:
+    return hashlib.sha256("\n".join(summarize_mistakes(mistakes)).encode("utf-8")).hexdigest()
+
+def build_prompt(mistakes: List[dict]) -> str:
+    mistake_text = "\n".join(summarize_mistakes(mistakes))
+    return f"""
+You are creating an educational programming dungeon for a student who made these mistakes:
+
+{mistake_text}
+
+Create a personalized learning dungeon with 3-4 levels that will help strengthen their weak areas.
+
+Return ONLY valid JSON in this exact format (no markdown, no code blocks):
+{{
+  "title": "Dungeon title based on weak areas",
+  "description": "Brief description of what this dungeon will teach",
+  "levels": [
+    {{
+      "title": "Level title",
+      "lesson": "Educational content explaining the concept (2-3 paragraphs with examples)",
+      "quiz": {{
+        "questions": [
+          {{
+            "q": "Question text?",
+            "options": ["A) Option 1", "B) Option 2", "C) Option 3", "D) Option 4"],
+            "answer": "A) Option 1"
+          }}
+        ]
+      }},
+      "xp": 50
+    }}
+  ]
+}}
+"""
+
+def parse_dungeon(content: str) -> dict:
+    content = content.strip()
+
+    # Clean fenced blocks
+    if content.startswith("```"):
+        content = content.split("\n", 1)[1]
+    if content.endswith("```"):
+        content = content.rsplit("```", 1)[0]
+
+    try:
+        return json.loads(content.strip())
+    except json.JSONDecodeError as e:
+        raise GenerationError(f"Failed to parse LLM response as JSON: {str(e)}")
+
+LEVEL_FORMAT = """{
+  "title": "Level title",
+  "lesson": "Educational content explaining the concept (2-3 paragraphs with examples)",
+  "quiz": {
+    "questions": [
+      {
+        "q": "Question text?",
+        "options": ["A) Option 1", "B) Option 2", "C) Option 3", "D) Option 4"],
+        "answer": "A) Option 1"
+      }
+    ]
+  },
+  "xp": 50
+}"""
+
+def build_continuation_prompt(mistakes: List[dict], levels: List[dict], missing: int) -> str:
+    """Ask only for the levels a truncated or malformed response did not deliver."""
+    mistake_text = "\n".join(summarize_mistakes(mistakes))
+    done = "\n".join(f"{i + 1}. {level.get('title', 'Untitled')}" for i, level in enumerate(levels)) or "(none)"
+    return f"""
+You are completing an educational programming dungeon for a student who made these mistakes:
+
+{mistake_text}
+
+The dungeon already has these levels:
+{done}
+
+Create {missing} more level(s) that strengthen weak areas not yet covered.
+
+Return ONLY a valid JSON array of level objects in this exact format (no markdown, no code blocks):
+[
+{LEVEL_FORMAT}
+]
+"""
+
+_LEVELS_KEY = re.compile(r'"levels"\s*:\s*$')
+
+def _valid_level(value) -> bool:
+    return isinstance(value, dict) and isinstance(value.get("title"), str)
+
+class DungeonStreamParser:
+    """
+    Incremental scanner for streamed dungeon JSON. `feed(chunk)` returns the
+    events completed by that chunk: ("header", {...}) once the "levels" array
+    opens, then ("level", {...}) as soon as each level object closes. Text
+    before the first bracket (e.g. a code fence) is skipped, and a malformed
+    level only loses itself, not the levels around it. A bare JSON array is
+    read as a list of levels.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.header: Optional[dict] = None
+        self.levels: List[dict] = []
+        self.malformed = 0
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._root: Optional[int] = None
+        # Depth inside the levels array; -1 once it has closed
+        self._levels_depth: Optional[int] = None
+        self._level_start: Optional[int] = None
+
+    def _open_levels(self, depth: int, prefix: str) -> Tuple[str, dict]:
+        self._levels_depth = depth
+        header = {}
+        # `{"title": ..., "description": ..., "levels": ` -> close it off and parse
+        prefix = _LEVELS_KEY.sub("", prefix).rstrip().rstrip(",")
+        if prefix:
+            try:
+                parsed = json.loads(prefix + "}")
+                if isinstance(parsed, dict):
+                    header = parsed
+            except json.JSONDecodeError:
+                pass
+        self.header = header
+        return ("header", header)
+
+    def feed(self, chunk: str) -> List[Tuple[str, dict]]:
+        self.text += chunk
+        text = self.text
+        events = []
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if self._root is None:
+                if ch == "{" or ch == "[":
+                    self._root = i
+                    self._depth = 1
+                    if ch == "[":
+                        events.append(self._open_levels(1, ""))
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch == "{" or ch == "[":
+                if ch == "[" and self._levels_depth is None and self._depth == 1 and _LEVELS_KEY.search(text, self._root, i):
+                    events.append(self._open_levels(2, text[self._root:i]))
+                elif ch == "{" and self._depth == self._levels_depth:
+                    self._level_start = i
+                self._depth += 1
+            elif ch == "}" or ch == "]":
+                self._depth -= 1
+                if ch == "}" and self._level_start is not None and self._depth == self._levels_depth:
+                    try:
+                        level = json.loads(text[self._level_start:i + 1])
+                    except json.JSONDecodeError:
+                        level = None
+                    self._level_start = None
+                    if _valid_level(level):
+                        self.levels.append(level)
+                        events.append(("level", level))
+                    else:
+                        self.malformed += 1
+                elif ch == "]" and self._levels_depth is not None and self._depth == self._levels_depth - 1:
+                    self._levels_depth = -1
+        self._pos = len(text)
+        return events
+
+# ============== LLM BACKENDS ==============
+
+class GeminiBackend:
+    def __init__(self, api_key: str, model: str = GEMINI_MODEL):
+        from google import genai
+
+        # One client for the process; its async surface shares connections across jobs
+        self.client = genai.Client(api_key=api_key).aio
+        self.model = model
+
+    async def generate(self, prompt: str) -> str:
+        try:
+            response = await self.client.models.generate_content(
+                model=self.model,
+                contents=[SYSTEM_INSTRUCTION, prompt],
+            )
+        except Exception as e:
+            raise GenerationError(f"Gemini API error: {str(e)}")
+        return response.text or ""
+
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        try:
+            response = await self.client.models.generate_content_stream(
+                model=self.model,
+                contents=[SYSTEM_INSTRUCTION, prompt],
+            )
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+        except Exception as e:
+            raise GenerationError(f"Gemini API error: {str(e)}")
+
+FAKE_DUNGEON = {
+    "title": "Practice Dungeon",
+    "description": "Offline placeholder dungeon produced by the fake LLM backend.",
+    "levels": [
+        {
+            "title": f"Practice Level {i}",
+            "lesson": "This lesson was generated offline for testing.",
+            "quiz": {"questions": [{"q": "Pick A?", "options": ["A) Yes", "B) No", "C) Maybe", "D) Never"], "answer": "A) Yes"}]},
+            "xp": 50,
+        }
+        for i in range(1, 4)
+    ],
+}
+
+class FakeBackend:
+    """Offline stand-in: returns a canned dungeon after a fixed delay."""
+
+    def __init__(self, delay: float = FAKE_LLM_DELAY_SECONDS):
+        self.delay = delay
+
+    async def generate(self, prompt: str) -> str:
+        await asyncio.sleep(self.delay)
+        return json.dumps(FAKE_DUNGEON)
+
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        # Same total delay, spread over small chunks like a real token stream
+        content = json.dumps(FAKE_DUNGEON)
+        chunks = [content[i:i + 64] for i in range(0, len(content), 64)]
+        for chunk in chunks:
+            await asyncio.sleep(self.delay / len(chunks))
+            yield chunk
+
+def make_backend():
+    """LLM backend selected by LLM_BACKEND, or None if Gemini has no API key."""
+    if LLM_BACKEND == "fake":
+        return FakeBackend()
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        return None
+    return GeminiBackend(api_key)
+
+# ============== STREAMING ==============
+
+async def stream_dungeon(
+    backend,
+    mistakes: List[dict],
+    on_header: Callable[[dict], Awaitable[None]],
+    on_level: Callable[[dict], Awaitable[None]],
+    repair_attempts: int = GENERATION_REPAIR_ATTEMPTS,
+) -> dict:
+    """
+    Generate a dungeon from the model's token stream. `on_header` is awaited
+    once before the first level, `on_level` for every valid level as it
+    completes. A stream that breaks off or yields too few valid levels is
+    topped up with continuation calls that ask for the missing levels only.
+    Returns the assembled dungeon data.
+    """
+    parser = DungeonStreamParser()
+    levels: List[dict] = []
+    header_sent = False
+
+    async def deliver(kind: str, value: dict):
+        nonlocal header_sent
+        if kind == "header" and header_sent:
+            return
+        if kind == "level" and not header_sent:
+            await deliver("header", {})
+        if kind == "header":
+            header_sent = True
+            await on_header(value)
+        else:
+            levels.append(value)
+            await on_level(value)
+
+    stream_error: Optional[GenerationError] = None
+    try:
+        async for chunk in backend.stream(build_prompt(mistakes)):
+            for kind, value in parser.feed(chunk):
+                await deliver(kind, value)
+    except GenerationError as e:
+        # Keep whatever arrived before the stream broke
+        stream_error = e
+        logger.warning("Dungeon stream interrupted after %d levels: %s", len(levels), e)
+
+    header = parser.header or {}
+    if "title" not in header or "description" not in header:
+        # Header fields may trail the levels; the full text parses if it completed
+        try:
+            complete = parse_dungeon(parser.text)
+            if isinstance(complete, dict):
+                header = {**{k: complete[k] for k in ("title", "description") if k in complete}, **header}
+        except GenerationError:
+            pass
+
+    attempts = 0
+    while len(levels) < MIN_LEVELS and attempts < repair_attempts:
+        attempts += 1
+        missing = MIN_LEVELS - len(levels)
+        logger.info("Dungeon stream gave %d valid levels (%d malformed); requesting %d more", len(levels), parser.malformed, missing)
+        try:
+            content = await backend.generate(build_continuation_prompt(mistakes, levels, missing))
+        except GenerationError as e:
+            stream_error = e
+            continue
+        repair = DungeonStreamParser()
+        for kind, value in repair.feed(content):
+            if kind == "level":
+                await deliver(kind, value)
+
+    if not levels:
+        raise stream_error or GenerationError("LLM response contained no valid levels")
+    if not header_sent:
+        await deliver("header", header)
+    return {"title": header.get("title"), "description": header.get("description"), "levels": levels}
+
+# ============== RESULT CACHE ==============
+
+class DungeonCache:
+    """
+    TTL + LRU cache of parsed dungeon data keyed by mistake fingerprint, with
+    single-flight: concurrent misses for one key share a single producer call.
+    Failures are shared with the waiting callers but never cached.
+    """
+
+    def __init__(self, size: int = DUNGEON_CACHE_SIZE, ttl: float = DUNGEON_CACHE_TTL_SECONDS):
+        self.size = max(0, size)
+        self.ttl = ttl
+        # key -> (expires_at, generation seconds, data)
+        self._entries: "OrderedDict[str, Tuple[float, float, dict]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+
+    def _lookup(self, key: str) -> Optional[Tuple[float, float, dict]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key: str, elapsed: float, data: dict):
+        if self.size:
+            self._entries[key] = (time.monotonic() + self.ttl, elapsed, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, key: str) -> Optional[dict]:
+        """Cached data for `key` (counted as a hit), or None without counting a miss."""
+        entry = self._lookup(key)
+        if entry is None:
+            return None
+        self.hits += 1
+        self.saved_seconds += entry[1]
+        return copy.deepcopy(entry[2])
+
+    def put(self, key: str, data: dict, elapsed: float):
+        """Store data produced outside get_or_create (streamed generations)."""
+        self.misses += 1
+        self._store(key, elapsed, copy.deepcopy(data))
+
+    async def get_or_create(self, key: str, produce: Callable[[], Awaitable[dict]]) -> dict:
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            elapsed, data = await asyncio.shield(inflight)
+            self.saved_seconds += elapsed
+            return copy.deepcopy(data)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        started = time.monotonic()
+        try:
+            data = await produce()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved so an unawaited failure isn't logged as lost
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+        elapsed = time.monotonic() - started
+        future.set_result((elapsed, data))
+        self._store(key, elapsed, data)
+        return copy.deepcopy(data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "capacity": self.size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            "saved_seconds": round(self.saved_seconds, 2),
+            "inflight": len(self._inflight),
+        }
+
+# ============== JOB QUEUE ==============
+
+class _Job:
+    def __init__(self, user_id: int, payload: dict):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.payload = payload
+        self.status = "queued"
+        self.created_at = datetime.utcnow()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.error: Optional[str] = None
+        self.result: Optional[dict] = None
+        self.done = asyncio.Event()
+        # (event, data) in order, replayed to every SSE subscriber
+        self.events: List[Tuple[str, dict]] = []
+        self._changed = asyncio.Event()
+
+    def emit(self, event: str, data: dict):
+        self.events.append((event, data))
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def public(self) -> dict:
+        return _public({
+            "_id": self.id,
+            "user_id": self.user_id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "dungeon": self.result,
+        })
+
+def _public(doc: dict) -> dict:
+    def iso(value):
+        return value.isoformat() if isinstance(value, datetime) else value
+    return {
+        "job_id": doc["_id"],
+        "user_id": doc.get("user_id"),
+        "status": doc.get("status"),
+        "created_at": iso(doc.get("created_at")),
+        "started_at": iso(doc.get("started_at")),
+        "finished_at": iso(doc.get("finished_at")),
+        "error": doc.get("error"),
+        "dungeon": doc.get("dungeon"),
+    }
+
+class GenerationQueue:
+    """
+    Bounded queue of generation jobs processed by `concurrency` workers.
+    `process(user_id, payload, emit)` does the actual work and returns the
+    result dict; it signals user-facing failures with GenerationError and may
+    publish progress with `emit(event, data)` for `events()` subscribers.
+    """
+
+    def __init__(
+        self,
+        jobs_col,
+        process: Callable[[int, dict, Callable[[str, dict], None]], Awaitable[dict]],
+        concurrency: int = GENERATION_CONCURRENCY,
+        queue_depth: int = GENERATION_QUEUE_DEPTH,
+    ):
+        self.jobs_col = jobs_col
+        self.process = process
+        self.concurrency = max(1, concurrency)
+        self.queue_depth = max(1, queue_depth)
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._jobs: Dict[str, _Job] = {}
+        self._active_by_user: Dict[int, str] = {}
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def start(self):
+        await self._fail_stale_jobs()
+        self._queue = asyncio.Queue(maxsize=self.queue_depth)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def close(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # Queued and cancelled jobs would otherwise stay "running" in Mongo
+        for job in [job for job in self._jobs.values() if not job.done.is_set()]:
+            job.status, job.error = "failed", INTERRUPTED_ERROR
+            self.failed += 1
+            await self._finish(job)
+
+    async def _fail_stale_jobs(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=GENERATION_STALE_SECONDS)
+        try:
+            result = await self.jobs_col.update_many(
+                {"status": {"$in": ["queued", "running"]}, "created_at": {"$lt": cutoff}},
+                {"$set": {"status": "failed", "error": INTERRUPTED_ERROR, "finished_at": datetime.utcnow()}},
+            )
+        except PyMongoError as e:
+            logger.warning("Could not fail stale generation jobs: %s", e)
+            return
+        if result.modified_count:
+            logger.warning("Marked %d interrupted generation jobs as failed", result.modified_count)
+
+    async def _persist(self, job: _Job):
+        doc = {
+            "user_id": job.user_id,
+            "status": job.status,
+            "created_at": job.created_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+            "error": job.error,
+            "dungeon": job.result,
+        }
+        try:
+            await self.jobs_col.update_one({"_id": job.id}, {"$set": doc}, upsert=True)
+        except PyMongoError as e:
+            # Status mirroring is best effort; the job itself carries on
+            logger.warning("Could not persist generation job %s: %s", job.id, e)
+
+    async def enqueue(self, user_id: int, payload: dict) -> dict:
+        """Queue a job for `user_id`, or return the one already in flight for them."""
+        active = self._active_by_user.get(user_id)
+        if active is not None:
+            return self._jobs[active].public()
+        if self._queue.full():
+            raise GenerationQueueFull()
+        job = _Job(user_id, payload)
+        self._jobs[job.id] = job
+        self._active_by_user[user_id] = job.id
+        # "queued" is written before a worker can pick the job up and persist "running"
+        await self._persist(job)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            # Filled up while persisting
+            self._jobs.pop(job.id, None)
+            self._active_by_user.pop(user_id, None)
+            job.status, job.error, job.finished_at = "failed", "Generation queue is full", datetime.utcnow()
+            await self._persist(job)
+            raise GenerationQueueFull()
+        return job.public()
+
+    async def status(self, job_id: str, wait: float = 0) -> Optional[dict]:
+        """Job status; with `wait` > 0, long-poll up to that many seconds for completion."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            if wait > 0 and not job.done.is_set():
+                try:
+                    await asyncio.wait_for(job.done.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            return job.public()
+
+        # Job owned by another process (or from before a restart)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while True:
+            doc = await self.jobs_col.find_one({"_id": job_id})
+            if doc is None:
+                return None
+            if doc.get("status") in ("done", "failed") or loop.time() >= deadline:
+                return _public(doc)
+            await asyncio.sleep(min(JOB_POLL_SECONDS, max(0.0, deadline - loop.time())))
+
+    async def events(self, job_id: str) -> Optional[AsyncIterator[Optional[Tuple[str, dict]]]]:
+        """
+        Event stream of a job: everything emitted so far, then new events
+        until it finishes ("done" or "failed" is always last). Yields None
+        as a keepalive when nothing happened for EVENT_KEEPALIVE_SECONDS.
+        Jobs not held by this process yield their final state once it exists.
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            if await self.jobs_col.find_one({"_id": job_id}, {"_id": 1}) is None:
+                return None
+            return self._remote_events(job_id)
+        return self._job_events(job)
+
+    async def _job_events(self, job: _Job):
+        sent = 0
+        while True:
+            changed = job._changed
+            while sent < len(job.events):
+                yield job.events[sent]
+                sent += 1
+            if job.done.is_set():
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), EVENT_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield None
+
+    async def _remote_events(self, job_id: str):
+        while True:
+            job = await self.status(job_id, wait=EVENT_KEEPALIVE_SECONDS)
+            if job is None:
+                return
+            if job["status"] in ("done", "failed"):
+                yield (job["status"], job)
+                return
+            yield None
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started_at = datetime.utcnow()
+            self.running += 1
+            await self._persist(job)
+            job.emit("status", {"status": job.status})
+            try:
+                job.result = await self.process(job.user_id, job.payload, job.emit)
+                job.status = "done"
+                self.completed += 1
+            except GenerationError as e:
+                job.status, job.error = "failed", str(e)
+                self.failed += 1
+            except Exception as e:
+                logger.exception("Generation job %s crashed", job.id)
+                job.status, job.error = "failed", f"Generation failed: {str(e)}"
+                self.failed += 1
+            finally:
+                self.running -= 1
+            await self._finish(job)
+
+    async def _finish(self, job: _Job):
+        job.finished_at = datetime.utcnow()
+        job.payload = None
+        self._active_by_user.pop(job.user_id, None)
+        await self._persist(job)
+        job.done.set()
+        job.emit(job.status, job.public())
+        asyncio.get_running_loop().call_later(JOB_RETENTION_SECONDS, self._jobs.pop, job.id, None)
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "queue_depth": self.queue_depth,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
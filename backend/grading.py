@@ -0,0 +1,132 @@
+# grading.py
+"""
+Single grading path shared by the "Run tests" and "Submit" endpoints.
+
+Grading results are cached per (question_id, question version, sha256(code))
+in a bounded LRU, so re-running identical code, or submitting code that was
+just tested, is answered without executing it again. Results whose outputs
+together render longer than GRADING_CACHE_MAX_RESULT_CHARS are not cached,
+so the entry-count bound also bounds memory. Entries of questions
+edited or removed by a catalog reload are dropped when the snapshot swaps. Execution itself goes
+through the sandbox pool, whose workers keep their own compiled-code cache.
+"""
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from sandbox import SandboxPool
+
+GRADING_CACHE_SIZE = int(os.getenv("GRADING_CACHE_SIZE", "2048"))
+GRADING_CACHE_MAX_RESULT_CHARS = int(os.getenv("GRADING_CACHE_MAX_RESULT_CHARS", "20000"))
+
+def code_digest(code: str) -> str:
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+def question_version(question: dict) -> str:
+    """
+    Version stamp of a question's grading inputs. Uses an explicit `version`
+    field when the catalog has one, otherwise a hash of the tests and entry
+    point so edited questions never reuse stale results.
+    """
+    if question.get("version") is not None:
+        return str(question["version"])
+    payload = json.dumps(
+        [question.get("function_name") or "solve", question.get("tests", [])],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+class GradingEngine:
+    def __init__(self, pool: SandboxPool, cache_size: int = GRADING_CACHE_SIZE):
+        self.pool = pool
+        self.cache_size = max(0, cache_size)
+        self._results: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self.compile_hits = 0
+        self.compile_misses = 0
+
+    async def grade(self, question: dict, code: str) -> dict:
+        """
+        Grade `code` against the question's tests.
+        Returns {"error": str|None, "passed": int, "total": int, "results": [...]}.
+        Callers must treat the returned dict as read-only (it may be shared).
+        """
+        tests = question.get("tests", []) or []
+        function_name = question.get("function_name") or "solve"
+        digest = code_digest(code)
+        key = (int(question["id"]), question_version(question), digest)
+
+        cached = self._results.get(key)
+        if cached is not None:
+            self._results.move_to_end(key)
+            self.hits += 1
+            return cached
+        self.misses += 1
+
+        outcome = await self.pool.run(code, function_name, tests, digest=digest)
+
+        if "compile_cache_hit" in outcome:
+            if outcome["compile_cache_hit"]:
+                self.compile_hits += 1
+            else:
+                self.compile_misses += 1
+
+        graded = {
+            "error": outcome["error"],
+            "passed": outcome["passed"],
+            "total": len(tests),
+            "results": outcome["results"],
+        }
+        # Resource-limit outcomes depend on load, so only cache deterministic
+        # ones, and only small ones
+        cacheable = outcome.get("cacheable", True) and outcome.get("output_chars", 0) <= GRADING_CACHE_MAX_RESULT_CHARS
+        if not cacheable:
+            self.uncacheable += 1
+        elif self.cache_size:
+            self._results[key] = graded
+            if len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+        return graded
+
+    def invalidate(self, question_ids: Optional[Iterable[int]] = None):
+        if question_ids is None:
+            self._results.clear()
+            return
+        question_ids = set(question_ids)
+        for key in [k for k in self._results if k[0] in question_ids]:
+            del self._results[key]
+
+    def catalog_changed(self, previous, snapshot):
+        """Catalog listener: drop results of questions that were edited or removed."""
+        if previous is None:
+            return
+        changed = [
+            q_id for q_id, question in previous.question_by_id.items()
+            if q_id not in snapshot.question_by_id
+            or question_version(snapshot.question_by_id[q_id]) != question_version(question)
+        ]
+        if changed:
+            self.invalidate(changed)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "result_cache": {
+                "size": len(self._results),
+                "capacity": self.cache_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "uncacheable": self.uncacheable,
+            },
+            "compile_cache": {
+                "hits": self.compile_hits,
+                "misses": self.compile_misses,
+            },
+            "sandbox": self.pool.stats(),
+        }
@@ -0,0 +1,54 @@
+# ids.py
+"""
+Numeric ID allocation (hi/lo).
+
+Each process reserves a block of IDs with one atomic `$inc` on the
+`counters` collection and hands them out locally, so most allocations need
+no database round trip and concurrent signups can never receive the same ID.
+Unused IDs of a block are skipped after a restart; IDs stay unique, not dense.
+The unique `id` indexes remain the safety net.
+"""
+import asyncio
+import os
+from typing import Dict, List
+
+from pymongo import ReturnDocument
+
+ID_BLOCK_SIZE = int(os.getenv("ID_BLOCK_SIZE", "20"))
+
+class IdAllocator:
+    def __init__(self, db, block_size: int = ID_BLOCK_SIZE):
+        self.counters = db.counters
+        self.block_size = max(1, block_size)
+        self._blocks: Dict[str, List[int]] = {}  # name -> [next, last]
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def seed(self, name: str, collection):
+        """
+        Make sure the counter is at least the highest `id` already stored in
+        `collection` (for data created before counters existed). `$max` keeps
+        this idempotent when several processes start at once.
+        """
+        last = await collection.find_one({}, {"id": 1}, sort=[("id", -1)])
+        highest = int(last["id"]) if last and last.get("id") is not None else 0
+        await self.counters.update_one({"_id": name}, {"$max": {"value": highest}}, upsert=True)
+        # Drop any local block that may now overlap stored IDs
+        self._blocks.pop(name, None)
+
+    async def next_id(self, name: str) -> int:
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            block = self._blocks.get(name)
+            if block is None or block[0] > block[1]:
+                counter = await self.counters.find_one_and_update(
+                    {"_id": name},
+                    {"$inc": {"value": self.block_size}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+                last = int(counter["value"])
+                block = [last - self.block_size + 1, last]
+                self._blocks[name] = block
+            new_id = block[0]
+            block[0] += 1
+            return new_id
@@ -0,0 +1,84 @@
+# indexes.py
+"""
+Index declarations for every query shape the API issues, plus tooling to
+verify them with explain().
+
+`ensure_indexes` runs at startup; create_index is a no-op when an identical
+index already exists, so it is safe on every boot.
+"""
+import logging
+from typing import List
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# (collection, keys, options)
+INDEXES = [
+    ("users", [("id", ASCENDING)], {"name": "id_unique", "unique": True}),
+    # Sparse so users not yet migrated (no username_lower) don't collide on null
+    ("users", [("username_lower", ASCENDING)], {"name": "username_lower_unique", "unique": True, "sparse": True}),
+    ("users", [("xp", DESCENDING), ("id", ASCENDING)], {"name": "xp_desc"}),
+    ("mistake_logs", [("user_id", ASCENDING), ("timestamp", DESCENDING)], {"name": "user_timestamp"}),
+    ("submissions", [("user_id", ASCENDING), ("timestamp", DESCENDING)], {"name": "user_timestamp"}),
+    ("personalized_dungeons", [("id", ASCENDING)], {"name": "id_unique", "unique": True}),
+    # Keyset pagination of the listing: (generated_at, _id) is a total order
+    ("personalized_dungeons", [("user_id", ASCENDING), ("generated_at", DESCENDING), ("_id", DESCENDING)], {"name": "user_generated_at_id"}),
+    # Generation job status is only needed while clients poll for it
+    ("generation_jobs", [("created_at", ASCENDING)], {"name": "created_at_ttl", "expireAfterSeconds": 7 * 24 * 3600}),
+    ("dungeons", [("id", ASCENDING)], {"name": "id_unique", "unique": True}),
+    ("levels", [("id", ASCENDING)], {"name": "id_unique", "unique": True}),
+    ("questions", [("id", ASCENDING)], {"name": "id_unique", "unique": True}),
+]
+
+async def ensure_indexes(db):
+    """Create any missing indexes. Failures (e.g. existing duplicates) are logged, not raised."""
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except OperationFailure as e:
+            logger.warning("Could not ensure index %s.%s: %s", collection, options.get("name"), e)
+
+# ============== EXPLAIN ==============
+
+# Representative values; plans depend on shape, not on whether documents match.
+SAMPLE_USER_ID = 1
+SAMPLE_USERNAME = "hero"
+
+def endpoint_queries(db):
+    """
+    (label, cursor) for each per-request query. Catalog and leaderboard
+    reloads read whole collections on purpose and are not listed.
+    """
+    return [
+        ("users by id (profile, submits)", db.users.find({"id": SAMPLE_USER_ID})),
+        ("users by username (login, signup)", db.users.find({"username_lower": SAMPLE_USERNAME})),
+        ("users award guard (submit_solution)", db.users.find({"id": SAMPLE_USER_ID, "completed_questions": {"$ne": 1}})),
+        ("mistake_logs count (counter seeding)", db.mistake_logs.find({"user_id": SAMPLE_USER_ID})),
+        ("mistake_logs latest (generate)", db.mistake_logs.find({"user_id": SAMPLE_USER_ID}).sort("timestamp", DESCENDING).limit(5)),
+        ("personalized_dungeons by user (listing)", db.personalized_dungeons.find({"user_id": SAMPLE_USER_ID}).sort([("generated_at", DESCENDING), ("_id", DESCENDING)]).limit(21)),
+        ("personalized_dungeons by id", db.personalized_dungeons.find({"id": 1})),
+    ]
+
+def plan_stages(plan: dict) -> List[str]:
+    """Flatten a winning plan into its stage names, outermost first."""
+    stages = [plan.get("stage", "?")]
+    if "inputStage" in plan:
+        stages += plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+async def explain_queries(db) -> bool:
+    """Print the winning plan of every endpoint query. Returns False if any is a COLLSCAN."""
+    ok = True
+    for label, cursor in endpoint_queries(db):
+        explained = await cursor.explain()
+        winning = explained.get("queryPlanner", {}).get("winningPlan", {})
+        # Newer servers nest the classic plan under queryPlan
+        stages = plan_stages(winning.get("queryPlan", winning))
+        collscan = "COLLSCAN" in stages
+        ok = ok and not collscan
+        print(f"{'FAIL' if collscan else 'ok  '}  {label}: {' <- '.join(stages)}")
+    return ok
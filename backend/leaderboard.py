@@ -0,0 +1,145 @@
+# leaderboard.py
+"""
+In-memory leaderboard index.
+
+Keeps every user's (xp, id) in one sorted list so top-N, rank-of-user and
+keyset pages are answered with a binary search instead of sorting the users
+collection. The index is updated from each XP award and periodically
+reconciled against Mongo, which also picks up awards made by other worker
+processes.
+"""
+import asyncio
+import logging
+import os
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, List, Optional, Tuple
+
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_RECONCILE_SECONDS = float(os.getenv("LEADERBOARD_RECONCILE_SECONDS", "300"))
+
+# Only the fields the leaderboard renders
+LEADERBOARD_PROJECTION = {"_id": 0, "id": 1, "username": 1, "level": 1, "xp": 1, "rank": 1, "win_streak": 1}
+
+Key = Tuple[int, int]
+
+def _key(xp: int, user_id: int) -> Key:
+    # Ascending order on (-xp, id) == highest XP first, ties by oldest account
+    return (-xp, user_id)
+
+def encode_cursor(key: Key) -> str:
+    return f"{-key[0]}:{key[1]}"
+
+def decode_cursor(cursor: str) -> Key:
+    xp, user_id = cursor.split(":", 1)
+    return _key(int(xp), int(user_id))
+
+class Leaderboard:
+    def __init__(self, users):
+        self.users = users
+        self._keys: List[Key] = []
+        self._entries: Dict[int, dict] = {}
+        self._task: Optional[asyncio.Task] = None
+        # Users updated while a load() scan is running, replayed before the swap
+        self._updated_during_load: Optional[Dict[int, dict]] = None
+        self.reconciled_at: Optional[float] = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def _entry(user_doc: dict) -> dict:
+        return {
+            "user_id": int(user_doc["id"]),
+            "username": user_doc.get("username"),
+            "level": int(user_doc.get("level", 1)),
+            "xp": int(user_doc.get("xp", 0)),
+            "title": user_doc.get("rank", ""),
+            "win_streak": int(user_doc.get("win_streak", 0)),
+        }
+
+    async def load(self):
+        """Rebuild the index from Mongo and swap it in."""
+        entries = {}
+        self._updated_during_load = {}
+        try:
+            async for doc in self.users.find({}, LEADERBOARD_PROJECTION):
+                if doc.get("id") is None:
+                    continue
+                entry = self._entry(doc)
+                entries[entry["user_id"]] = entry
+            # The scan may have read these users before their latest award
+            entries.update(self._updated_during_load)
+        finally:
+            self._updated_during_load = None
+        keys = sorted(_key(e["xp"], e["user_id"]) for e in entries.values())
+        self._keys, self._entries = keys, entries
+        self.reconciled_at = asyncio.get_running_loop().time()
+
+    def update(self, user_doc: Optional[dict]):
+        """Record a user's current XP (call with the document returned by an award)."""
+        if not user_doc or user_doc.get("id") is None:
+            return
+        entry = self._entry(user_doc)
+        if self._updated_during_load is not None:
+            self._updated_during_load[entry["user_id"]] = entry
+        old = self._entries.get(entry["user_id"])
+        if old is not None:
+            old_key = _key(old["xp"], old["user_id"])
+            i = bisect_left(self._keys, old_key)
+            if i < len(self._keys) and self._keys[i] == old_key:
+                del self._keys[i]
+        self._entries[entry["user_id"]] = entry
+        insort(self._keys, _key(entry["xp"], entry["user_id"]))
+
+    def _page(self, start: int, limit: int) -> List[dict]:
+        page = []
+        for offset, (_, user_id) in enumerate(self._keys[start:start + max(0, limit)]):
+            entry = dict(self._entries[user_id])
+            entry["rank"] = start + offset + 1
+            page.append(entry)
+        return page
+
+    def top(self, limit: int) -> List[dict]:
+        return self._page(0, limit)
+
+    def page_after(self, cursor: Optional[str], limit: int) -> dict:
+        """Keyset page: entries strictly after `cursor` (as returned in `next_cursor`)."""
+        start = bisect_right(self._keys, decode_cursor(cursor)) if cursor else 0
+        entries = self._page(start, limit)
+        end = start + len(entries)
+        next_cursor = encode_cursor(self._keys[end - 1]) if entries and end < len(self._keys) else None
+        return {"entries": entries, "next_cursor": next_cursor, "total": len(self._keys)}
+
+    def rank_of(self, user_id: int) -> Optional[int]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        return bisect_left(self._keys, _key(entry["xp"], user_id)) + 1
+
+    def around(self, user_id: int, radius: int) -> Optional[dict]:
+        rank = self.rank_of(user_id)
+        if rank is None:
+            return None
+        start = max(0, rank - 1 - radius)
+        return {"rank": rank, "total": len(self._keys), "entries": self._page(start, rank - start + radius)}
+
+    async def start(self):
+        await self.load()
+        self._task = asyncio.create_task(self._reconcile())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _reconcile(self):
+        while True:
+            await asyncio.sleep(LEADERBOARD_RECONCILE_SECONDS)
+            try:
+                await self.load()
+            except PyMongoError as e:
+                logger.warning("Leaderboard reconciliation failed: %s", e)
@@ -0,0 +1,159 @@
+# loaders.py
+"""
+Request-scoped loading of user documents.
+
+`RequestScopeMiddleware` opens a `RequestScope` for every HTTP request and
+keeps it in a ContextVar, so helpers find it without it being threaded
+through every handler. Within a request the scope's `UserLoader`:
+
+- memoizes users by id: a later load is served from memory when the fields
+  it asks for were already loaded;
+- batches: loads issued in the same event-loop tick (e.g. under
+  asyncio.gather) become one `find({"id": {"$in": [...]}})` projecting the
+  union of their views;
+- stays correct across writes: `prime` stores a document a write returned,
+  `forget` drops one a write changed without returning it.
+
+Catalog entities need no loader; they are served from the in-memory catalog
+snapshot (catalog.py) and cost no round trips.
+
+`gather_reads` runs a handler's independent reads concurrently; user loads
+among them share one batch.
+
+`RoundTripCounter` is a driver command listener counting every command
+(including getMores) sent on behalf of the current request. With
+DEBUG_DB_ROUND_TRIPS=1 the count is returned in the X-DB-Round-Trips header.
+"""
+import asyncio
+import os
+import threading
+from contextvars import ContextVar
+from typing import Any, Awaitable, Dict, FrozenSet, Optional, Set, Tuple
+
+from pymongo import monitoring
+from starlette.datastructures import MutableHeaders
+
+from repository import View, project, projection
+
+DEBUG_DB_ROUND_TRIPS = os.getenv("DEBUG_DB_ROUND_TRIPS", "0") == "1"
+ROUND_TRIPS_HEADER = "X-DB-Round-Trips"
+
+# Fields of a document known in full (returned by a write, or a user that does not exist)
+ALL_FIELDS = None
+
+class UserLoader:
+    def __init__(self, users):
+        self.users = users
+        # user id -> (fields loaded, document or None if there is no such user)
+        self._docs: Dict[int, Tuple[Optional[FrozenSet[str]], Optional[dict]]] = {}
+        self._pending: Dict[int, Set[str]] = {}
+        self._batch: Optional[asyncio.Task] = None
+
+    def _cached(self, user_id: int, view: View) -> Tuple[bool, Optional[dict]]:
+        entry = self._docs.get(user_id)
+        if entry is None:
+            return False, None
+        fields, doc = entry
+        if fields is not ALL_FIELDS and not fields.issuperset(view):
+            return False, None
+        return True, None if doc is None else project(doc, view)
+
+    async def load(self, user_id: int, view: View) -> Optional[dict]:
+        """The user's `view` fields, or None if there is no such user."""
+        hit, doc = self._cached(user_id, view)
+        if hit:
+            return doc
+        self._pending.setdefault(user_id, set()).update(view)
+        if self._batch is None:
+            self._batch = asyncio.ensure_future(self._dispatch())
+        # Shielded: one cancelled caller must not cancel the batch the others wait on
+        await asyncio.shield(self._batch)
+        return self._cached(user_id, view)[1]
+
+    async def _dispatch(self):
+        # Let every load issued in this tick join the batch first
+        await asyncio.sleep(0)
+        pending, self._pending, self._batch = self._pending, {}, None
+        fields = frozenset().union(*pending.values()) | {"id"}
+        query = {"id": {"$in": list(pending)}} if len(pending) > 1 else {"id": next(iter(pending))}
+        found = {doc["id"]: doc async for doc in self.users.find(query, projection(tuple(fields)))}
+        for user_id in pending:
+            doc = found.get(user_id)
+            if doc is None:
+                self._docs[user_id] = (ALL_FIELDS, None)
+                continue
+            known, previous = self._docs.get(user_id, (frozenset(), None))
+            self._docs[user_id] = (fields | known, {**(previous or {}), **doc})
+
+    def prime(self, doc: dict):
+        """Remember a whole user document returned by a write."""
+        self._docs[doc["id"]] = (ALL_FIELDS, {k: v for k, v in doc.items() if k != "_id"})
+
+    def forget(self, user_id: int):
+        self._docs.pop(user_id, None)
+
+class RequestScope:
+    def __init__(self):
+        self.round_trips = 0
+        self._lock = threading.Lock()
+        self._users: Optional[UserLoader] = None
+
+    def count_round_trip(self):
+        # Called from the driver's executor threads
+        with self._lock:
+            self.round_trips += 1
+
+    def users(self, collection) -> UserLoader:
+        if self._users is None:
+            self._users = UserLoader(collection)
+        return self._users
+
+_current: ContextVar[Optional[RequestScope]] = ContextVar("request_scope", default=None)
+
+def user_loader(users) -> Optional[UserLoader]:
+    """The current request's user loader; None outside a request (startup, background jobs)."""
+    scope = _current.get()
+    return scope.users(users) if scope is not None else None
+
+async def gather_reads(**reads: Awaitable) -> Dict[str, Any]:
+    """Await independent reads concurrently; results keyed like the arguments."""
+    values = await asyncio.gather(*reads.values())
+    return dict(zip(reads, values))
+
+class RoundTripCounter(monitoring.CommandListener):
+    """Counts commands per request. Motor runs the driver with the caller's context, so the ContextVar is visible here."""
+
+    def started(self, event):
+        scope = _current.get()
+        if scope is not None:
+            scope.count_round_trip()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+class RequestScopeMiddleware:
+    """ASGI middleware opening a RequestScope per HTTP request."""
+
+    def __init__(self, app, header: bool = DEBUG_DB_ROUND_TRIPS):
+        self.app = app
+        self.header = header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_scope = RequestScope()
+        token = _current.set(request_scope)
+
+        async def send_with_round_trips(message):
+            # Counted up to the moment headers go out (streamed bodies may add more)
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append(ROUND_TRIPS_HEADER, str(request_scope.round_trips))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_round_trips if self.header else send)
+        finally:
+            _current.reset(token)
@@ -1,24 +1,57 @@
 # main.py
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Depends, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List, Any
 from datetime import datetime
-import bcrypt
-import json
+from itertools import islice
+import asyncio
+import logging
 import os
+import re
+import time
 import httpx
-from motor.motor_asyncio import AsyncIOMotorClient
 from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from dotenv import load_dotenv
 
+# Local modules read their settings from the environment at import time
 load_dotenv()
 
-MONGODB_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
-DB_NAME = os.getenv("MONGODB_DB", "codedungeon")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+from sandbox import SandboxPool, SandboxBusy
+from grading import GradingEngine, code_digest
+from catalog import Catalog, QUESTION_SORT_KEYS
+from progress import award_progress
+from leaderboard import Leaderboard
+from indexes import ensure_indexes
+from passwords import PasswordHasher, PasswordHasherBusy
+from ids import IdAllocator
+from personalized import (
+    LEGACY_FIELD, LISTING_MAX_PAGE_SIZE, LISTING_PAGE_SIZE, MAX_LEVELS as MAX_PERSONALIZED_LEVELS, PROGRESS_FIELD,
+    award_guard, dungeon_key, level_bit, list_dungeons, migrate_user, progress_field,
+)
+from stats import UserStats, stats_view, submission_event
+from submissions import SubmissionWriter
+from serialization import FastJSONResponse, dumps
+from prerender import render_catalog, respond
+from repository import (
+    QUESTION_LIST, USER_AUTH, USER_DAILY, USER_EXISTS, USER_LEVEL_PROGRESS,
+    USER_PUBLIC, USER_QUESTION_PROGRESS, USER_STATS, USER_SUBMIT, View, project, projection,
+)
+from mistakes import MistakeRecorder
+from database_conn import DB_NAME, PoolMonitor, make_client, warm_up
+from loaders import ROUND_TRIPS_HEADER, RequestScopeMiddleware, RoundTripCounter, gather_reads, user_loader
+from generation import DungeonCache, GenerationQueue, GenerationQueueFull, build_prompt, make_backend, mistake_fingerprint, parse_dungeon, stream_dungeon
+
+# How often to re-check whether the username_lower migration has completed
+USERNAME_MIGRATION_CHECK_SECONDS = float(os.getenv("USERNAME_MIGRATION_CHECK_SECONDS", "60"))
+
+logger = logging.getLogger(__name__)
 
-app = FastAPI(title="CodeDungeon API", version="1.0.0")
+# Responses are encoded once by orjson (see serialization.py)
+app = FastAPI(title="CodeDungeon API", version="1.0.0", default_response_class=FastJSONResponse)
 
 # CORS for React frontend
 app.add_middleware(
@@ -27,7 +60,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count", ROUND_TRIPS_HEADER],
 )
+# Per-request user identity map and DB round-trip count (see loaders.py)
+app.add_middleware(RequestScopeMiddleware)
 
 # ============== MODELS ==============
 
@@ -74,6 +110,7 @@ class QuestionSubmit(BaseModel):
 class TestSubmit(BaseModel):
     code: str
     language: str
+    user_id: Optional[int] = None
 
 class SubmissionResult(BaseModel):
     success: bool
@@ -116,72 +153,129 @@ class PersonalizedDungeon(BaseModel):
 
 @app.on_event("startup")
 async def startup_db_client():
-    app.state.mongo_client = AsyncIOMotorClient(MONGODB_URI)
+    # The one client of the process (see database_conn.py)
+    app.state.db_pool = PoolMonitor()
+    app.state.mongo_client = make_client([RoundTripCounter(), app.state.db_pool])
     app.state.db = app.state.mongo_client[DB_NAME]
+    # Startup finishes before the server accepts connections
+    await warm_up(app.state.mongo_client)
+    await ensure_indexes(app.state.db)
+    app.state.ids = IdAllocator(app.state.db)
+    app.state.stats = UserStats(app.state.db)
+    await app.state.ids.seed("users", app.state.db.users)
+    await app.state.ids.seed("personalized_dungeons", app.state.db.personalized_dungeons)
+    # Until every user has username_lower, login falls back to a regex match
+    app.state.usernames_normalized = await usernames_normalized(app.state.db)
+    app.state.username_migration_watch = None
+    if not app.state.usernames_normalized:
+        app.state.username_migration_watch = asyncio.create_task(watch_username_migration())
+
+async def usernames_normalized(db) -> bool:
+    return await db.users.find_one({"username_lower": {"$exists": False}}, {"_id": 1}) is None
+
+async def watch_username_migration():
+    """Drop the regex fallback once manage.py migrate-username-lower has run, without a restart."""
+    while not app.state.usernames_normalized:
+        await asyncio.sleep(USERNAME_MIGRATION_CHECK_SECONDS)
+        try:
+            app.state.usernames_normalized = await usernames_normalized(app.state.db)
+        except PyMongoError as e:
+            logger.warning("Username migration check failed: %s", e)
+
+@app.on_event("shutdown")
+async def shutdown_username_migration_watch():
+    task = app.state.username_migration_watch
+    if task:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+@app.on_event("startup")
+async def startup_catalog():
+    app.state.catalog = Catalog(app.state.db, clean_docs, prepare=render_catalog)
+    await app.state.catalog.start()
+
+@app.on_event("shutdown")
+async def shutdown_catalog():
+    await app.state.catalog.close()
+
+@app.on_event("startup")
+async def startup_leaderboard():
+    app.state.leaderboard = Leaderboard(app.state.db.users)
+    await app.state.leaderboard.start()
 
+@app.on_event("shutdown")
+async def shutdown_leaderboard():
+    await app.state.leaderboard.close()
+
+@app.on_event("startup")
+async def startup_password_hasher():
+    app.state.passwords = PasswordHasher()
+
+@app.on_event("shutdown")
+async def shutdown_password_hasher():
+    app.state.passwords.close()
+
+@app.on_event("startup")
+async def startup_mistake_recorder():
+    app.state.mistakes = MistakeRecorder(app.state.db)
+    await app.state.mistakes.start()
+
+@app.on_event("shutdown")
+async def shutdown_mistake_recorder():
+    await app.state.mistakes.close()
+
+@app.on_event("startup")
+async def startup_submission_writer():
+    app.state.submissions = SubmissionWriter(app.state.db.submissions, user_stats=app.state.stats)
+    await app.state.submissions.start()
+
+@app.on_event("shutdown")
+async def shutdown_submission_writer():
+    await app.state.submissions.close()
+
+@app.on_event("startup")
+async def startup_generation_queue():
+    app.state.llm = make_backend()
+    app.state.dungeon_cache = DungeonCache()
+    app.state.generation = GenerationQueue(app.state.db.generation_jobs, process_generation_job)
+    await app.state.generation.start()
+
+@app.on_event("shutdown")
+async def shutdown_generation_queue():
+    await app.state.generation.close()
+
+@app.on_event("startup")
+async def startup_sandbox_pool():
+    app.state.sandbox = SandboxPool()
+    await app.state.sandbox.start()
+    app.state.grader = GradingEngine(app.state.sandbox)
+    app.state.catalog.listeners.append(app.state.grader.catalog_changed)
+
+@app.on_event("shutdown")
+async def shutdown_sandbox_pool():
+    await app.state.sandbox.close()
+
+# Shutdown handlers run in registration order; the ones above may still write
 @app.on_event("shutdown")
 async def shutdown_db_client():
     app.state.mongo_client.close()
 
-def to_jsonable(value):
+def clean_doc(doc: Optional[dict]) -> Optional[dict]:
     """
-    Recursively convert Mongo types (ObjectId) into JSON-serializable values.
+    Shallow copy of a document with its ObjectId `_id` as a string (or None).
+    Nested values are not walked; the response encoder handles BSON types.
     """
-    if isinstance(value, ObjectId):
-        return str(value)
-    if isinstance(value, dict):
-        return {k: to_jsonable(v) for k, v in value.items()}
-    if isinstance(value, list):
-        return [to_jsonable(v) for v in value]
-    # primitives (int/str/etc) are JSON safe
-    return value
-
-def clean_doc(doc: Optional[dict]) -> Optional[dict]:
-    """Return JSON-safe copy of a document (or None)."""
     if doc is None:
         return None
-    return to_jsonable(doc)
+    doc = dict(doc)
+    if isinstance(doc.get("_id"), ObjectId):
+        doc["_id"] = str(doc["_id"])
+    return doc
 
 def clean_docs(docs: List[dict]) -> List[dict]:
     """Convert list of docs to JSON-safe versions."""
     return [clean_doc(d) for d in docs]
 
-async def update_user_streak(user_id: int, user_doc: dict) -> int:
-    """
-    Update user's win streak based on daily activity.
-    Returns the new streak value.
-    """
-    db = app.state.db
-    today = datetime.utcnow().date().isoformat()
-    last_activity = user_doc.get("last_activity_date")
-    current_streak = int(user_doc.get("win_streak", 0))
-    
-    if last_activity == today:
-        # Already active today, no change
-        return current_streak
-    
-    if last_activity:
-        # Check if last activity was yesterday
-        from datetime import timedelta
-        yesterday = (datetime.utcnow().date() - timedelta(days=1)).isoformat()
-        if last_activity == yesterday:
-            # Consecutive day - increment streak
-            new_streak = current_streak + 1
-        else:
-            # Streak broken - reset to 1
-            new_streak = 1
-    else:
-        # First activity
-        new_streak = 1
-    
-    # Update user's streak and last activity date
-    await db.users.update_one(
-        {"id": user_id},
-        {"$set": {"win_streak": new_streak, "last_activity_date": today}}
-    )
-    
-    return new_streak
-
 def calculate_xp_for_level(level: int) -> int:
     """Calculate total XP required to reach a given level."""
     # Level 1 requires 0 XP, Level 2 requires 100 XP, etc.
@@ -197,8 +291,8 @@ def calculate_xp_in_current_level(total_xp: int, level: int, xp_to_next: int) ->
     return max(0, total_xp - xp_at_current_level)
 
 def _user_public(user_doc: dict, dungeons_completed: int = 0, total_dungeons: int = 0, total_questions: int = 0):
-    # Convert DB user doc to API-friendly dict (and ensure JSONable)
-    user_doc = to_jsonable(user_doc or {})
+    # Convert DB user doc to API-friendly dict
+    user_doc = user_doc or {}
     
     level = int(user_doc.get("level", 1))
     xp = int(user_doc.get("xp", 0))
@@ -223,93 +317,143 @@ def _user_public(user_doc: dict, dungeons_completed: int = 0, total_dungeons: in
         "created_at": user_doc.get("created_at"),
         "completed_questions": user_doc.get("completed_questions", []),
         "completed_levels": user_doc.get("completed_levels", []),
-        "completed_personalized_levels": user_doc.get("completed_personalized_levels", []),
+        "personalized_progress": user_doc.get(PROGRESS_FIELD, {}),
         "avatar": user_doc.get("avatar")
     }
 
-async def get_user_by_username(username: str):
+def normalize_username(username: str) -> str:
+    """Lookup key for usernames (usernames are unique case-insensitively)."""
+    return username.lower()
+
+async def get_user_by_username(username: str, view: View = USER_AUTH):
     db = app.state.db
-    doc = await db.users.find_one({"username": {"$regex": f"^{username}$", "$options": "i"}})
+    doc = await db.users.find_one({"username_lower": normalize_username(username)}, projection(view))
+    if doc is None and not app.state.usernames_normalized:
+        # Users created before username_lower existed (see manage.py migrate-username-lower);
+        # normalize them as they are found
+        doc = await db.users.find_one({
+            "username_lower": {"$exists": False},
+            "username": {"$regex": f"^{re.escape(username)}$", "$options": "i"}
+        }, projection(view + ("username",), with_id=True))
+        if doc is not None:
+            await db.users.update_one({"_id": doc.pop("_id")}, {"$set": {"username_lower": normalize_username(doc["username"])}})
     return clean_doc(doc)
 
-async def get_user_by_id(user_id: int):
+async def get_user_by_id(user_id: int, view: View = USER_PUBLIC):
+    """User document restricted to the fields of `view` (see repository.py), memoized per request."""
+    loader = user_loader(app.state.db.users)
+    if loader is not None:
+        return await loader.load(user_id, view)
     db = app.state.db
-    doc = await db.users.find_one({"id": user_id})
+    doc = await db.users.find_one({"id": user_id}, projection(view))
     return clean_doc(doc)
 
+def user_written(user_id: int, doc: Optional[dict] = None):
+    """After a write to a user: keep the returned document, or drop the now stale one from this request's loader."""
+    loader = user_loader(app.state.db.users)
+    if loader is None:
+        return
+    if doc is not None:
+        loader.prime(doc)
+    else:
+        loader.forget(user_id)
+
+def awarded(updated: dict):
+    """Propagate the user document an award returned."""
+    app.state.leaderboard.update(updated)
+    user_written(updated["id"], updated)
+
+async def insert_with_new_id(collection, counter: str, doc: dict) -> int:
+    """Insert `doc` under a freshly allocated numeric id (see ids.IdAllocator)."""
+    for _ in range(3):
+        doc["id"] = await app.state.ids.next_id(counter)
+        try:
+            await collection.insert_one(doc)
+            return doc["id"]
+        except DuplicateKeyError as e:
+            if "id" not in (e.details or {}).get("keyPattern", {}):
+                raise
+            # id taken by a document written outside the allocator: resync and retry
+            doc.pop("_id", None)
+            await app.state.ids.seed(counter, collection)
+    raise HTTPException(500, "Could not allocate an id")
+
 async def create_user(user_data: dict):
     db = app.state.db
-    await db.users.insert_one(user_data)
+    await insert_with_new_id(db.users, "users", user_data)
     return clean_doc(user_data)
 
-async def update_user_by_id(user_id: int, update: dict):
-    db = app.state.db
-    await db.users.update_one({"id": user_id}, {"$set": update})
-    return await get_user_by_id(user_id)
+async def get_question_by_id(question_id: int):
+    return app.state.catalog.snapshot.question_by_id.get(question_id)
 
-async def get_questions_from_db(filters: dict = None):
-    db = app.state.db
-    filters = filters or {}
-    cursor = db.questions.find(filters)
-    docs = [d async for d in cursor]
-    return clean_docs(docs)
+async def get_level_by_id(level_id: int):
+    return app.state.catalog.snapshot.level_by_id.get(level_id)
 
-async def get_question_by_id(question_id: int):
-    db = app.state.db
-    doc = await db.questions.find_one({"id": question_id})
-    return clean_doc(doc)
+async def grade_submission(question: dict, code: str) -> dict:
+    """Grade submitted code against a question (cached, runs in the sandbox pool)."""
+    started = time.perf_counter()
+    try:
+        outcome = await app.state.grader.grade(question, code)
+    except SandboxBusy:
+        raise HTTPException(503, "Code runner is busy, please try again in a moment")
+    return {**outcome, "duration_ms": round(1000 * (time.perf_counter() - started), 2)}
 
-async def get_dungeons_from_db():
-    db = app.state.db
-    docs = [d async for d in db.dungeons.find({})]
-    return clean_docs(docs)
+def run_fields(code: str, outcome: dict) -> dict:
+    """What a submission event records about a graded run of `code`."""
+    return {
+        "code_hash": code_digest(code),
+        "passed": outcome["passed"],
+        "total": outcome["total"],
+        "duration_ms": outcome["duration_ms"],
+        "error": bool(outcome["error"]),
+    }
 
-async def get_levels_from_db():
-    db = app.state.db
-    docs = [l async for l in app.state.db.levels.find({})]
-    return clean_docs(docs)
+async def record_submission(event: dict):
+    """
+    Queue the event for the submissions collection; the writer folds submits
+    into the user's stats in the background. Callers validate the user first.
+    """
+    if not event["user_id"] or event["user_id"] <= 0:
+        # Anonymous runs have no stats or history to keep
+        return
+    await app.state.submissions.record(event)
 
-async def get_dungeon_by_id(dungeon_id: int):
-    db = app.state.db
-    doc = await db.dungeons.find_one({"id": dungeon_id})
-    return clean_doc(doc)
+async def hash_password(password: str) -> str:
+    try:
+        return await app.state.passwords.hash(password)
+    except PasswordHasherBusy:
+        raise HTTPException(503, "Too many sign-in attempts right now, please try again")
 
-async def get_level_by_id(level_id: int):
-    doc = await app.state.db.levels.find_one({"id": level_id})
-    return clean_doc(doc)
+async def verify_password(password: str, password_hash: str) -> bool:
+    try:
+        return await app.state.passwords.verify(password, password_hash)
+    except PasswordHasherBusy:
+        raise HTTPException(503, "Too many sign-in attempts right now, please try again")
 
-async def get_completed_dungeons_from_levels(completed_levels: List[int]) -> List[int]:
+def get_user_completed_dungeons(user: dict) -> List[int]:
     """
-    Determine which dungeons are completed given a list of completed level IDs.
-    A dungeon is considered completed if all of its levels are present in completed_levels.
+    Completed dungeon IDs for a user, read from the maintained
+    `completed_dungeons` field (falls back to the catalog index for users
+    that predate it; see `manage.py backfill-completed-dungeons`).
     """
-    dungeons = await get_dungeons_from_db()
-    completed = []
-    for d in dungeons:
-        levels = d.get("levels", [])
-        if levels and all(l in completed_levels for l in levels):
-            completed.append(int(d["id"]))
-    return completed
+    if user.get("completed_dungeons") is not None:
+        return user["completed_dungeons"]
+    return app.state.catalog.snapshot.completed_dungeons(user.get("completed_levels", []) or [])
 
 # ============== AUTH ENDPOINTS ==============
 
 @app.post("/api/auth/signup", tags=["Auth"])
 async def signup(user: UserCreate):
     # duplicate check
-    existing = await get_user_by_username(user.username)
+    existing = await get_user_by_username(user.username, USER_EXISTS)
     if existing:
         raise HTTPException(400, "Username already exists")
-    db = app.state.db
 
-    # create numeric incremental id (simple approach)
-    last = await db.users.find_one(sort=[("id", -1)])
-    new_id = 1 if not last else int(last["id"]) + 1
-
-    password_hash = bcrypt.hashpw(user.password.encode(), bcrypt.gensalt()).decode()
+    password_hash = await hash_password(user.password)
     now = datetime.utcnow().isoformat()
     new_user = {
-        "id": new_id,
         "username": user.username,
+        "username_lower": normalize_username(user.username),
         "email": user.email,
         "password_hash": password_hash,
         "created_at": now,
@@ -321,11 +465,17 @@ async def signup(user: UserCreate):
         "total_quests": 0,
         "win_streak": 0,
         "completed_questions": [],
-        "completed_levels": []
+        "completed_levels": [],
+        "completed_dungeons": []
     }
 
-    await create_user(new_user)
-    return {"success": True, "message": "Hero created successfully", "user_id": new_id, "token": "placeholder_jwt_token"}
+    try:
+        created = await create_user(new_user)
+    except DuplicateKeyError:
+        # lost a race with a concurrent signup for the same name
+        raise HTTPException(400, "Username already exists")
+    app.state.leaderboard.update(created)
+    return {"success": True, "message": "Hero created successfully", "user_id": created["id"], "token": "placeholder_jwt_token"}
 
 @app.post("/api/auth/login", tags=["Auth"])
 async def login(credentials: UserLogin):
@@ -333,46 +483,49 @@ async def login(credentials: UserLogin):
     if not user:
         raise HTTPException(400, "User not found")
     # user doc returned from helper is already cleaned
-    if not bcrypt.checkpw(credentials.password.encode(), user["password_hash"].encode()):
+    if not await verify_password(credentials.password, user["password_hash"]):
         raise HTTPException(400, "Incorrect password")
+    # Upgrade hashes made with a lower work factor than currently configured
+    if app.state.passwords.needs_rehash(user["password_hash"]):
+        new_hash = await hash_password(credentials.password)
+        await app.state.db.users.update_one(
+            {"id": int(user["id"]), "password_hash": user["password_hash"]},
+            {"$set": {"password_hash": new_hash}}
+        )
     return {"success": True, "message": "Welcome back, hero!", "user_id": int(user["id"]), "token": "placeholder_jwt_token"}
 
 # ============== PROFILE ENDPOINTS ==============
 
+async def store_total_quests(user_id: int, total_quests: int):
+    await app.state.db.users.update_one({"id": user_id}, {"$set": {"total_quests": total_quests}})
+
 @app.get("/api/profile/{user_id}", tags=["Profile"])
-async def get_profile(user_id: int):
+async def get_profile(user_id: int, background: BackgroundTasks):
     user = await get_user_by_id(user_id)
     if not user:
         raise HTTPException(404, "User not found")
+    if LEGACY_FIELD in user:
+        user = await migrate_user(app.state.db, user)
+        user_written(user_id)
     
-    # Calculate dungeons completed and total
-    completed_levels = user.get("completed_levels", []) or []
-    completed_dungeons = await get_completed_dungeons_from_levels(completed_levels)
-    
-    # Get total dungeons count
-    all_dungeons = await get_dungeons_from_db()
-    total_dungeons = len(all_dungeons)
-    dungeons_completed = len(completed_dungeons)
+    # Totals are counted once per catalog snapshot, not per request
+    snapshot = app.state.catalog.snapshot
+    dungeons_completed = len(get_user_completed_dungeons(user))
+    total_dungeons = len(snapshot.dungeons)
+    total_quests = len(snapshot.questions)
     
-    # Get total quests count
-    all_questions = await get_questions_from_db()
-    total_quests = len(all_questions)
-    
-    # Update total_quests in user if different
+    # Keep the stored total_quests current, after the response is sent
     if user.get("total_quests", 0) != total_quests:
-        await app.state.db.users.update_one(
-            {"id": user_id},
-            {"$set": {"total_quests": total_quests}}
-        )
+        background.add_task(store_total_quests, user_id, total_quests)
     
-    return _user_public(user, dungeons_completed, total_dungeons, total_quests)
+    return FastJSONResponse(_user_public(user, dungeons_completed, total_dungeons, total_quests))
 
 class AvatarUpdate(BaseModel):
     avatar: dict
 
 @app.put("/api/profile/{user_id}/avatar", tags=["Profile"])
 async def update_avatar(user_id: int, data: AvatarUpdate):
-    user = await get_user_by_id(user_id)
+    user = await get_user_by_id(user_id, USER_EXISTS)
     if not user:
         raise HTTPException(404, "User not found")
     
@@ -380,31 +533,23 @@ async def update_avatar(user_id: int, data: AvatarUpdate):
         {"id": user_id},
         {"$set": {"avatar": data.avatar}}
     )
+    user_written(user_id)
     return {"success": True}
 
 @app.get("/api/profile/{user_id}/stats", tags=["Profile"])
 async def get_user_stats(user_id: int):
-    # You can implement real stats gathering from submissions/levels collection
-    return {
-        "total_xp": 3450,
-        "level": 12,
-        "rank": "Silver Knight",
-        "quests_completed": 47,
-        "quests_failed": 3,
-        "win_streak": 5,
-        "best_streak": 12,
-        "total_time_spent": 14400,
-        "avg_completion_time": 306,
-        "favorite_category": "Arrays",
-        "accuracy": 94.0
-    }
+    """Submission statistics, read from the user's incrementally maintained stats document"""
+    reads = await gather_reads(user=get_user_by_id(user_id, USER_STATS), stats=app.state.stats.get(user_id))
+    if not reads["user"]:
+        raise HTTPException(404, "User not found")
+    return stats_view(reads["stats"], reads["user"])
 
 # ============== DAILY LOGIN BONUS ==============
 
 @app.post("/api/daily-login/{user_id}", tags=["Profile"])
 async def check_daily_login(user_id: int):
     """Check if user should receive daily login bonus"""
-    user = await get_user_by_id(user_id)
+    user = await get_user_by_id(user_id, USER_DAILY)
     if not user:
         raise HTTPException(404, "User not found")
     
@@ -447,66 +592,36 @@ async def check_daily_login(user_id: int):
 @app.post("/api/daily-login/{user_id}/claim", tags=["Profile"])
 async def claim_daily_login(user_id: int):
     """Claim daily login bonus"""
-    user = await get_user_by_id(user_id)
-    if not user:
-        raise HTTPException(404, "User not found")
-    
-    from datetime import timedelta
     today = datetime.utcnow().date().isoformat()
-    last_login_bonus = user.get("last_login_bonus_date")
-    
-    # Prevent double claiming
-    if last_login_bonus == today:
-        return {"success": False, "message": "Already claimed today"}
-    
-    # Calculate streak and XP
-    current_streak = int(user.get("win_streak", 0))
-    last_activity = user.get("last_activity_date")
-    
-    if last_activity:
-        yesterday = (datetime.utcnow().date() - timedelta(days=1)).isoformat()
-        if last_activity == yesterday:
-            new_streak = current_streak + 1
-        elif last_activity == today:
-            new_streak = current_streak
-        else:
-            new_streak = 1
-    else:
-        new_streak = 1
-    
-    # Calculate XP
+
+    # 25 XP base + streak bonus (5 XP per day, max 35), computed from the
+    # streak as updated by the same write
     base_xp = 25
-    streak_bonus = min(new_streak, 7) * 5
-    total_xp = base_xp + streak_bonus
-    
-    # Update user
-    new_xp = int(user.get("xp", 0)) + total_xp
-    level = int(user.get("level", 1))
-    xp_to_next = int(user.get("xp_to_next", 100))
-    
-    # Check for level up
-    while new_xp >= xp_to_next:
-        level += 1
-        xp_to_next = level * 500
-    
-    await app.state.db.users.update_one(
-        {"id": user_id},
-        {"$set": {
-            "xp": new_xp,
-            "level": level,
-            "xp_to_next": xp_to_next,
-            "win_streak": new_streak,
-            "last_activity_date": today,
-            "last_login_bonus_date": today
-        }}
+    bonus_xp = {"$add": [base_xp, {"$multiply": [{"$min": ["$win_streak", 7]}, 5]}]}
+
+    # Prevent double claiming: the guard only matches if not claimed today
+    updated = await award_progress(
+        app.state.db.users,
+        user_id,
+        bonus_xp,
+        guard={"last_login_bonus_date": {"$ne": today}},
+        set_fields={"last_login_bonus_date": today},
     )
-    
+    if updated is None:
+        if not await get_user_by_id(user_id, USER_EXISTS):
+            raise HTTPException(404, "User not found")
+        return {"success": False, "message": "Already claimed today"}
+    awarded(updated)
+
+    new_streak = int(updated.get("win_streak", 1))
+    total_xp = base_xp + min(new_streak, 7) * 5
+
     return {
         "success": True,
         "xp_earned": total_xp,
         "new_streak": new_streak,
-        "new_xp": new_xp,
-        "new_level": level
+        "new_xp": int(updated.get("xp", 0)),
+        "new_level": int(updated.get("level", 1))
     }
 
 # ============== QUESTIONS/QUESTS ENDPOINTS ==============
@@ -516,58 +631,52 @@ async def get_questions(
     difficulty: Optional[str] = None,
     category: Optional[str] = None,
     status: Optional[str] = None,
-    user_id: Optional[int] = None
+    user_id: Optional[int] = None,
+    sort: Optional[str] = None,
+    offset: int = 0,
+    limit: Optional[int] = None
 ):
-    # Pull all questions
-    questions = await get_questions_from_db()
+    """
+    Question list with per-user status. `sort` is id, xp, title or difficulty
+    (prefix "-" for descending; catalog order by default); `offset`/`limit`
+    page the result and X-Total-Count carries the number of matches.
+    """
+    snapshot = app.state.catalog.snapshot
+    descending = bool(sort) and sort.startswith("-")
+    order = snapshot.question_orders.get(sort.lstrip("-") if sort else None)
+    if order is None:
+        raise HTTPException(400, f"Invalid sort, expected one of: {', '.join(QUESTION_SORT_KEYS)}")
+    if descending:
+        order = reversed(order)
 
     # Load user progress if requested
-    completed_levels = []
-    completed_questions = []
-    completed_dungeons = []
+    completed_questions = frozenset()
+    completed_dungeons = frozenset()
     if user_id:
-        user = await get_user_by_id(user_id)
+        user = await get_user_by_id(user_id, USER_QUESTION_PROGRESS)
         if user:
-            completed_levels = user.get("completed_levels", []) or []
-            completed_questions = user.get("completed_questions", []) or []
-            completed_dungeons = await get_completed_dungeons_from_levels(completed_levels)
-
-    # Determine status per user
-    for q in questions:
-        q.setdefault("status", "available")
-        q_id = int(q.get("id"))
-        req_d = q.get("required_dungeon")
-        if q_id in completed_questions:
-            q["status"] = "completed"
-        elif req_d is not None:
-            # ensure types
-            try:
-                req_d_int = int(req_d)
-            except:
-                req_d_int = None
-            if req_d_int is not None and req_d_int in completed_dungeons:
-                q["status"] = "available"
-            else:
-                q["status"] = "locked"
-        else:
-            q["status"] = q.get("status", "available")
+            completed_questions = frozenset(user.get("completed_questions", []) or [])
+            completed_dungeons = frozenset(get_user_completed_dungeons(user))
+
+    # Filters are set operations on the catalog's inverted indexes
+    selected = snapshot.select_questions(completed_questions, completed_dungeons, difficulty, category, status)
+    total = len(snapshot.question_ids) if selected is None else len(selected)
+    matches = order if selected is None else (q_id for q_id in order if q_id in selected)
+    offset = max(offset, 0)
+    stop = offset + max(limit, 0) if limit is not None else None
 
-    # Apply filters
-    if difficulty:
-        questions = [q for q in questions if str(q.get("difficulty", "")).lower() == difficulty.lower()]
-    if category:
-        questions = [q for q in questions if str(q.get("category", "")).lower() == category.lower()]
-    if status:
-        questions = [q for q in questions if str(q.get("status", "")).lower() == status.lower()]
+    # Only the returned page is projected and annotated
+    questions = []
+    for q_id in islice(matches, offset, stop):
+        q = project(snapshot.question_by_id[q_id], QUESTION_LIST)
+        q["status"] = snapshot.question_status(q_id, completed_questions, completed_dungeons)
+        questions.append(q)
 
-    return questions
+    return FastJSONResponse(questions, headers={"X-Total-Count": str(total)})
 
 @app.get("/api/questions/{question_id}", tags=["Questions"])
-async def get_question(question_id: int):
-    q = await get_question_by_id(question_id)
-    if not q:
-        raise HTTPException(404, "Question not found")
-    return q
+async def get_question(question_id: int, request: Request):
+    return catalog_response(request, ("question", question_id), "Question not found")
 
 @app.post("/api/questions/{question_id}/submit", tags=["Questions"])
 async def submit_solution(question_id: int, submission: QuestionSubmit):
@@ -577,7 +686,7 @@ async def submit_solution(question_id: int, submission: QuestionSubmit):
         raise HTTPException(404, "Question not found")
 
     # Load user
-    user = await get_user_by_id(submission.user_id)
+    user = await get_user_by_id(submission.user_id, USER_SUBMIT)
     if not user:
         raise HTTPException(404, "User not found")
 
@@ -586,92 +695,42 @@ async def submit_solution(question_id: int, submission: QuestionSubmit):
     if question_id in completed_questions:
         return {"success": False, "passed": 0, "total": len(question.get("tests", [])), "xp_earned": 0, "message": "You have already completed this quest. No XP rewarded."}
 
-    # run code in restricted environment (still same risk as before)
-    tests = question.get("tests", [])
-    function_name = question.get("function_name") or "solve"
-
-    if not function_name:
-        raise HTTPException(500, "Question missing function_name")
-
-    restricted_globals = {
-        "__builtins__": {
-            "range": range,
-            "len": len,
-            "print": print,
-            "abs": abs,
-            "min": min,
-            "max": max,
-            "enumerate": enumerate,
-            "list": list,
-            "dict": dict,
-            "set": set,
-            "tuple": tuple,
-        }
-    }
-    restricted_locals = {}
-
-    try:
-        exec(submission.code, restricted_globals, restricted_locals)
-    except Exception as e:
-        return {"success": False, "passed": 0, "total": len(tests), "xp_earned": 0, "message": f"Code error: {str(e)}"}
+    outcome = await grade_submission(question, submission.code)
+    run = run_fields(submission.code, outcome)
+    if outcome["error"]:
+        await record_submission(submission_event(submission.user_id, "question", question_id, False, False, question.get("category"), **run))
+        return {"success": False, "passed": 0, "total": outcome["total"], "xp_earned": 0, "message": outcome["error"]}
 
-    if function_name not in restricted_locals:
-        return {"success": False, "passed": 0, "total": len(tests), "xp_earned": 0, "message": f"Function '{function_name}' not found in submitted code."}
+    passed = outcome["passed"]
+    results = outcome["results"]
 
-    user_function = restricted_locals[function_name]
-    passed = 0
-    results = []
-
-    for test in tests:
-        test_input = test.get("input")
-        expected_output = test.get("output")
-        try:
-            if isinstance(test_input, list):
-                result = user_function(*test_input)
-            else:
-                result = user_function(test_input)
-        except Exception as e:
-            results.append({"input": test_input, "expected": expected_output, "output": str(e), "passed": False})
-            continue
-
-        ok = result == expected_output
-        if ok:
-            passed += 1
-        results.append({"input": test_input, "expected": expected_output, "output": result, "passed": ok})
-
-    success = passed == len(tests)
+    success = passed == outcome["total"]
     xp_earned = 0
+    updated = None
 
     if success:
+        # XP, streak and level-up in one guarded write
+        updated = await award_progress(
+            app.state.db.users,
+            submission.user_id,
+            int(question.get("xp", 0)),
+            guard={"completed_questions": {"$ne": question_id}},
+            inc={"quests_completed": 1},
+            append={"completed_questions": question_id},
+        )
+        if updated is None:
+            # completed by a concurrent submission
+            await record_submission(submission_event(submission.user_id, "question", question_id, True, False, question.get("category"), **run))
+            return {"success": False, "passed": passed, "total": outcome["total"], "xp_earned": 0, "message": "You have already completed this quest. No XP rewarded.", "results": results}
+        awarded(updated)
         xp_earned = int(question.get("xp", 0))
-        # update user document
-        new_xp = int(user.get("xp", 0)) + xp_earned
-        new_quests_completed = int(user.get("quests_completed", 0)) + 1
-        completed_questions.append(question_id)
-
-        # level up logic
-        level = int(user.get("level", 1))
-        xp_to_next = int(user.get("xp_to_next", 100))
-        while new_xp >= xp_to_next:
-            level += 1
-            xp_to_next = level * 500
 
-        # Update streak
-        new_streak = await update_user_streak(submission.user_id, user)
-
-        await app.state.db.users.update_one(
-            {"id": submission.user_id},
-            {"$set": {
-                "xp": new_xp,
-                "level": level,
-                "xp_to_next": xp_to_next,
-                "quests_completed": new_quests_completed,
-                "completed_questions": completed_questions,
-                "win_streak": new_streak
-            }}
-        )
+    await record_submission(submission_event(
+        submission.user_id, "question", question_id, success, updated is not None, question.get("category"),
+        win_streak=updated.get("win_streak") if updated else None, **run,
+    ))
 
-    return {"success": success, "passed": passed, "total": len(tests), "xp_earned": xp_earned, "message": "All test cases passed!" if success else "Some test cases failed.", "results": results}
+    return {"success": success, "passed": passed, "total": outcome["total"], "xp_earned": xp_earned, "message": "All test cases passed!" if success else "Some test cases failed.", "results": results}
 
 @app.post("/api/questions/{question_id}/test")
 async def test_solution(question_id: int, submission: TestSubmit):
@@ -680,58 +739,25 @@ async def test_solution(question_id: int, submission: TestSubmit):
     if not question:
         raise HTTPException(404, "Question not found")
 
-    tests = question.get("tests", [])
-    function_name = question.get("function_name") or "solve"
-
-    if not function_name:
-        raise HTTPException(500, "Question missing function_name")
-
-    restricted_globals = {
-        "__builtins__": {
-            "range": range,
-            "len": len,
-            "print": print,
-            "abs": abs,
-            "min": min,
-            "max": max,
-            "enumerate": enumerate,
-            "list": list,
-            "dict": dict,
-            "set": set,
-            "tuple": tuple,
-        }
-    }
-    restricted_locals = {}
-
-    try:
-        exec(submission.code, restricted_globals, restricted_locals)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Code error: {str(e)}")
-
-    if function_name not in restricted_locals:
-        raise HTTPException(status_code=400, detail=f"Function '{function_name}' not found in submitted code.")
-
-    user_function = restricted_locals[function_name]
-    results = []
-    all_passed = True
+    # Runs are recorded only for users that exist; anyone else runs anonymously
+    grading = grade_submission(question, submission.code)
+    user_id = None
+    if submission.user_id and submission.user_id > 0:
+        reads = await gather_reads(outcome=grading, user=get_user_by_id(submission.user_id, USER_EXISTS))
+        outcome = reads["outcome"]
+        if reads["user"]:
+            user_id = submission.user_id
+    else:
+        outcome = await grading
+    all_passed = not outcome["error"] and all(r["passed"] for r in outcome["results"])
+    await record_submission(submission_event(
+        user_id, "question", question_id, all_passed, False, question.get("category"),
+        action="run", **run_fields(submission.code, outcome),
+    ))
+    if outcome["error"]:
+        raise HTTPException(status_code=400, detail=outcome["error"])
 
-    for test in tests:
-        test_input = test.get("input")
-        expected = test.get("output")
-        try:
-            if isinstance(test_input, list):
-                output = user_function(*test_input)
-            else:
-                output = user_function(test_input)
-        except Exception as e:
-            results.append({"input": test_input, "expected": expected, "output": str(e), "passed": False})
-            all_passed = False
-            continue
-
-        passed = output == expected
-        if not passed:
-            all_passed = False
-        results.append({"input": test_input, "expected": expected, "output": output, "passed": passed})
+    results = outcome["results"]
 
     return {"success": True, "all_passed": all_passed, "results": results}
 
@@ -739,54 +765,49 @@ async def test_solution(question_id: int, submission: TestSubmit):
 
 @app.get("/api/leaderboard", tags=["Leaderboard"])
 async def get_leaderboard(limit: int = 100):
-    cursor = app.state.db.users.find({}).sort("xp", -1).limit(limit)
-    users = [to_jsonable(u) for u in [u async for u in cursor]]
-    leaderboard = []
-    rank_counter = 1
-    for u in users:
-        leaderboard.append({
-            "rank": rank_counter, 
-            "username": u["username"], 
-            "level": int(u.get("level", 1)), 
-            "xp": int(u.get("xp", 0)), 
-            "title": u.get("rank", ""),
-            "win_streak": int(u.get("win_streak", 0))
-        })
-        rank_counter += 1
-    return leaderboard
+    return FastJSONResponse(app.state.leaderboard.top(limit))
+
+@app.get("/api/leaderboard/page", tags=["Leaderboard"])
+async def get_leaderboard_page(cursor: Optional[str] = None, limit: int = 50):
+    """Keyset-paginated leaderboard; pass back `next_cursor` to get the next page"""
+    try:
+        return FastJSONResponse(app.state.leaderboard.page_after(cursor, limit))
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor")
+
+@app.get("/api/leaderboard/rank/{user_id}", tags=["Leaderboard"])
+async def get_leaderboard_rank(user_id: int, radius: int = 5):
+    """A user's rank plus the entries around it ("where am I")"""
+    around = app.state.leaderboard.around(user_id, max(0, radius))
+    if around is None:
+        raise HTTPException(404, "User not found")
+    return FastJSONResponse(around)
 
 # ============== DUNGEONS & LEVELS ENDPOINTS ==============
 
+def catalog_response(request: Request, key: tuple, not_found: str):
+    """Pre-rendered catalog body for `key` with ETag / 304 handling (see prerender.py)."""
+    rendered = app.state.catalog.snapshot.responses.get(key)
+    if rendered is None:
+        raise HTTPException(404, not_found)
+    return respond(rendered, request.headers)
+
 @app.get("/api/dungeons", tags=["Dungeons"])
-async def get_dungeons():
-    dungeons = await get_dungeons_from_db()
-    return dungeons
+async def get_dungeons(request: Request):
+    return catalog_response(request, ("dungeons",), "Dungeons not found")
 
 @app.get("/api/dungeons/{dungeon_id}", tags=["Dungeons"])
-async def get_dungeon(dungeon_id: int):
-    d = await get_dungeon_by_id(dungeon_id)
-    if not d:
-        raise HTTPException(404, "Dungeon not found")
-    return d
+async def get_dungeon(dungeon_id: int, request: Request):
+    return catalog_response(request, ("dungeon", dungeon_id), "Dungeon not found")
 
 @app.get("/api/dungeons/{dungeon_id}/levels", tags=["Dungeons"])
-async def get_dungeon_levels(dungeon_id: int):
-    dungeon = await get_dungeon_by_id(dungeon_id)
-    if not dungeon:
-        raise HTTPException(404, "Dungeon not found")
-    levels_cursor = app.state.db.levels.find({"id": {"$in": dungeon.get("levels", [])}})
-    levels = [to_jsonable(l) for l in [l async for l in levels_cursor]]
-    # preserve order from dungeon.levels
-    id_order = dungeon.get("levels", [])
-    levels.sort(key=lambda x: id_order.index(x["id"]) if x["id"] in id_order else 0)
-    return levels
+async def get_dungeon_levels(dungeon_id: int, request: Request):
+    # Rendered in dungeon.levels order
+    return catalog_response(request, ("dungeon_levels", dungeon_id), "Dungeon not found")
 
 @app.get("/api/levels/{level_id}", tags=["Levels"])
-async def get_level(level_id: int):
-    level = await get_level_by_id(level_id)
-    if not level:
-        raise HTTPException(404, "Level not found")
-    return level
+async def get_level(level_id: int, request: Request):
+    return catalog_response(request, ("level", level_id), "Level not found")
 
 @app.post("/api/levels/{level_id}/submit", tags=["Levels"])
 async def submit_level(level_id: int, submission: LevelSubmit):
@@ -802,41 +823,48 @@ async def submit_level(level_id: int, submission: LevelSubmit):
 
     passed = correct == len(questions)
     xp_earned = 0
+    updated = None
 
-    if passed and submission.user_id > 0:
-        user = await get_user_by_id(submission.user_id)
+    if submission.user_id > 0:
+        user = await get_user_by_id(submission.user_id, USER_LEVEL_PROGRESS if passed else USER_EXISTS)
         if not user:
             raise HTTPException(404, "User not found")
 
+    if passed and submission.user_id > 0:
         completed = user.get("completed_levels", []) or []
         if level_id not in completed:
-            completed.append(level_id)
-            new_xp = int(user.get("xp", 0)) + int(level.get("xp", 0))
-            new_quests_completed = int(user.get("quests_completed", 0))
-            # award xp and increment if desired
-            new_quests_completed += 1
-            # level up logic
-            level_num = int(user.get("level", 1))
-            xp_to_next = int(user.get("xp_to_next", 100))
-            while new_xp >= xp_to_next:
-                level_num += 1
-                xp_to_next = level_num * 500
-
-            # Update streak
-            new_streak = await update_user_streak(submission.user_id, user)
-
-            await app.state.db.users.update_one(
-                {"id": submission.user_id},
-                {"$set": {
-                    "xp": new_xp,
-                    "level": level_num,
-                    "xp_to_next": xp_to_next,
-                    "quests_completed": new_quests_completed,
-                    "completed_levels": completed,
-                    "win_streak": new_streak
-                }}
+            # Only dungeons containing this level can become complete
+            snapshot = app.state.catalog.snapshot
+            completed_dungeons = set(get_user_completed_dungeons(user))
+            completed_dungeons.update(snapshot.dungeons_completed_by(level_id, completed))
+
+            updated = await award_progress(
+                app.state.db.users,
+                submission.user_id,
+                int(level.get("xp", 0)),
+                guard={"completed_levels": {"$ne": level_id}},
+                inc={"quests_completed": 1},
+                append={"completed_levels": level_id},
+                union={"completed_dungeons": sorted(completed_dungeons)},
             )
-            xp_earned = int(level.get("xp", 0))
+            if updated is not None:
+                awarded(updated)
+                xp_earned = int(level.get("xp", 0))
+                # Levels finished concurrently may complete a dungeon neither
+                # request could see on its own
+                missing = set(snapshot.dungeons_completed_by(level_id, updated.get("completed_levels", []))) - set(updated.get("completed_dungeons", []))
+                if missing:
+                    await app.state.db.users.update_one(
+                        {"id": submission.user_id},
+                        {"$addToSet": {"completed_dungeons": {"$each": sorted(missing)}}}
+                    )
+                    user_written(submission.user_id)
+
+    if submission.user_id > 0:
+        await record_submission(submission_event(
+            submission.user_id, "level", level_id, passed, updated is not None,
+            win_streak=updated.get("win_streak") if updated else None,
+        ))
 
     return {"success": passed, "correct": correct, "total": len(questions), "xp_earned": xp_earned, "message": "Level completed!" if passed else "Try again!"}
 
@@ -847,8 +875,6 @@ async def submit_level(level_id: int, submission: LevelSubmit):
 @app.post("/api/mistakes/log", tags=["Personalized Learning"])
 async def log_mistake(mistake: MistakeLog):
     """Log a user's mistake for later analysis"""
-    db = app.state.db
-    
     mistake_doc = {
         "user_id": mistake.user_id,
         "type": mistake.type,
@@ -862,10 +888,10 @@ async def log_mistake(mistake: MistakeLog):
         "timestamp": datetime.utcnow().isoformat()
     }
     
-    await db.mistake_logs.insert_one(mistake_doc)
+    # Written behind in batches; the returned count comes from the user's counter
+    mistake_count = await app.state.mistakes.record(mistake_doc)
     
     # Check if user has 5 mistakes - trigger generation
-    mistake_count = await db.mistake_logs.count_documents({"user_id": mistake.user_id})
     
     return {
         "success": True, 
@@ -875,153 +901,190 @@ async def log_mistake(mistake: MistakeLog):
     }
 
 @app.get("/api/personalized_dungeons/{user_id}", tags=["Personalized Learning"])
-async def get_personalized_dungeons(user_id: int):
-    """Get all personalized dungeons for a user"""
-    db = app.state.db
-    
-    cursor = db.personalized_dungeons.find({"user_id": user_id}).sort("generated_at", -1)
-    dungeons = [clean_doc(d) async for d in cursor]
-    
-    # Add completion status
-    user = await get_user_by_id(user_id)
-    completed_personalized = user.get("completed_personalized_levels", []) if user else []
-    
-    for dungeon in dungeons:
-        dungeon["levels_completed"] = sum(
-            1 for i, _ in enumerate(dungeon.get("levels", []))
-            if f"{dungeon['_id']}_{i}" in completed_personalized
-        )
-        dungeon["total_levels"] = len(dungeon.get("levels", []))
-        dungeon["is_completed"] = dungeon["levels_completed"] == dungeon["total_levels"]
-    
-    return dungeons
+async def get_personalized_dungeons(
+    user_id: int,
+    cursor: Optional[str] = None,
+    limit: int = Query(LISTING_PAGE_SIZE, ge=1, le=LISTING_MAX_PAGE_SIZE),
+):
+    """
+    A user's personalized dungeons, newest first, as summaries with progress
+    counts (levels come from the detail endpoint). Pass `next_cursor` back as
+    `cursor` for the next page; it is null on the last one.
+    """
+    try:
+        dungeons, next_cursor = await list_dungeons(app.state.db, user_id, limit, cursor)
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor")
+    return FastJSONResponse({"dungeons": dungeons, "next_cursor": next_cursor})
 
 @app.get("/api/personalized_dungeons/{user_id}/count", tags=["Personalized Learning"])
 async def get_mistake_count(user_id: int):
     """Get the current mistake count for a user"""
-    db = app.state.db
-    count = await db.mistake_logs.count_documents({"user_id": user_id})
+    count = await app.state.mistakes.count(user_id)
     return {"count": count, "threshold": 5}
 
-@app.post("/api/personalized_dungeons/generate", tags=["Personalized Learning"])
-async def generate_personalized_dungeon(user_id: int):
-    """Generate a personalized dungeon based on user's mistakes"""
-    from google import genai
+def new_personalized_dungeon(user_id: int, mistakes: List[dict], dungeon_data: dict) -> dict:
+    return {
+        "user_id": user_id,
+        "title": dungeon_data.get("title") or "Personalized Training",
+        "description": dungeon_data.get("description") or "AI-generated dungeon to strengthen your weak areas",
+        "difficulty": "personalized",
+        # Progress has one bit per level
+        "levels": dungeon_data.get("levels", [])[:MAX_PERSONALIZED_LEVELS],
+        "generated_at": datetime.utcnow().isoformat(),
+        "source_mistakes": [str(m.get("_id")) for m in mistakes]
+    }
 
-    GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-    if not GEMINI_API_KEY:
-        raise HTTPException(500, "Gemini API key missing")
+async def consume_mistakes(user_id: int, mistakes: List[dict]):
+    """Remove the mistakes a generated dungeon was built from."""
+    mistake_ids = [ObjectId(m["_id"]) for m in mistakes if m.get("_id")]
+    await app.state.mistakes.consume(user_id, mistake_ids)
 
-    client = genai.Client(api_key=GEMINI_API_KEY)
+async def process_generation_job(user_id: int, payload: dict, emit) -> dict:
+    """Generation worker body: call the LLM, store the dungeon, consume the mistakes."""
+    if payload.get("stream"):
+        return await process_streaming_generation(user_id, payload, emit)
 
     db = app.state.db
-    
-    # Get last 5 mistakes
-    cursor = db.mistake_logs.find({"user_id": user_id}).sort("timestamp", -1).limit(5)
-    mistakes = [clean_doc(m) async for m in cursor]
-    
-    if len(mistakes) < 5:
-        raise HTTPException(400, f"Need at least 5 mistakes to generate. Current: {len(mistakes)}")
-    
-    # Prepare mistake summary
-    mistake_summary = []
-    for m in mistakes:
-        if m["type"] == "mcq":
-            mistake_summary.append(
-                f"- MCQ mistake in dungeon '{m.get('dungeon_title', 'Unknown')}', level '{m.get('level_title', 'Unknown')}'"
-            )
-        else:
-            mistake_summary.append(
-                f"- Coding mistake in question '{m.get('question_title', 'Unknown')}' (category: {m.get('category', 'Unknown')})"
-            )
-    
-    mistake_text = "\n".join(mistake_summary)
-
-    # Prompt
-    prompt = f"""
-You are creating an educational programming dungeon for a student who made these mistakes:
-
-{mistake_text}
-
-Create a personalized learning dungeon with 3-4 levels that will help strengthen their weak areas.
-
-Return ONLY valid JSON in this exact format (no markdown, no code blocks):
-{{
-  "title": "Dungeon title based on weak areas",
-  "description": "Brief description of what this dungeon will teach",
-  "levels": [
-    {{
-      "title": "Level title",
-      "lesson": "Educational content explaining the concept (2-3 paragraphs with examples)",
-      "quiz": {{
-        "questions": [
-          {{
-            "q": "Question text?",
-            "options": ["A) Option 1", "B) Option 2", "C) Option 3", "D) Option 4"],
-            "answer": "A) Option 1"
-          }}
-        ]
-      }},
-      "xp": 50
-    }}
-  ]
-}}
-"""
-
-    # ========= FIXED GEMINI CALL ========= #
-    try:
-        gemini_response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                "You are an expert programming educator. Always respond with valid JSON only.",
-                prompt
-            ]
-        )
+    mistakes = payload["mistakes"]
 
-        content = gemini_response.text.strip()
+    async def produce():
+        content = await app.state.llm.generate(build_prompt(mistakes))
+        return parse_dungeon(content)
 
-        # Clean fenced blocks
-        if content.startswith("```"):
-            content = content.split("\n", 1)[1]
-        if content.endswith("```"):
-            content = content.rsplit("```", 1)[0]
+    # Same weak spots -> same dungeon content; shared across users and concurrent jobs
+    dungeon_data = await app.state.dungeon_cache.get_or_create(mistake_fingerprint(mistakes), produce)
 
-        content = content.strip()
-        dungeon_data = json.loads(content)
+    # Save dungeon
+    new_dungeon = new_personalized_dungeon(user_id, mistakes, dungeon_data)
+    await insert_with_new_id(db.personalized_dungeons, "personalized_dungeons", new_dungeon)
+    await consume_mistakes(user_id, mistakes)
+    return clean_doc(new_dungeon)
 
-    except json.JSONDecodeError as e:
-        raise HTTPException(500, f"Failed to parse LLM response as JSON: {str(e)}")
-    except Exception as e:
-        raise HTTPException(500, f"Gemini API error: {str(e)}")
+async def process_streaming_generation(user_id: int, payload: dict, emit) -> dict:
+    """
+    Streaming variant: the dungeon document is created as soon as the header
+    arrives (status "generating") and each level is $push-ed and emitted as
+    a "level" event the moment it parses, so the first level is playable
+    long before the response is complete.
+    """
+    db = app.state.db
+    mistakes = payload["mistakes"]
+    key = mistake_fingerprint(mistakes)
+
+    cached = app.state.dungeon_cache.get(key)
+    if cached is not None:
+        new_dungeon = new_personalized_dungeon(user_id, mistakes, cached)
+        await insert_with_new_id(db.personalized_dungeons, "personalized_dungeons", new_dungeon)
+        dungeon = clean_doc(new_dungeon)
+        emit("dungeon", {**dungeon, "levels": []})
+        for index, level in enumerate(dungeon["levels"]):
+            emit("level", {"dungeon_id": dungeon["id"], "index": index, "level": level})
+        await consume_mistakes(user_id, mistakes)
+        return dungeon
+
+    new_dungeon = None
+    level_count = 0
+
+    async def on_header(header: dict):
+        nonlocal new_dungeon
+        new_dungeon = new_personalized_dungeon(user_id, mistakes, {**header, "levels": []})
+        new_dungeon["status"] = "generating"
+        await insert_with_new_id(db.personalized_dungeons, "personalized_dungeons", new_dungeon)
+        emit("dungeon", clean_doc(new_dungeon))
+
+    async def on_level(level: dict):
+        nonlocal level_count
+        if level_count >= MAX_PERSONALIZED_LEVELS:
+            return
+        await db.personalized_dungeons.update_one({"_id": new_dungeon["_id"]}, {"$push": {"levels": level}})
+        emit("level", {"dungeon_id": new_dungeon["id"], "index": level_count, "level": level})
+        level_count += 1
+
+    started = time.monotonic()
+    try:
+        dungeon_data = await stream_dungeon(app.state.llm, mistakes, on_header, on_level)
+    except Exception:
+        # Don't leave an empty, never-finished dungeon behind
+        if new_dungeon is not None:
+            await db.personalized_dungeons.delete_one({"_id": new_dungeon["_id"]})
+        raise
+    app.state.dungeon_cache.put(key, dungeon_data, time.monotonic() - started)
+
+    final = new_personalized_dungeon(user_id, mistakes, dungeon_data)
+    update = {"title": final["title"], "description": final["description"], "status": "ready"}
+    dungeon = await db.personalized_dungeons.find_one_and_update(
+        {"_id": new_dungeon["_id"]},
+        {"$set": update},
+        return_document=ReturnDocument.AFTER,
+    )
+    await consume_mistakes(user_id, mistakes)
+    return clean_doc(dungeon)
 
-    # Save dungeon
-    last_dungeon = await db.personalized_dungeons.find_one(sort=[("id", -1)])
-    new_id = 1 if not last_dungeon else int(last_dungeon.get("id", 0)) + 1
+@app.post("/api/personalized_dungeons/generate", tags=["Personalized Learning"])
+async def generate_personalized_dungeon(user_id: int, stream: bool = False):
+    """
+    Start generating a personalized dungeon based on user's mistakes (returns a job to poll).
+    With `stream=true` levels are saved and published one by one as the model
+    produces them; follow them on /api/personalized_dungeons/jobs/{job_id}/events.
+    """
+    if app.state.llm is None:
+        raise HTTPException(500, "Gemini API key missing")
 
-    new_dungeon = {
-        "id": new_id,
-        "user_id": user_id,
-        "title": dungeon_data.get("title", "Personalized Training"),
-        "description": dungeon_data.get("description", "AI-generated dungeon to strengthen your weak areas"),
-        "difficulty": "personalized",
-        "levels": dungeon_data.get("levels", []),
-        "generated_at": datetime.utcnow().isoformat(),
-        "source_mistakes": [str(m.get("_id")) for m in mistakes]
-    }
+    db = app.state.db
     
-    await db.personalized_dungeons.insert_one(new_dungeon)
+    # Get last 5 mistakes (including any still waiting in the write-behind buffer)
+    await app.state.mistakes.flush()
+    cursor = db.mistake_logs.find({"user_id": user_id}).sort("timestamp", -1).limit(5)
+    mistakes = [clean_doc(m) async for m in cursor]
+    
+    if len(mistakes) < 5:
+        raise HTTPException(400, f"Need at least 5 mistakes to generate. Current: {len(mistakes)}")
 
-    # Remove used mistakes
-    mistake_ids = [ObjectId(m["_id"]) for m in mistakes if m.get("_id")]
-    if mistake_ids:
-        await db.mistake_logs.delete_many({"_id": {"$in": mistake_ids}})
+    try:
+        job = await app.state.generation.enqueue(user_id, {"mistakes": mistakes, "stream": stream})
+    except GenerationQueueFull:
+        raise HTTPException(503, "Dungeon generation is busy, please try again shortly")
 
     return {
         "success": True,
-        "message": "Personalized dungeon generated!",
-        "dungeon": clean_doc(new_dungeon)
+        "message": "Personalized dungeon generation started",
+        "job_id": job["job_id"],
+        "status": job["status"]
     }
 
+@app.get("/api/personalized_dungeons/jobs/{job_id}", tags=["Personalized Learning"])
+async def get_generation_job(job_id: str, wait: float = 0):
+    """Status of a generation job; `wait` long-polls up to 30 seconds for it to finish"""
+    job = await app.state.generation.status(job_id, wait=min(max(wait, 0), 30))
+    if job is None:
+        raise HTTPException(404, "Generation job not found")
+    return FastJSONResponse(job)
+
+@app.get("/api/personalized_dungeons/jobs/{job_id}/events", tags=["Personalized Learning"])
+async def stream_generation_job(job_id: str):
+    """
+    Server-sent events for a generation job: "status", "dungeon" (created),
+    "level" (one per level as it is ready), then "done" or "failed".
+    """
+    events = await app.state.generation.events(job_id)
+    if events is None:
+        raise HTTPException(404, "Generation job not found")
+
+    async def body():
+        async for item in events:
+            if item is None:
+                yield ": keepalive\n\n"
+                continue
+            event, data = item
+            yield f"event: {event}\ndata: {dumps(data).decode()}\n\n"
+
+    return StreamingResponse(
+        body(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.get("/api/personalized_dungeons/detail/{dungeon_id}", tags=["Personalized Learning"])
 async def get_personalized_dungeon(dungeon_id: str):
     """Get a specific personalized dungeon by ID"""
@@ -1036,7 +1099,7 @@ async def get_personalized_dungeon(dungeon_id: str):
     if not dungeon:
         raise HTTPException(404, "Personalized dungeon not found")
     
-    return clean_doc(dungeon)
+    return FastJSONResponse(clean_doc(dungeon))
 
 @app.post("/api/personalized_dungeons/{dungeon_id}/levels/{level_index}/submit", tags=["Personalized Learning"])
 async def submit_personalized_level(dungeon_id: str, level_index: int, submission: LevelSubmit):
@@ -1053,7 +1116,7 @@ async def submit_personalized_level(dungeon_id: str, level_index: int, submissio
         raise HTTPException(404, "Personalized dungeon not found")
     
     levels = dungeon.get("levels", [])
-    if level_index < 0 or level_index >= len(levels):
+    if level_index < 0 or level_index >= min(len(levels), MAX_PERSONALIZED_LEVELS):
         raise HTTPException(404, "Level not found")
     
     level = levels[level_index]
@@ -1066,36 +1129,27 @@ async def submit_personalized_level(dungeon_id: str, level_index: int, submissio
     
     passed = correct == len(questions)
     xp_earned = 0
+    key = dungeon_key(dungeon)
+    level_key = f"{key}_{level_index}"
+    updated = None
     
     if passed and submission.user_id > 0:
-        user = await get_user_by_id(submission.user_id)
-        if not user:
-            raise HTTPException(404, "User not found")
-        
-        level_key = f"{dungeon_id}_{level_index}"
-        completed = user.get("completed_personalized_levels", []) or []
-        
-        if level_key not in completed:
-            completed.append(level_key)
+        updated = await award_progress(
+            db.users,
+            submission.user_id,
+            int(level.get("xp", 50)),
+            guard=award_guard(dungeon, level_index),
+            bits={progress_field(key): level_bit(level_index)},
+            touch_streak=False,
+        )
+        if updated is not None:
+            awarded(updated)
             xp_earned = int(level.get("xp", 50))
-            new_xp = int(user.get("xp", 0)) + xp_earned
-            
-            # Level up logic
-            level_num = int(user.get("level", 1))
-            xp_to_next = int(user.get("xp_to_next", 100))
-            while new_xp >= xp_to_next:
-                level_num += 1
-                xp_to_next = level_num * 500
-            
-            await db.users.update_one(
-                {"id": submission.user_id},
-                {"$set": {
-                    "xp": new_xp,
-                    "level": level_num,
-                    "xp_to_next": xp_to_next,
-                    "completed_personalized_levels": completed
-                }}
-            )
+    
+    if submission.user_id > 0:
+        if updated is None and not await get_user_by_id(submission.user_id, USER_EXISTS):
+            raise HTTPException(404, "User not found")
+        await record_submission(submission_event(submission.user_id, "personalized", level_key, passed, updated is not None))
     
     return {
         "success": passed,
@@ -1111,6 +1165,41 @@ async def submit_personalized_level(dungeon_id: str, level_index: int, submissio
 async def health_check():
     return {"status": "healthy", "version": "1.0.0", "timestamp": datetime.utcnow().isoformat()}
 
+@app.get("/api/system/catalog", tags=["System"])
+async def catalog_stats():
+    """Catalog snapshot generation and refresh mode"""
+    return app.state.catalog.stats()
+
+@app.get("/api/system/passwords", tags=["System"])
+async def password_hasher_stats():
+    """Password hashing pool queue and timing metrics"""
+    return app.state.passwords.stats()
+
+@app.get("/api/system/generation", tags=["System"])
+async def generation_stats():
+    """Personalized-dungeon generation queue and result cache state"""
+    return {"queue": app.state.generation.stats(), "cache": app.state.dungeon_cache.stats()}
+
+@app.get("/api/system/mistakes", tags=["System"])
+async def mistake_stats():
+    """Mistake-log write-behind buffer state"""
+    return app.state.mistakes.stats()
+
+@app.get("/api/system/database", tags=["System"])
+async def database_stats():
+    """MongoDB connection pool utilization per server"""
+    return app.state.db_pool.stats()
+
+@app.get("/api/system/submissions", tags=["System"])
+async def submission_stats():
+    """Submission event queue: backlog, drops and write counters"""
+    return app.state.submissions.stats()
+
+@app.get("/api/system/grading", tags=["System"])
+async def grading_stats():
+    """Grading cache hit/miss counters and sandbox pool state"""
+    return app.state.grader.stats()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,130 @@
+# manage.py
+"""
+Maintenance commands for the CodeDungeon backend.
+
+Usage (from the backend directory):
+    python manage.py backfill-completed-dungeons
+    python manage.py benchmark-projections
+    python manage.py ensure-indexes
+    python manage.py explain-queries
+    python manage.py migrate-personalized-progress
+    python manage.py migrate-username-lower
+    python manage.py rebuild-mistake-counters
+    python manage.py rebuild-user-stats
+"""
+import argparse
+import asyncio
+import sys
+
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+# Local modules read their settings from the environment at import time
+load_dotenv()
+
+from catalog import Catalog
+from database_conn import DB_NAME, make_client
+from indexes import ensure_indexes, explain_queries
+from mistakes import rebuild_counters
+from personalized import LEGACY_FIELD, migrate_user
+from repository import benchmark
+from stats import rebuild as rebuild_stats
+from main import clean_docs, normalize_username
+
+BATCH_SIZE = 500
+
+async def backfill_completed_dungeons(db):
+    """Recompute the `completed_dungeons` field of every user from their completed levels."""
+    catalog = Catalog(db, clean_docs)
+    await catalog.reload()
+    snapshot = catalog.snapshot
+
+    ops = []
+    updated = 0
+    cursor = db.users.find({}, {"_id": 1, "completed_levels": 1, "completed_dungeons": 1})
+    async for user in cursor:
+        completed = snapshot.completed_dungeons(user.get("completed_levels", []) or [])
+        if user.get("completed_dungeons") == completed:
+            continue
+        ops.append(UpdateOne({"_id": user["_id"]}, {"$set": {"completed_dungeons": completed}}))
+        if len(ops) >= BATCH_SIZE:
+            await db.users.bulk_write(ops, ordered=False)
+            updated += len(ops)
+            ops = []
+    if ops:
+        await db.users.bulk_write(ops, ordered=False)
+        updated += len(ops)
+    print(f"completed_dungeons backfilled for {updated} users")
+
+async def benchmark_projections(db):
+    """Bytes and serialization time per endpoint, whole documents vs. projected views."""
+    return await benchmark(db)
+
+async def migrate_personalized_progress(db):
+    """Convert completed_personalized_levels arrays into per-dungeon progress bitmasks."""
+    migrated = 0
+    cursor = db.users.find({LEGACY_FIELD: {"$exists": True}}, {"_id": 0, "id": 1, LEGACY_FIELD: 1})
+    async for user in cursor:
+        await migrate_user(db, user)
+        migrated += 1
+    print(f"personalized progress migrated for {migrated} users")
+
+async def migrate_username_lower(db):
+    """Set `username_lower` on users created before it was maintained at signup."""
+    ops = []
+    updated = 0
+    cursor = db.users.find({"username_lower": {"$exists": False}}, {"_id": 1, "username": 1})
+    async for user in cursor:
+        if not isinstance(user.get("username"), str):
+            continue
+        ops.append(UpdateOne({"_id": user["_id"]}, {"$set": {"username_lower": normalize_username(user["username"])}}))
+        if len(ops) >= BATCH_SIZE:
+            await db.users.bulk_write(ops, ordered=False)
+            updated += len(ops)
+            ops = []
+    if ops:
+        await db.users.bulk_write(ops, ordered=False)
+        updated += len(ops)
+    print(f"username_lower set for {updated} users")
+    # Usernames that only differ by case block the unique index; create it now
+    await ensure_indexes(db)
+
+async def rebuild_mistake_counters(db):
+    """Reset every user's mistake counter to the number of stored mistake logs."""
+    counts = await rebuild_counters(db)
+    ops = [UpdateOne({"_id": user_id}, {"$set": {"count": count}}, upsert=True) for user_id, count in counts.items()]
+    for start in range(0, len(ops), BATCH_SIZE):
+        await db.mistake_counters.bulk_write(ops[start:start + BATCH_SIZE], ordered=False)
+    print(f"mistake counters rebuilt for {len(ops)} users")
+
+async def rebuild_user_stats(db):
+    """Recompute every user_stats document from the stored submission events."""
+    await rebuild_stats(db)
+    print(f"user stats rebuilt ({await db.user_stats.count_documents({})} users)")
+
+COMMANDS = {
+    "backfill-completed-dungeons": backfill_completed_dungeons,
+    "benchmark-projections": benchmark_projections,
+    "ensure-indexes": ensure_indexes,
+    # exits non-zero if any endpoint query plans a COLLSCAN
+    "explain-queries": explain_queries,
+    "migrate-personalized-progress": migrate_personalized_progress,
+    "migrate-username-lower": migrate_username_lower,
+    "rebuild-mistake-counters": rebuild_mistake_counters,
+    "rebuild-user-stats": rebuild_user_stats,
+}
+
+async def run(command: str):
+    # Rebuilds and backfills can run long; no socket timeout
+    client = make_client(socketTimeoutMS=None)
+    try:
+        return await COMMANDS[command](client[DB_NAME])
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CodeDungeon maintenance commands")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args()
+    if asyncio.run(run(args.command)) is False:
+        sys.exit(1)
@@ -0,0 +1,178 @@
+# mistakes.py
+"""
+Mistake logging with O(1) per-user counts.
+
+Each user's number of stored mistakes lives in `mistake_counters`
+({_id: user_id, count}) and is bumped with one atomic `$inc` per mistake,
+so neither logging nor reading the count scans `mistake_logs`. The log
+documents themselves are written behind: they are buffered and inserted
+with `insert_many` by size or time. The buffer is bounded; when it is full
+the caller waits for a flush instead of growing it. Documents a flush could
+not write go back into the buffer and are retried by the next flush (their
+client-side `_id` makes a retry of an already-written document a no-op);
+only what no longer fits under the cap is dropped, and its counter
+increments are taken back. Whatever is buffered is flushed on shutdown and
+before mistakes are read back (`flush()`).
+"""
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+MISTAKE_BUFFER_SIZE = int(os.getenv("MISTAKE_BUFFER_SIZE", "1000"))
+MISTAKE_FLUSH_BATCH = int(os.getenv("MISTAKE_FLUSH_BATCH", "100"))
+MISTAKE_FLUSH_SECONDS = float(os.getenv("MISTAKE_FLUSH_SECONDS", "1"))
+
+class MistakeRecorder:
+    def __init__(
+        self,
+        db,
+        buffer_size: int = MISTAKE_BUFFER_SIZE,
+        flush_batch: int = MISTAKE_FLUSH_BATCH,
+        flush_seconds: float = MISTAKE_FLUSH_SECONDS,
+    ):
+        self.logs = db.mistake_logs
+        self.counters = db.mistake_counters
+        self.buffer_size = max(1, buffer_size)
+        self.flush_batch = max(1, min(flush_batch, self.buffer_size))
+        self.flush_seconds = flush_seconds
+        self._buffer: List[dict] = []
+        self._lock = asyncio.Lock()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.recorded = 0
+        self.flushes = 0
+        self.dropped = 0
+
+    async def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def record(self, doc: dict) -> int:
+        """Buffer `doc` for insertion and return the user's new mistake count."""
+        while len(self._buffer) >= self.buffer_size:
+            if not await self.flush():
+                # Writes are failing; wait for the next attempt instead of spinning
+                await asyncio.sleep(self.flush_seconds)
+        # Client-side _id so the seeding count below can exclude this document
+        doc["_id"] = ObjectId()
+        self._buffer.append(doc)
+        self.recorded += 1
+        if len(self._buffer) >= self.flush_batch:
+            self._wake.set()
+
+        user_id = doc["user_id"]
+        before = await self.counters.find_one_and_update(
+            {"_id": user_id},
+            {"$inc": {"count": 1}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+        )
+        if before is not None:
+            return before.get("count", 0) + 1
+        # First counted mistake: fold in logs stored before counters existed
+        existing = await self.logs.count_documents({"user_id": user_id, "_id": {"$ne": doc["_id"]}})
+        if existing:
+            await self.counters.update_one({"_id": user_id}, {"$inc": {"count": existing}})
+        return existing + 1
+
+    async def count(self, user_id: int) -> int:
+        counter = await self.counters.find_one({"_id": user_id})
+        if counter is not None:
+            return max(0, counter.get("count", 0))
+        # No mistakes since counters were introduced
+        return await self.logs.count_documents({"user_id": user_id})
+
+    async def consume(self, user_id: int, mistake_ids: List[ObjectId]) -> int:
+        """Delete used mistakes and decrement the counter by however many were removed."""
+        if not mistake_ids:
+            return 0
+        result = await self.logs.delete_many({"_id": {"$in": mistake_ids}})
+        if result.deleted_count:
+            await self.counters.update_one(
+                {"_id": user_id},
+                [{"$set": {"count": {"$max": [0, {"$subtract": ["$count", result.deleted_count]}]}}}],
+            )
+        return result.deleted_count
+
+    async def flush(self) -> bool:
+        """Write buffered logs; False if some could not be written and were re-queued."""
+        async with self._lock:
+            if not self._buffer:
+                return True
+            batch, self._buffer = self._buffer, []
+            failed = []
+            try:
+                await self.logs.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # A duplicate _id means an earlier attempt already wrote the document
+                failed = [batch[err["index"]] for err in e.details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY]
+            except PyMongoError as e:
+                logger.warning("Could not write %d mistake logs: %s", len(batch), e)
+                failed = batch
+            self.flushes += 1
+            if failed:
+                await self._requeue(failed)
+            return not failed
+
+    async def _requeue(self, failed: List[dict]):
+        room = max(0, self.buffer_size - len(self._buffer))
+        kept, lost = failed[:room], failed[room:]
+        self._buffer[:0] = kept
+        if not lost:
+            return
+        self.dropped += len(lost)
+        logger.warning("Dropping %d mistake logs that could not be written", len(lost))
+        per_user: Dict[int, int] = {}
+        for doc in lost:
+            per_user[doc["user_id"]] = per_user.get(doc["user_id"], 0) + 1
+        try:
+            for user_id, n in per_user.items():
+                await self.counters.update_one({"_id": user_id}, {"$inc": {"count": -n}})
+        except PyMongoError as e:
+            # rebuild-mistake-counters repairs what could not be taken back
+            logger.warning("Could not correct mistake counters: %s", e)
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self._buffer),
+            "buffer_size": self.buffer_size,
+            "flush_batch": self.flush_batch,
+            "flush_seconds": self.flush_seconds,
+            "recorded": self.recorded,
+            "flushes": self.flushes,
+            "dropped": self.dropped,
+        }
+
+async def rebuild_counters(db) -> Dict[int, int]:
+    """Recompute every counter from `mistake_logs` in one aggregation."""
+    counts = {}
+    async for row in db.mistake_logs.aggregate([{"$group": {"_id": "$user_id", "count": {"$sum": 1}}}]):
+        counts[row["_id"]] = row["count"]
+    async for counter in db.mistake_counters.find({}, {"_id": 1}):
+        counts.setdefault(counter["_id"], 0)
+    return counts
@@ -0,0 +1,86 @@
+# passwords.py
+"""
+bcrypt hashing off the event loop.
+
+bcrypt is deliberately slow (~100-300 ms per call) and releases the GIL, so
+it runs on a small dedicated thread pool. The number of pending calls is
+capped: beyond it callers get PasswordHasherBusy instead of queueing without
+bound, and queue wait / run times are tracked for monitoring.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "4"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hash/verify calls are already pending."""
+
+def hash_cost(password_hash: str) -> int:
+    """Work factor encoded in a bcrypt hash ("$2b$12$..." -> 12); 0 if unparseable."""
+    try:
+        return int(password_hash.split("$")[2])
+    except (IndexError, ValueError):
+        return 0
+
+class PasswordHasher:
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING, rounds: int = BCRYPT_ROUNDS):
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.rounds = rounds
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    async def _submit(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self.pending += 1
+        queued_at = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            return started, fn(*args), time.perf_counter()
+
+        try:
+            started, result, finished = await asyncio.get_running_loop().run_in_executor(self._executor, timed)
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        self.wait_seconds += started - queued_at
+        self.run_seconds += finished - started
+        return result
+
+    async def hash(self, password: str) -> str:
+        hashed = await self._submit(bcrypt.hashpw, password.encode(), bcrypt.gensalt(rounds=self.rounds))
+        return hashed.decode()
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        return await self._submit(bcrypt.checkpw, password.encode(), password_hash.encode())
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        return hash_cost(password_hash) < self.rounds
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "rounds": self.rounds,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(1000 * self.wait_seconds / self.completed, 2) if self.completed else 0.0,
+            "avg_run_ms": round(1000 * self.run_seconds / self.completed, 2) if self.completed else 0.0,
+        }
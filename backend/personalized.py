@@ -0,0 +1,177 @@
+# personalized.py
+"""
+Personalized-dungeon progress as per-dungeon completion bitmasks.
+
+A user's progress is one map, `personalized_progress`, from dungeon key
+(the dungeon's `_id` as a string) to an int whose bit i is set once level i
+has been completed. Checking a level is a bit test, a dungeon's completed
+count is a popcount, and a completion sets one bit atomically together with
+the XP award (see progress.award_progress).
+
+Users from before the map existed have a `completed_personalized_levels`
+array of "<dungeon>_<index>" strings, where <dungeon> is whatever id the
+client put in the URL (`_id` or the numeric `id`). `migrate_user` folds it
+into the map with `$bit` and drops the array; it runs lazily when such a
+user is read and for everyone via `manage.py migrate-personalized-progress`.
+
+The dungeon listing is one aggregation on `users`: the user's progress
+plus a `$lookup` of one page of dungeon summaries (no lessons or quizzes),
+keyset-paginated on (generated_at, _id).
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+
+from repository import USER_PERSONALIZED_PROGRESS, projection
+
+PROGRESS_FIELD = "personalized_progress"
+LEGACY_FIELD = "completed_personalized_levels"
+# Masks stay within 31 bits so the frontend can test them with JS bitwise ops
+MAX_LEVELS = 31
+
+def dungeon_key(dungeon: dict) -> str:
+    return str(dungeon["_id"])
+
+def level_bit(level_index: int) -> int:
+    return 1 << level_index
+
+def progress_field(key: str) -> str:
+    return f"{PROGRESS_FIELD}.{key}"
+
+def dungeon_mask(user: Optional[dict], dungeon: dict) -> int:
+    return int(((user or {}).get(PROGRESS_FIELD) or {}).get(dungeon_key(dungeon), 0))
+
+def levels_completed(mask: int, total_levels: int) -> int:
+    return (mask & (level_bit(total_levels) - 1)).bit_count()
+
+def legacy_keys(dungeon: dict, level_index: int) -> List[str]:
+    """Every string the old array may hold for this level."""
+    ids = [dungeon["_id"]] + ([dungeon["id"]] if dungeon.get("id") is not None else [])
+    return [f"{i}_{level_index}" for i in ids]
+
+def award_guard(dungeon: dict, level_index: int) -> dict:
+    """Filter that only matches while the level is not yet completed."""
+    return {
+        progress_field(dungeon_key(dungeon)): {"$not": {"$bitsAllSet": level_bit(level_index)}},
+        # Until the user is migrated the completion may still be in the old array
+        LEGACY_FIELD: {"$nin": legacy_keys(dungeon, level_index)},
+    }
+
+async def _resolve_dungeons(dungeons, refs: Iterable[str]) -> Dict[str, str]:
+    """Old URL ids -> dungeon key. Numeric ids need a lookup; anything else is an ObjectId already."""
+    resolved, numeric = {}, []
+    for ref in refs:
+        if ref.isdigit():
+            numeric.append(int(ref))
+            continue
+        try:
+            resolved[ref] = str(ObjectId(ref))
+        except InvalidId:
+            pass
+    if numeric:
+        async for doc in dungeons.find({"id": {"$in": numeric}}, {"_id": 1, "id": 1}):
+            resolved[str(doc["id"])] = str(doc["_id"])
+    return resolved
+
+async def legacy_masks(dungeons, legacy: Iterable[str]) -> Dict[str, int]:
+    """Bitmasks equivalent to an old completed_personalized_levels array."""
+    levels = []
+    for entry in legacy:
+        ref, _, index = str(entry).rpartition("_")
+        if ref and index.isdigit() and int(index) < MAX_LEVELS:
+            levels.append((ref, int(index)))
+    resolved = await _resolve_dungeons(dungeons, {ref for ref, _ in levels})
+    masks: Dict[str, int] = {}
+    for ref, index in levels:
+        if ref in resolved:
+            key = resolved[ref]
+            masks[key] = masks.get(key, 0) | level_bit(index)
+    return masks
+
+async def migrate_user(db, user: dict) -> dict:
+    """Move `user`'s old array into the progress map; returns the user with the merged map."""
+    legacy = user.get(LEGACY_FIELD)
+    if legacy is None:
+        return user
+    masks = await legacy_masks(db.personalized_dungeons, legacy)
+    # $bit or is idempotent, so racing with a submit or another migration is harmless
+    update = {"$unset": {LEGACY_FIELD: ""}}
+    if masks:
+        update["$bit"] = {progress_field(key): {"or": mask} for key, mask in masks.items()}
+    await db.users.update_one({"id": user["id"]}, update)
+
+    progress = dict(user.get(PROGRESS_FIELD) or {})
+    for key, mask in masks.items():
+        progress[key] = int(progress.get(key, 0)) | mask
+    migrated = {k: v for k, v in user.items() if k != LEGACY_FIELD}
+    migrated[PROGRESS_FIELD] = progress
+    return migrated
+
+# ============== LISTING ==============
+
+LISTING_PAGE_SIZE = 20
+LISTING_MAX_PAGE_SIZE = 100
+
+SUMMARY_PROJECTION = {
+    "_id": 1, "id": 1, "user_id": 1, "title": 1, "description": 1,
+    "difficulty": 1, "generated_at": 1, "status": 1,
+    # Counted server-side so level content never leaves the database
+    "total_levels": {"$size": {"$ifNull": ["$levels", []]}},
+}
+
+def encode_cursor(dungeon: dict) -> str:
+    return f"{dungeon['generated_at']}|{dungeon['_id']}"
+
+def decode_cursor(cursor: str) -> Tuple[str, ObjectId]:
+    """Raises ValueError for anything encode_cursor did not produce."""
+    generated_at, _, dungeon_id = cursor.rpartition("|")
+    if not generated_at:
+        raise ValueError(cursor)
+    try:
+        return generated_at, ObjectId(dungeon_id)
+    except InvalidId:
+        raise ValueError(cursor)
+
+def listing_pipeline(user_id: int, limit: int, cursor: Optional[str] = None) -> list:
+    """
+    One document: the user's progress fields and `dungeons`, the next
+    `limit + 1` summaries (newest first) after `cursor`. The extra one only
+    tells whether there is another page.
+    """
+    match: dict = {"user_id": user_id}
+    if cursor:
+        generated_at, dungeon_id = decode_cursor(cursor)
+        match["$or"] = [
+            {"generated_at": {"$lt": generated_at}},
+            {"generated_at": generated_at, "_id": {"$lt": dungeon_id}},
+        ]
+    return [
+        {"$match": {"id": user_id}},
+        {"$project": projection(USER_PERSONALIZED_PROGRESS)},
+        {"$lookup": {
+            "from": "personalized_dungeons",
+            "pipeline": [
+                {"$match": match},
+                {"$sort": {"generated_at": -1, "_id": -1}},
+                {"$limit": limit + 1},
+                {"$project": SUMMARY_PROJECTION},
+            ],
+            "as": "dungeons",
+        }},
+    ]
+
+async def list_dungeons(db, user_id: int, limit: int, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """A page of dungeon summaries with progress counts, and the cursor of the next page (None on the last)."""
+    docs = await db.users.aggregate(listing_pipeline(user_id, limit, cursor)).to_list(length=1)
+    if not docs:
+        return [], None
+    user = await migrate_user(db, docs[0])
+    dungeons = user.get("dungeons", [])
+    next_cursor = encode_cursor(dungeons[limit - 1]) if len(dungeons) > limit else None
+    dungeons = dungeons[:limit]
+    for dungeon in dungeons:
+        completed = levels_completed(dungeon_mask(user, dungeon), dungeon["total_levels"])
+        dungeon["levels_completed"] = completed
+        dungeon["is_completed"] = completed == dungeon["total_levels"]
+    return dungeons, next_cursor
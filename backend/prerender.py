@@ -0,0 +1,98 @@
+# prerender.py
+"""
+Pre-rendered catalog responses.
+
+Catalog content is the same for every user and only changes with a new
+catalog snapshot, so each catalog response body is encoded and compressed
+(gzip, plus brotli when the `brotli` package is installed) once per
+snapshot, off the event loop. Requests are then answered from memory with a
+strong ETag derived from the body, and a matching If-None-Match gets an
+empty 304.
+"""
+import gzip
+import hashlib
+import os
+from typing import Dict, Hashable, Optional
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+
+from serialization import RawJSONResponse, dumps
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is always available
+    brotli = None
+
+CATALOG_CACHE_MAX_AGE = int(os.getenv("CATALOG_CACHE_MAX_AGE", "0"))
+# Bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 512
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+class RenderedBody:
+    __slots__ = ("tag", "bodies")
+
+    def __init__(self, value):
+        identity = dumps(value)
+        # Content hash: equal across processes and across reloads that don't change it
+        self.tag = hashlib.sha256(identity).hexdigest()[:32]
+        self.bodies: Dict[str, bytes] = {"identity": identity}
+        if len(identity) >= COMPRESS_MIN_BYTES:
+            self.bodies["gzip"] = gzip.compress(identity, GZIP_LEVEL, mtime=0)
+            if brotli is not None:
+                self.bodies["br"] = brotli.compress(identity, quality=BROTLI_QUALITY)
+
+    def etag(self, encoding: str) -> str:
+        # Each encoding is a different byte sequence, so it gets its own strong tag
+        return f'"{self.tag}"' if encoding == "identity" else f'"{self.tag}-{encoding}"'
+
+def render_catalog(snapshot) -> Dict[Hashable, RenderedBody]:
+    """Bodies for every catalog endpoint of `snapshot`, keyed like CatalogSnapshot.responses."""
+    rendered: Dict[Hashable, RenderedBody] = {("dungeons",): RenderedBody(snapshot.dungeons)}
+    for dungeon_id, dungeon in snapshot.dungeon_by_id.items():
+        rendered[("dungeon", dungeon_id)] = RenderedBody(dungeon)
+        levels = [snapshot.level_by_id[l] for l in dungeon.get("levels", []) if l in snapshot.level_by_id]
+        rendered[("dungeon_levels", dungeon_id)] = RenderedBody(levels)
+    for level_id, level in snapshot.level_by_id.items():
+        rendered[("level", level_id)] = RenderedBody(level)
+    for question_id, question in snapshot.question_by_id.items():
+        rendered[("question", question_id)] = RenderedBody(question)
+    return rendered
+
+def _accepted_encodings(accept_encoding: str) -> set:
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        params = params.replace(" ", "")
+        if params in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+def _matches(if_none_match: str, rendered: RenderedBody) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        # Weak comparison (RFC 9110 13.1.2): any encoding of the same content matches
+        if tag.strip('"').split("-", 1)[0] == rendered.tag:
+            return True
+    return False
+
+def respond(rendered: RenderedBody, headers: Headers) -> Response:
+    accepted = _accepted_encodings(headers.get("accept-encoding", ""))
+    encoding = next((e for e in ("br", "gzip") if e in rendered.bodies and e in accepted), "identity")
+    response_headers = {
+        "ETag": rendered.etag(encoding),
+        "Cache-Control": f"public, max-age={CATALOG_CACHE_MAX_AGE}, must-revalidate",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match: Optional[str] = headers.get("if-none-match")
+    if if_none_match and _matches(if_none_match, rendered):
+        return Response(status_code=304, headers=response_headers)
+    if encoding != "identity":
+        response_headers["Content-Encoding"] = encoding
+    return RawJSONResponse(rendered.bodies[encoding], headers=response_headers)
@@ -0,0 +1,103 @@
+# progress.py
+"""
+Atomic XP / progress awards.
+
+Every award (quest, level, personalized level, daily bonus) is one
+`find_one_and_update`: the filter guards against awarding the same thing
+twice, and an update pipeline computes XP, win streak and level-up from the
+values stored at write time. Concurrent submits from the same user therefore
+cannot lose updates, and no read is needed before the write.
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Union
+
+from pymongo import ReturnDocument
+
+# Level N+1 is reached at N * LEVEL_XP_STEP total XP (after the first level-up)
+LEVEL_XP_STEP = 500
+
+def _field(name: str, default: Any) -> dict:
+    return {"$ifNull": [f"${name}", default]}
+
+def streak_stage(today: str, yesterday: str) -> dict:
+    """Consecutive-day streak: unchanged if already active today, +1 after yesterday, else reset to 1."""
+    streak = _field("win_streak", 0)
+    return {"$set": {
+        "win_streak": {"$switch": {
+            "branches": [
+                {"case": {"$eq": ["$last_activity_date", today]}, "then": streak},
+                {"case": {"$eq": ["$last_activity_date", yesterday]}, "then": {"$add": [streak, 1]}},
+            ],
+            "default": 1,
+        }},
+        "last_activity_date": today,
+    }}
+
+def level_up_stage() -> dict:
+    """
+    Closed form of the level-up loop
+        while xp >= xp_to_next: level += 1; xp_to_next = level * 500
+    evaluated against the freshly updated xp.
+    """
+    xp = _field("xp", 0)
+    level = _field("level", 1)
+    xp_to_next = _field("xp_to_next", 100)
+    levelled = {"$gte": [xp, xp_to_next]}
+    new_level = {"$toInt": {"$max": [
+        {"$add": [level, 1]},
+        {"$add": [{"$floor": {"$divide": [xp, LEVEL_XP_STEP]}}, 1]},
+    ]}}
+    return {"$set": {
+        "level": {"$cond": [levelled, new_level, level]},
+        "xp_to_next": {"$cond": [levelled, {"$multiply": [new_level, LEVEL_XP_STEP]}, xp_to_next]},
+    }}
+
+async def award_progress(
+    users,
+    user_id: int,
+    xp: Union[int, dict],
+    guard: Optional[dict] = None,
+    inc: Optional[Dict[str, int]] = None,
+    append: Optional[Dict[str, Any]] = None,
+    union: Optional[Dict[str, List[Any]]] = None,
+    bits: Optional[Dict[str, int]] = None,
+    set_fields: Optional[Dict[str, Any]] = None,
+    touch_streak: bool = True,
+) -> Optional[dict]:
+    """
+    Apply one award to a user in a single atomic write.
+
+    xp         -- XP to add; an int or an aggregation expression (evaluated
+                  after the streak update, so it may reference "$win_streak")
+    guard      -- extra filter conditions; the award is skipped if they fail
+    inc        -- counters to increment
+    append     -- array field -> value to append (pair with a guard on the same value)
+    union      -- array field -> values to merge as a set
+    bits       -- int field -> bit to set (pair with a guard that the bit is clear)
+    set_fields -- literal values to set
+    Returns the updated user document, or None if the user does not exist or
+    the guard did not match.
+    """
+    stages = []
+    if touch_streak:
+        now = datetime.utcnow().date()
+        stages.append(streak_stage(now.isoformat(), (now - timedelta(days=1)).isoformat()))
+
+    updates = {"xp": {"$add": [_field("xp", 0), xp]}}
+    for name, amount in (inc or {}).items():
+        updates[name] = {"$add": [_field(name, 0), amount]}
+    for name, value in (append or {}).items():
+        updates[name] = {"$concatArrays": [_field(name, []), [{"$literal": value}]]}
+    for name, values in (union or {}).items():
+        updates[name] = {"$setUnion": [_field(name, []), {"$literal": list(values)}]}
+    for name, bit in (bits or {}).items():
+        # Update pipelines have no $bit; with the bit guarded clear, adding it is the same as or-ing it in
+        updates[name] = {"$add": [_field(name, 0), bit]}
+    for name, value in (set_fields or {}).items():
+        updates[name] = {"$literal": value}
+    stages.append({"$set": updates})
+    stages.append(level_up_stage())
+
+    query = {"id": user_id}
+    query.update(guard or {})
+    return await users.find_one_and_update(query, stages, return_document=ReturnDocument.AFTER)
@@ -0,0 +1,102 @@
+# repository.py
+"""
+Field sets ("views") for every read the API makes.
+
+Each endpoint names the view it needs and the query asks Mongo for exactly
+those fields, so password hashes, the growing `completed_*` arrays, lesson
+bodies and hidden test cases are only transferred (and encoded) where
+they are actually used. Catalog documents are already
+in memory; `project` trims them the same way.
+
+`benchmark` compares full documents against each view on the configured
+database (see `manage.py benchmark-projections`).
+"""
+import time
+from typing import Callable, Iterable, Optional, Tuple
+
+import bson
+
+from leaderboard import LEADERBOARD_PROJECTION
+from serialization import dumps
+
+View = Tuple[str, ...]
+
+# Profile responses (_user_public) and the completed-dungeon fallback
+USER_PUBLIC: View = (
+    "id", "username", "email", "level", "xp", "xp_to_next", "rank", "win_streak",
+    "last_activity_date", "created_at", "avatar", "total_quests",
+    "completed_questions", "completed_levels", "completed_dungeons",
+    "personalized_progress", "completed_personalized_levels",
+)
+USER_AUTH: View = ("id", "username", "password_hash")
+USER_EXISTS: View = ("id",)
+USER_DAILY: View = ("id", "win_streak", "last_activity_date", "last_login_bonus_date")
+# Per-user question status (/api/questions?user_id=)
+USER_QUESTION_PROGRESS: View = ("id", "completed_questions", "completed_levels", "completed_dungeons")
+USER_SUBMIT: View = ("id", "completed_questions")
+USER_LEVEL_PROGRESS: View = ("id", "completed_levels", "completed_dungeons")
+# The old array is only present on users not yet migrated (see personalized.py)
+USER_PERSONALIZED_PROGRESS: View = ("id", "personalized_progress", "completed_personalized_levels")
+USER_STATS: View = ("id", "xp", "level", "rank", "quests_completed", "win_streak")
+
+# Question list cards; tests, examples and function_name only on the detail page
+QUESTION_LIST: View = ("id", "title", "description", "difficulty", "xp", "category", "required_dungeon", "status")
+
+def projection(view: Optional[View], with_id: bool = False) -> Optional[dict]:
+    """Mongo projection for `view`; None (whole document) if no view is given."""
+    if view is None:
+        return None
+    fields = {field: 1 for field in view}
+    if not with_id:
+        fields["_id"] = 0
+    return fields
+
+def project(doc: dict, view: View) -> dict:
+    """In-memory equivalent of `projection` for already loaded documents."""
+    return {field: doc[field] for field in view if field in doc}
+
+# ============== BENCHMARK ==============
+
+def _benchmark_cases(db, user: dict):
+    """(endpoint, full query factory, projected query factory) per view."""
+    user_id = user["id"]
+    username_lower = user.get("username_lower")
+    one = lambda col, query, proj: (lambda: col.find(query, proj).limit(1))
+    return [
+        ("GET /api/profile/{id}", one(db.users, {"id": user_id}, None), one(db.users, {"id": user_id}, projection(USER_PUBLIC))),
+        ("POST /api/auth/login", one(db.users, {"username_lower": username_lower}, None), one(db.users, {"username_lower": username_lower}, projection(USER_AUTH))),
+        ("GET /api/questions?user_id", one(db.users, {"id": user_id}, None), one(db.users, {"id": user_id}, projection(USER_QUESTION_PROGRESS))),
+        ("POST /api/questions/{id}/submit", one(db.users, {"id": user_id}, None), one(db.users, {"id": user_id}, projection(USER_SUBMIT))),
+        ("POST /api/daily-login/{id}", one(db.users, {"id": user_id}, None), one(db.users, {"id": user_id}, projection(USER_DAILY))),
+        ("GET /api/questions (list body)", lambda: db.questions.find({}), lambda: db.questions.find({}, projection(QUESTION_LIST))),
+        ("GET /api/leaderboard (index load)", lambda: db.users.find({}), lambda: db.users.find({}, LEADERBOARD_PROJECTION)),
+    ]
+
+async def _measure(query: Callable, iterations: int) -> Tuple[int, float]:
+    """BSON bytes returned by the query and mean ms to encode them as a JSON body."""
+    docs = [doc async for doc in query()]
+    size = sum(len(bson.encode(doc)) for doc in docs)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        dumps(docs)
+    return size, 1000 * (time.perf_counter() - started) / iterations
+
+def _format_rows(rows: Iterable[tuple]) -> str:
+    lines = [f"{'endpoint':<36} {'bytes before':>12} {'after':>10} {'ser ms before':>14} {'after':>8}"]
+    for label, bytes_before, bytes_after, ms_before, ms_after in rows:
+        lines.append(f"{label:<36} {bytes_before:>12} {bytes_after:>10} {ms_before:>14.3f} {ms_after:>8.3f}")
+    return "\n".join(lines)
+
+async def benchmark(db, iterations: int = 200):
+    """Print bytes transferred and serialization time per endpoint, full documents vs views."""
+    # The most active user has the longest completed_* arrays
+    user = await db.users.find_one({"id": {"$exists": True}}, sort=[("xp", -1)])
+    if user is None:
+        print("No users to benchmark against")
+        return False
+    rows = []
+    for label, full, projected in _benchmark_cases(db, user):
+        bytes_before, ms_before = await _measure(full, iterations)
+        bytes_after, ms_after = await _measure(projected, iterations)
+        rows.append((label, bytes_before, bytes_after, ms_before, ms_after))
+    print(_format_rows(rows))
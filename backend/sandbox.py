@@ -0,0 +1,383 @@
+# sandbox.py
+"""
+Out-of-process execution pool for user submitted code.
+
+Submissions are graded by a fixed set of pre-started worker processes so a
+runaway solution (infinite loop, deep recursion, huge allocation) can never
+block the API event loop. Each worker enforces per-test CPU and wall-clock
+limits itself; the parent additionally watches every job and kills/replaces a
+worker that stops responding, without touching jobs running on other workers.
+Workers drop the server's environment (API keys, database URI) before they
+accept a job, and what a test sends back is capped at
+SANDBOX_MAX_OUTPUT_CHARS so the parent never unpickles a huge result.
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, List, Optional
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+SANDBOX_POOL_SIZE = int(os.getenv("SANDBOX_POOL_SIZE", "2"))
+SANDBOX_QUEUE_DEPTH = int(os.getenv("SANDBOX_QUEUE_DEPTH", "64"))
+SANDBOX_TEST_CPU_SECONDS = float(os.getenv("SANDBOX_TEST_CPU_SECONDS", "2"))
+SANDBOX_TEST_WALL_SECONDS = float(os.getenv("SANDBOX_TEST_WALL_SECONDS", "5"))
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "256"))
+# Extra slack the parent allows on top of the per-test budget before it
+# declares a worker hung (covers process scheduling and result transfer).
+SANDBOX_GRACE_SECONDS = float(os.getenv("SANDBOX_GRACE_SECONDS", "2"))
+# Compiled submissions kept per worker, keyed by source digest.
+SANDBOX_COMPILE_CACHE_SIZE = int(os.getenv("SANDBOX_COMPILE_CACHE_SIZE", "256"))
+# Longest rendering of a test's output (or input/expected/error) sent back.
+SANDBOX_MAX_OUTPUT_CHARS = int(os.getenv("SANDBOX_MAX_OUTPUT_CHARS", "10000"))
+
+SAFE_BUILTINS = {
+    "range": range,
+    "len": len,
+    "print": print,
+    "abs": abs,
+    "min": min,
+    "max": max,
+    "enumerate": enumerate,
+    "list": list,
+    "dict": dict,
+    "set": set,
+    "tuple": tuple,
+}
+
+class SandboxBusy(Exception):
+    """Raised when the job queue is full."""
+
+# ============== WORKER SIDE ==============
+
+class _TimeLimitExceeded(BaseException):
+    # BaseException so `except Exception` in user code cannot swallow it
+    pass
+
+def _on_timer(signum, frame):
+    raise _TimeLimitExceeded()
+
+@contextmanager
+def _time_limit(cpu_seconds: float, wall_seconds: float):
+    signal.setitimer(signal.ITIMER_PROF, cpu_seconds)
+    signal.setitimer(signal.ITIMER_REAL, wall_seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+def _rendered_size(value: Any, limit: int) -> int:
+    """
+    Approximate length of repr(value), or -1 as soon as it exceeds `limit`.
+    Counts without building the string, so huge or self-referencing
+    containers are rejected cheaply.
+    """
+    size = 0
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        if v is None or isinstance(v, (bool, float)):
+            size += 5
+        elif isinstance(v, int):
+            # str() of huge ints is slow (and capped by the interpreter)
+            size += v.bit_length() * 3 // 10 + 2
+        elif isinstance(v, str):
+            size += len(v) + 2
+        elif isinstance(v, (list, tuple, set, frozenset)):
+            size += 2 + 2 * len(v)
+            if size <= limit:
+                stack.extend(v)
+        elif isinstance(v, dict):
+            size += 2 + 4 * len(v)
+            if size <= limit:
+                stack.extend(v.keys())
+                stack.extend(v.values())
+        else:
+            size += len(repr(v))
+        if size > limit:
+            return -1
+    return size
+
+def _shown(value: Any) -> Any:
+    """`value` if it renders within the output cap, else a truncated repr."""
+    if _rendered_size(value, SANDBOX_MAX_OUTPUT_CHARS) >= 0:
+        return value
+    return repr(value)[:SANDBOX_MAX_OUTPUT_CHARS] + "..."
+
+def _message(e: BaseException) -> str:
+    return str(e)[:SANDBOX_MAX_OUTPUT_CHARS]
+
+def _portable(value: Any) -> Any:
+    """Make a test output safe to send back to the parent and encode as JSON."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_portable(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _portable(v) for k, v in value.items()}
+    return repr(value)[:SANDBOX_MAX_OUTPUT_CHARS]
+
+_compiled = OrderedDict()
+
+def _compile(code: str, digest: str):
+    """Compile a submission, reusing the code object for repeated sources."""
+    if digest and digest in _compiled:
+        _compiled.move_to_end(digest)
+        return _compiled[digest], True
+    code_obj = compile(code, "<string>", "exec")
+    if digest:
+        _compiled[digest] = code_obj
+        if len(_compiled) > SANDBOX_COMPILE_CACHE_SIZE:
+            _compiled.popitem(last=False)
+    return code_obj, False
+
+def _run_job(code: str, digest: str, function_name: str, tests: List[dict], cpu_seconds: float, wall_seconds: float) -> dict:
+    # A fresh builtins copy per job: submissions can reach and mutate
+    # __builtins__, and workers are reused across players.
+    restricted_globals = {"__builtins__": dict(SAFE_BUILTINS)}
+    restricted_locals = {}
+    compile_hit = False
+
+    try:
+        with _time_limit(cpu_seconds, wall_seconds):
+            code_obj, compile_hit = _compile(code, digest)
+            exec(code_obj, restricted_globals, restricted_locals)
+    except _TimeLimitExceeded:
+        return {"error": "Code error: time limit exceeded", "passed": 0, "results": [], "cacheable": False}
+    except MemoryError:
+        return {"error": "Code error: memory limit exceeded", "passed": 0, "results": [], "cacheable": False}
+    except Exception as e:
+        return {"error": f"Code error: {_message(e)}", "passed": 0, "results": [], "compile_cache_hit": compile_hit}
+
+    if function_name not in restricted_locals:
+        return {"error": f"Function '{function_name}' not found in submitted code.", "passed": 0, "results": [], "compile_cache_hit": compile_hit}
+
+    user_function = restricted_locals[function_name]
+    passed = 0
+    results = []
+    cacheable = True
+
+    for test in tests:
+        test_input = test.get("input")
+        expected = test.get("output")
+        try:
+            with _time_limit(cpu_seconds, wall_seconds):
+                if isinstance(test_input, list):
+                    output = user_function(*test_input)
+                else:
+                    output = user_function(test_input)
+                ok = output == expected
+                size = _rendered_size(output, SANDBOX_MAX_OUTPUT_CHARS)
+        except _TimeLimitExceeded:
+            results.append({"input": test_input, "expected": expected, "output": "Time limit exceeded", "passed": False})
+            cacheable = False
+            continue
+        except MemoryError:
+            results.append({"input": test_input, "expected": expected, "output": "Memory limit exceeded", "passed": False})
+            cacheable = False
+            continue
+        except Exception as e:
+            results.append({"input": test_input, "expected": expected, "output": _message(e), "passed": False})
+            continue
+
+        if size < 0:
+            results.append({"input": test_input, "expected": expected, "output": "Output too large", "passed": False})
+            continue
+        if ok:
+            passed += 1
+        results.append({"input": test_input, "expected": expected, "output": _portable(output), "passed": ok})
+
+    output_chars = 0
+    for result in results:
+        result["input"] = _shown(result["input"])
+        result["expected"] = _shown(result["expected"])
+        output_chars += max(0, _rendered_size(result["output"], SANDBOX_MAX_OUTPUT_CHARS))
+
+    return {
+        "error": None, "passed": passed, "results": results, "cacheable": cacheable,
+        "compile_cache_hit": compile_hit, "output_chars": output_chars,
+    }
+
+def _worker_main(conn, memory_mb: int):
+    # Submissions can reach os.environ through object introspection; keep
+    # nothing of the server's environment (API keys, MONGO_URI) around.
+    os.environ.clear()
+    # The server handles Ctrl+C; workers are torn down by the parent.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGALRM, _on_timer)
+    signal.signal(signal.SIGPROF, _on_timer)
+    if resource is not None and memory_mb > 0:
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        try:
+            result = _run_job(*job)
+        except MemoryError:
+            result = {"error": "Code error: memory limit exceeded", "passed": 0, "results": [], "cacheable": False}
+        conn.send(result)
+
+# ============== PARENT SIDE ==============
+
+class _Worker:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+
+class SandboxPool:
+    """
+    Fixed-size pool of grading processes fed from a bounded queue.
+    Use `await pool.run(code, function_name, tests)` from request handlers.
+    """
+
+    def __init__(
+        self,
+        size: int = SANDBOX_POOL_SIZE,
+        queue_depth: int = SANDBOX_QUEUE_DEPTH,
+        cpu_seconds: float = SANDBOX_TEST_CPU_SECONDS,
+        wall_seconds: float = SANDBOX_TEST_WALL_SECONDS,
+        memory_mb: int = SANDBOX_MEMORY_MB,
+    ):
+        self.size = max(1, size)
+        self.queue_depth = max(1, queue_depth)
+        self.cpu_seconds = cpu_seconds
+        self.wall_seconds = wall_seconds
+        self.memory_mb = memory_mb
+        self._ctx = multiprocessing.get_context("spawn")
+        self._workers: List[Optional[_Worker]] = []
+        self._dispatchers: List[asyncio.Task] = []
+        self._queue: Optional[asyncio.Queue] = None
+        self.busy = 0
+        self.restarts = 0
+
+    def _spawn(self) -> _Worker:
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(target=_worker_main, args=(child_conn, self.memory_mb), daemon=True)
+        process.start()
+        child_conn.close()
+        return _Worker(process, parent_conn)
+
+    @staticmethod
+    def _kill(worker: _Worker):
+        worker.conn.close()
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join(timeout=5)
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_depth)
+        self._workers = [self._spawn() for _ in range(self.size)]
+        self._dispatchers = [asyncio.create_task(self._dispatch(i)) for i in range(self.size)]
+
+    async def close(self):
+        for task in self._dispatchers:
+            task.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        for worker in self._workers:
+            if worker is None:
+                continue
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            self._kill(worker)
+        self._workers = []
+        self._dispatchers = []
+
+    async def run(
+        self,
+        code: str,
+        function_name: str,
+        tests: List[dict],
+        cpu_seconds: Optional[float] = None,
+        wall_seconds: Optional[float] = None,
+        digest: str = "",
+    ) -> dict:
+        """
+        Grade `code` against `tests` in a worker process.
+        Returns {"error": str|None, "passed": int, "results": [...]}; results
+        that hit a resource limit carry "cacheable": False.
+        `digest` (hash of `code`) lets workers reuse compiled code objects.
+        Raises SandboxBusy if the queue is full.
+        """
+        job = (
+            code,
+            digest,
+            function_name,
+            list(tests),
+            cpu_seconds or self.cpu_seconds,
+            wall_seconds or self.wall_seconds,
+        )
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((job, future))
+        except asyncio.QueueFull:
+            raise SandboxBusy()
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "busy": self.busy,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "queue_depth": self.queue_depth,
+            "restarts": self.restarts,
+        }
+
+    async def _recv(self, conn):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = conn.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_reader(fd)
+        return conn.recv()
+
+    async def _replace(self, slot: int):
+        loop = asyncio.get_running_loop()
+        worker = self._workers[slot]
+        self._workers[slot] = None
+        await loop.run_in_executor(None, self._kill, worker)
+        self._workers[slot] = await loop.run_in_executor(None, self._spawn)
+        self.restarts += 1
+
+    async def _dispatch(self, slot: int):
+        while True:
+            job, future = await self._queue.get()
+            if future.done():
+                # caller went away while queued
+                continue
+
+            tests, wall_seconds = job[3], job[5]
+            deadline = wall_seconds * (len(tests) + 1) + SANDBOX_GRACE_SECONDS
+            worker = self._workers[slot]
+            self.busy += 1
+            try:
+                worker.conn.send(job)
+                result = await asyncio.wait_for(self._recv(worker.conn), deadline)
+            except asyncio.TimeoutError:
+                await self._replace(slot)
+                result = {"error": "Execution timed out", "passed": 0, "results": [], "cacheable": False}
+            except (EOFError, OSError):
+                await self._replace(slot)
+                result = {"error": "Execution failed: worker crashed", "passed": 0, "results": [], "cacheable": False}
+            finally:
+                self.busy -= 1
+
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,40 @@
+# serialization.py
+"""
+Single-pass JSON encoding with orjson.
+
+Mongo documents are encoded as they come out of the driver (or the catalog
+snapshot): orjson walks them once in C and the `default` hook only sees
+the few BSON types it does not know, so there is no recursive copy in
+Python first. Endpoints returning large documents return a
+FastJSONResponse directly, which also skips FastAPI's jsonable_encoder
+pass; everything else gets it as the app's default response class.
+"""
+from typing import Any
+
+import orjson
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from starlette.responses import JSONResponse, Response
+
+# Int keys appear in some stats payloads
+DUMPS_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+def _default(value: Any):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def dumps(value: Any) -> bytes:
+    return orjson.dumps(value, default=_default, option=DUMPS_OPTIONS)
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+class RawJSONResponse(Response):
+    """Body that is already encoded JSON bytes."""
+    media_type = "application/json"
@@ -0,0 +1,224 @@
+# stats.py
+"""
+Per-user statistics maintained incrementally.
+
+Every graded submit produces a submission event (`submission_event`). The
+submission writer (see submissions.py) stores the events in `submissions`
+and, off the request path, folds each batch into the users' `user_stats`
+documents with one pipeline update per event in a single bulk write, so
+reading stats is a single document fetch and no history is aggregated per
+request.
+`rebuild` recomputes every stats document from them with an aggregation
+pipeline, for backfills and for repairing drift.
+
+Time is estimated from activity: the gap between consecutive events counts
+as time spent when it is at most STATS_IDLE_SECONDS. A quest's completion
+time runs from its first attempt to the submit that completes it.
+"""
+import logging
+import os
+from datetime import datetime
+from typing import List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+STATS_IDLE_SECONDS = int(os.getenv("STATS_IDLE_SECONDS", "1800"))
+
+def submission_event(
+    user_id: int,
+    kind: str,
+    item_id,
+    success: bool,
+    completed: bool,
+    category: Optional[str] = None,
+    win_streak: Optional[int] = None,
+    action: str = "submit",
+    **fields,
+) -> dict:
+    """
+    One graded submit (or, with action="run", a test run that awards
+    nothing). `kind` is "question", "level" or "personalized"; `completed`
+    is True only for the submit that first completes the item.
+    """
+    return {
+        "user_id": user_id,
+        "action": action,
+        "kind": kind,
+        "item_id": item_id,
+        "success": success,
+        "completed": completed,
+        "category": category,
+        "win_streak": win_streak,
+        "timestamp": datetime.utcnow(),
+        **fields,
+    }
+
+def _field_key(value) -> str:
+    # Stats map keys must not contain "." or "$"
+    return str(value).replace(".", "_").replace("$", "_")
+
+def _item_key(event: dict) -> str:
+    return f"{event['kind'][0]}{_field_key(event['item_id'])}"
+
+def _count(field: str, by: int = 1) -> dict:
+    return {"$add": [{"$ifNull": [f"${field}", 0]}, by]}
+
+def update_pipeline(event: dict) -> list:
+    """Pipeline update folding `event` into a stats document."""
+    now = event["timestamp"]
+    first_attempt = f"first_attempt.{_item_key(event)}"
+    gap = {"$divide": [{"$subtract": [now, "$last_event_at"]}, 1000]}
+    stages = [{"$set": {
+        "attempts": _count("attempts"),
+        "successes": _count("successes", 1 if event["success"] else 0),
+        "quests_failed": _count("quests_failed", 1 if event["kind"] == "question" and not event["success"] else 0),
+        "best_streak": {"$max": [{"$ifNull": ["$best_streak", 0]}, event.get("win_streak") or 0]},
+        "time_spent_seconds": {"$add": [
+            {"$ifNull": ["$time_spent_seconds", 0]},
+            {"$cond": [{"$and": [{"$gt": ["$last_event_at", None]}, {"$lte": [gap, STATS_IDLE_SECONDS]}]}, gap, 0]},
+        ]},
+        "last_event_at": now,
+        first_attempt: {"$ifNull": [f"${first_attempt}", now]},
+    }}]
+    if event["completed"]:
+        completion = {
+            "completions": _count("completions"),
+            "completion_seconds": {"$add": [
+                {"$ifNull": ["$completion_seconds", 0]},
+                {"$divide": [{"$subtract": [now, f"${first_attempt}"]}, 1000]},
+            ]},
+        }
+        if event.get("category"):
+            category = f"category_counts.{_field_key(event['category'])}"
+            completion[category] = _count(category)
+        stages += [{"$set": completion}, {"$unset": first_attempt}]
+    return stages
+
+class UserStats:
+    def __init__(self, db):
+        self.stats = db.user_stats
+
+    async def record_many(self, events: List[dict]):
+        """Apply the submits among `events`, in order; best effort, failures are only logged."""
+        ops = [
+            UpdateOne({"_id": event["user_id"]}, update_pipeline(event), upsert=True)
+            for event in events if event["action"] == "submit"
+        ]
+        if not ops:
+            return
+        try:
+            await self.stats.bulk_write(ops, ordered=True)
+        except PyMongoError as e:
+            logger.warning("Could not update stats for %d submissions: %s", len(ops), e)
+
+    async def get(self, user_id: int) -> dict:
+        return await self.stats.find_one({"_id": user_id}, {"first_attempt": 0}) or {}
+
+def stats_view(stats: dict, user: dict) -> dict:
+    """API shape of /api/profile/{user_id}/stats."""
+    attempts = stats.get("attempts", 0)
+    completions = stats.get("completions", 0)
+    categories = stats.get("category_counts") or {}
+    win_streak = int(user.get("win_streak", 0))
+    return {
+        "total_xp": int(user.get("xp", 0)),
+        "level": int(user.get("level", 1)),
+        "rank": user.get("rank", "Novice"),
+        "quests_completed": int(user.get("quests_completed", 0)),
+        "quests_failed": stats.get("quests_failed", 0),
+        "win_streak": win_streak,
+        "best_streak": max(int(stats.get("best_streak", 0)), win_streak),
+        "total_time_spent": int(stats.get("time_spent_seconds", 0)),
+        "avg_completion_time": int(stats.get("completion_seconds", 0) / completions) if completions else 0,
+        "favorite_category": max(categories, key=categories.get) if categories else None,
+        "accuracy": round(100 * stats.get("successes", 0) / attempts, 1) if attempts else 0.0,
+    }
+
+# ============== REBUILD ==============
+
+def _sanitized(expression) -> dict:
+    dots = {"$replaceAll": {"input": expression, "find": ".", "replacement": "_"}}
+    return {"$replaceAll": {"input": dots, "find": {"$literal": "$"}, "replacement": "_"}}
+
+def rebuild_pipeline() -> list:
+    """
+    Aggregation over `submissions` producing one stats document per user,
+    merged into `user_stats` (needs MongoDB 5.0+ for $setWindowFields).
+    """
+    completed = {"$ne": ["$completed_at", None]}
+    return [
+        {"$match": {"action": "submit"}},
+        # Gap to the user's previous event, for time spent
+        {"$setWindowFields": {
+            "partitionBy": "$user_id",
+            "sortBy": {"timestamp": 1},
+            "output": {"previous_at": {"$shift": {"output": "$timestamp", "by": -1}}},
+        }},
+        {"$set": {"gap": {"$divide": [{"$subtract": ["$timestamp", "$previous_at"]}, 1000]}}},
+        # Per user and item: attempts and first attempt -> completion
+        {"$group": {
+            "_id": {"user_id": "$user_id", "kind": "$kind", "item_id": "$item_id"},
+            "attempts": {"$sum": 1},
+            "successes": {"$sum": {"$cond": ["$success", 1, 0]}},
+            "quests_failed": {"$sum": {"$cond": [{"$and": [{"$eq": ["$kind", "question"]}, {"$not": ["$success"]}]}, 1, 0]}},
+            "first_at": {"$min": "$timestamp"},
+            "completed_at": {"$min": {"$cond": ["$completed", "$timestamp", None]}},
+            "category": {"$max": "$category"},
+            "best_streak": {"$max": "$win_streak"},
+            "time_spent": {"$sum": {"$cond": [
+                {"$and": [{"$gt": ["$previous_at", None]}, {"$lte": ["$gap", STATS_IDLE_SECONDS]}]}, "$gap", 0,
+            ]}},
+            "last_at": {"$max": "$timestamp"},
+        }},
+        {"$group": {
+            "_id": "$_id.user_id",
+            "attempts": {"$sum": "$attempts"},
+            "successes": {"$sum": "$successes"},
+            "quests_failed": {"$sum": "$quests_failed"},
+            "best_streak": {"$max": {"$ifNull": ["$best_streak", 0]}},
+            "time_spent_seconds": {"$sum": "$time_spent"},
+            "last_event_at": {"$max": "$last_at"},
+            "completions": {"$sum": {"$cond": [completed, 1, 0]}},
+            "completion_seconds": {"$sum": {"$cond": [
+                completed, {"$divide": [{"$subtract": ["$completed_at", "$first_at"]}, 1000]}, 0,
+            ]}},
+            "categories": {"$push": {"$cond": [
+                {"$and": [completed, {"$gt": ["$category", None]}]}, _sanitized("$category"), None,
+            ]}},
+            "pending": {"$push": {"$cond": [completed, None, {
+                "k": {"$concat": [{"$substrCP": ["$_id.kind", 0, 1]}, _sanitized({"$toString": "$_id.item_id"})]},
+                "v": "$first_at",
+            }]}},
+        }},
+        {"$set": {
+            "categories": {"$filter": {"input": "$categories", "cond": {"$ne": ["$$this", None]}}},
+            "pending": {"$filter": {"input": "$pending", "cond": {"$ne": ["$$this", None]}}},
+        }},
+        {"$set": {
+            "category_counts": {"$arrayToObject": {"$map": {
+                "input": {"$setUnion": ["$categories"]},
+                "as": "category",
+                "in": {"k": "$$category", "v": {"$size": {"$filter": {
+                    "input": "$categories", "cond": {"$eq": ["$$this", "$$category"]},
+                }}}},
+            }}},
+            "first_attempt": {"$arrayToObject": "$pending"},
+        }},
+        {"$unset": ["categories", "pending"]},
+        {"$merge": {
+            "into": "user_stats",
+            "on": "_id",
+            # Streaks from before events were recorded are kept
+            "whenMatched": [{"$replaceWith": {"$mergeObjects": [
+                "$$new", {"best_streak": {"$max": [{"$ifNull": ["$best_streak", 0]}, "$$new.best_streak"]}},
+            ]}}],
+            "whenNotMatched": "insert",
+        }},
+    ]
+
+async def rebuild(db):
+    """Recompute every user's stats document from the stored submission events."""
+    await db.submissions.aggregate(rebuild_pipeline()).to_list(length=None)
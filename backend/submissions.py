@@ -0,0 +1,148 @@
+# submissions.py
+"""
+Buffered persistence of submission events.
+
+Every code run and graded submit is recorded in the `submissions`
+collection for analytics, replays and stats rebuilds (see stats.py), but
+never on the grading path: `record` only puts the event on a bounded
+in-process queue. A background task writes the queue out with `insert_many`
+whenever SUBMISSION_BATCH_SIZE events are waiting or SUBMISSION_FLUSH_SECONDS
+have passed since the oldest one. If the queue is full, the producer waits
+at most SUBMISSION_ENQUEUE_TIMEOUT_SECONDS for room and then drops the
+event. Drops and failed writes are counted, not raised. When given a
+UserStats, the writer also folds each written batch into the users' stats,
+so no stats update runs on the request path.
+"""
+import asyncio
+import logging
+import os
+from typing import List, Optional
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+SUBMISSION_QUEUE_SIZE = int(os.getenv("SUBMISSION_QUEUE_SIZE", "10000"))
+SUBMISSION_BATCH_SIZE = int(os.getenv("SUBMISSION_BATCH_SIZE", "200"))
+SUBMISSION_FLUSH_SECONDS = float(os.getenv("SUBMISSION_FLUSH_SECONDS", "2"))
+SUBMISSION_ENQUEUE_TIMEOUT_SECONDS = float(os.getenv("SUBMISSION_ENQUEUE_TIMEOUT_SECONDS", "0.05"))
+
+_STOP = object()
+
+class SubmissionWriter:
+    def __init__(
+        self,
+        collection,
+        queue_size: int = SUBMISSION_QUEUE_SIZE,
+        batch_size: int = SUBMISSION_BATCH_SIZE,
+        flush_seconds: float = SUBMISSION_FLUSH_SECONDS,
+        enqueue_timeout: float = SUBMISSION_ENQUEUE_TIMEOUT_SECONDS,
+        user_stats=None,
+    ):
+        self.collection = collection
+        self.user_stats = user_stats
+        self.queue_size = max(1, queue_size)
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+        self.enqueue_timeout = enqueue_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.waited = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._task = asyncio.create_task(self._drain())
+
+    async def close(self):
+        """Write out everything queued so far, then stop the writer."""
+        if self._task:
+            # The sentinel queues behind pending events, so they are all written first
+            await self._queue.put(_STOP)
+            await self._task
+            self._task = None
+
+    async def record(self, event: dict) -> bool:
+        """Queue `event` for writing. Returns False if it was dropped because the queue stayed full."""
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Backpressure: give the writer a moment to make room, then shed
+            self.waited += 1
+            try:
+                await asyncio.wait_for(self._queue.put(event), self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                return False
+        self.enqueued += 1
+        return True
+
+    def _take(self, batch: List[dict]) -> bool:
+        """Move queued events into `batch` up to batch_size; True if the stop sentinel was reached."""
+        while len(batch) < self.batch_size and not self._queue.empty():
+            event = self._queue.get_nowait()
+            if event is _STOP:
+                return True
+            batch.append(event)
+        return False
+
+    async def _write(self, batch: List[dict]):
+        if not batch:
+            return
+        self.batches += 1
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+            self.written += len(batch)
+        except BulkWriteError as e:
+            inserted = e.details.get("nInserted", 0)
+            self.written += inserted
+            self.failed += len(batch) - inserted
+            logger.warning("Could not write %d of %d submissions: %s", len(batch) - inserted, len(batch), e)
+        except PyMongoError as e:
+            self.failed += len(batch)
+            logger.warning("Could not write %d submissions: %s", len(batch), e)
+        if self.user_stats is not None:
+            await self.user_stats.record_many(batch)
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            event = await self._queue.get()
+            if event is _STOP:
+                return
+            batch = [event]
+            # Hold the batch open until it is full or the oldest event is flush_seconds old
+            deadline = loop.time() + self.flush_seconds
+            while not stop and len(batch) < self.batch_size:
+                stop = self._take(batch)
+                remaining = deadline - loop.time()
+                if stop or len(batch) >= self.batch_size or remaining <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if event is _STOP:
+                    stop = True
+                else:
+                    batch.append(event)
+            await self._write(batch)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "queue_size": self.queue_size,
+            "batch_size": self.batch_size,
+            "flush_seconds": self.flush_seconds,
+            "enqueued": self.enqueued,
+            "waited": self.waited,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches,
+        }
@@ -0,0 +1,119 @@
+"""
+Minimal evaluator for the aggregation operators the backend's update
+pipelines use, so their arithmetic can be tested without a server.
+"""
+import copy
+from datetime import datetime
+
+def _get(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+def _set(doc, path, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+def _unset(doc, path):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.get(part, {})
+    doc.pop(last, None)
+
+def _order(value):
+    # BSON comparison order for the types used here
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, datetime):
+        return (3, value)
+    raise TypeError(value)
+
+def _subtract(a, b):
+    if a is None or b is None:
+        return None
+    if isinstance(a, datetime):
+        return (a - b).total_seconds() * 1000
+    return a - b
+
+def _divide(a, b):
+    return None if a is None or b is None else a / b
+
+def _switch(args, doc):
+    for branch in args["branches"]:
+        if evaluate(branch["case"], doc):
+            return evaluate(branch["then"], doc)
+    return evaluate(args["default"], doc)
+
+def _cond(args, doc):
+    condition, then, otherwise = args
+    return evaluate(then if evaluate(condition, doc) else otherwise, doc)
+
+def _if_null(args, doc):
+    for arg in args:
+        value = evaluate(arg, doc)
+        if value is not None:
+            return value
+    return None
+
+OPERATORS = {
+    "$literal": lambda args, doc: copy.deepcopy(args),
+    "$ifNull": _if_null,
+    "$switch": _switch,
+    "$cond": _cond,
+}
+
+VALUE_OPERATORS = {
+    "$add": lambda *v: sum(v),
+    "$multiply": lambda a, b: a * b,
+    "$subtract": _subtract,
+    "$divide": _divide,
+    "$floor": lambda v: int(v // 1),
+    "$toInt": lambda v: int(v),
+    "$max": lambda *v: max(v, key=_order),
+    "$eq": lambda a, b: a == b,
+    "$gt": lambda a, b: _order(a) > _order(b),
+    "$gte": lambda a, b: _order(a) >= _order(b),
+    "$lte": lambda a, b: _order(a) <= _order(b),
+    "$and": lambda *v: all(v),
+    "$concatArrays": lambda *v: [x for part in v for x in part],
+    "$setUnion": lambda *v: sorted({x for part in v for x in part}),
+}
+
+def evaluate(expr, doc):
+    if isinstance(expr, str) and expr.startswith("$"):
+        return _get(doc, expr[1:])
+    if isinstance(expr, list):
+        return [evaluate(e, doc) for e in expr]
+    if isinstance(expr, dict):
+        if len(expr) == 1 and next(iter(expr)).startswith("$"):
+            op, args = next(iter(expr.items()))
+            if op in OPERATORS:
+                return OPERATORS[op](args, doc)
+            values = [evaluate(a, doc) for a in args] if isinstance(args, list) else [evaluate(args, doc)]
+            return VALUE_OPERATORS[op](*values)
+        return {k: evaluate(v, doc) for k, v in expr.items()}
+    return expr
+
+def apply_pipeline(doc: dict, stages: list) -> dict:
+    """Result of running an update pipeline of $set / $unset stages on `doc`."""
+    doc = copy.deepcopy(doc)
+    for stage in stages:
+        (kind, spec), = stage.items()
+        if kind == "$set":
+            values = {path: evaluate(expr, doc) for path, expr in spec.items()}
+            for path, value in values.items():
+                _set(doc, path, value)
+        elif kind == "$unset":
+            for path in [spec] if isinstance(spec, str) else spec:
+                _unset(doc, path)
+        else:
+            raise NotImplementedError(kind)
+    return doc
@@ -0,0 +1,124 @@
+import asyncio
+
+from pymongo.errors import AutoReconnect, OperationFailure
+
+import catalog
+from catalog import Catalog
+
+class FakeStream:
+    def __init__(self, events):
+        self.events = events
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for event in self.events:
+            if isinstance(event, Exception):
+                raise event
+            yield event
+        await asyncio.Event().wait()
+
+class FakeDb:
+    """db.watch() hands out the scripted outcomes one per call."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.watches = 0
+
+    def watch(self, pipeline):
+        self.watches += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeStream(outcome)
+
+def watch_catalog(db, monkeypatch, seconds=0.2):
+    monkeypatch.setattr(catalog, "CATALOG_WATCH_RETRY_SECONDS", 0.01)
+    monkeypatch.setattr(catalog, "CATALOG_RELOAD_DEBOUNCE_SECONDS", 0.01)
+    monkeypatch.setattr(catalog, "CATALOG_POLL_SECONDS", 3600)
+    cat = Catalog(db, lambda docs: docs)
+    reloads = []
+
+    async def reload():
+        reloads.append(cat.mode)
+    cat.reload = reload
+
+    async def scenario():
+        task = asyncio.create_task(cat._watch())
+        await asyncio.sleep(seconds)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await cat.close()
+    asyncio.run(scenario())
+    return cat, reloads
+
+def test_transient_stream_failure_reopens_the_watch(monkeypatch):
+    db = FakeDb([AutoReconnect("primary stepped down"), [AutoReconnect("network blip")], [{"op": "update"}]])
+    cat, reloads = watch_catalog(db, monkeypatch)
+    assert db.watches == 3
+    assert cat.mode == "change_stream"
+    # One catch-up reload per successful open, plus the debounced event
+    assert len(reloads) == 3
+
+def test_standalone_server_falls_back_to_polling(monkeypatch):
+    unsupported = OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+    db = FakeDb([unsupported])
+    cat, reloads = watch_catalog(db, monkeypatch)
+    assert db.watches == 1
+    assert cat.mode == "poll"
+
+def test_burst_of_events_reloads_once(monkeypatch):
+    db = FakeDb([[{"op": "update"}] * 20])
+    cat, reloads = watch_catalog(db, monkeypatch)
+    # Catch-up reload on open and one for the whole burst
+    assert len(reloads) == 2
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def estimated_document_count(self):
+        return len(self.docs)
+
+    async def find_one(self, query, projection=None, sort=None):
+        docs = [d for d in self.docs if all(k in d for k in query)]
+        if sort:
+            field = sort[0][0]
+            docs = sorted(docs, key=lambda d: d[field], reverse=True)
+        return docs[0] if docs else None
+
+class PollDb:
+    def __init__(self):
+        self.collections = {name: FakeCollection([{"_id": 1}]) for name in catalog.CATALOG_COLLECTIONS}
+        self.catalog_meta = FakeCollection([])
+
+    def __getitem__(self, name):
+        return self.collections[name]
+
+def test_poll_reloads_only_when_the_signature_changes(monkeypatch):
+    monkeypatch.setattr(catalog, "CATALOG_POLL_SECONDS", 0.01)
+    db = PollDb()
+    cat = Catalog(db, lambda docs: docs)
+    reloads = []
+
+    async def reload():
+        reloads.append(True)
+    cat.reload = reload
+
+    async def scenario():
+        task = asyncio.create_task(cat._poll())
+        await asyncio.sleep(0.1)
+        assert reloads == []
+        db.collections["questions"].docs.append({"_id": 2})
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    asyncio.run(scenario())
+    assert len(reloads) == 1
@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from generation import INTERRUPTED_ERROR, GenerationQueue
+
+class UpdateResult:
+    def __init__(self, modified_count):
+        self.modified_count = modified_count
+
+class FakeJobs:
+    """generation_jobs keeping every $set in order."""
+
+    def __init__(self, docs=()):
+        self.docs = {d["_id"]: dict(d) for d in docs}
+        self.writes = []
+
+    async def update_one(self, query, update, upsert=False):
+        self.writes.append(update["$set"]["status"])
+        self.docs.setdefault(query["_id"], {"_id": query["_id"]}).update(update["$set"])
+
+    async def update_many(self, query, update):
+        modified = 0
+        for doc in self.docs.values():
+            if doc["status"] in query["status"]["$in"] and doc["created_at"] < query["created_at"]["$lt"]:
+                doc.update(update["$set"])
+                modified += 1
+        return UpdateResult(modified)
+
+def test_queued_is_written_before_running():
+    jobs = FakeJobs()
+
+    async def process(user_id, payload, emit):
+        return {"ok": True}
+
+    async def scenario():
+        queue = GenerationQueue(jobs, process, concurrency=1)
+        await queue.start()
+        job = await queue.enqueue(1, {})
+        status = await queue.status(job["job_id"], wait=1)
+        await queue.close()
+        return status
+
+    assert asyncio.run(scenario())["status"] == "done"
+    assert jobs.writes == ["queued", "running", "done"]
+
+def test_close_fails_running_and_queued_jobs():
+    jobs = FakeJobs()
+
+    async def process(user_id, payload, emit):
+        await asyncio.Event().wait()
+
+    async def scenario():
+        queue = GenerationQueue(jobs, process, concurrency=1)
+        await queue.start()
+        running = await queue.enqueue(1, {})
+        queued = await queue.enqueue(2, {})
+        await asyncio.sleep(0.01)
+        await queue.close()
+        return running, queued
+
+    running, queued = asyncio.run(scenario())
+    for job in (running, queued):
+        assert jobs.docs[job["job_id"]]["status"] == "failed"
+        assert jobs.docs[job["job_id"]]["error"] == INTERRUPTED_ERROR
+
+def test_start_fails_jobs_left_behind_by_a_dead_process():
+    old = datetime.utcnow() - timedelta(hours=1)
+    jobs = FakeJobs([
+        {"_id": "stale-running", "status": "running", "created_at": old},
+        {"_id": "stale-queued", "status": "queued", "created_at": old},
+        {"_id": "recent", "status": "running", "created_at": datetime.utcnow()},
+        {"_id": "finished", "status": "done", "created_at": old},
+    ])
+
+    async def scenario():
+        queue = GenerationQueue(jobs, None, concurrency=1)
+        await queue.start()
+        await queue.close()
+
+    asyncio.run(scenario())
+    assert {k: d["status"] for k, d in jobs.docs.items()} == {
+        "stale-running": "failed", "stale-queued": "failed", "recent": "running", "finished": "done",
+    }
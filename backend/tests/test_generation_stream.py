@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+import pytest
+
+from generation import DungeonStreamParser, GenerationError, stream_dungeon
+
+def level(n):
+    # Braces, brackets and escaped quotes inside strings must not confuse the scanner
+    return {"title": f"Level {n}", "lesson": 'Use {} and [] with "quotes" \\ here', "quiz": {"questions": []}, "xp": 50}
+
+DUNGEON = {"title": "Loops", "description": "Practice", "levels": [level(1), level(2), level(3)]}
+TEXT = "```json\n" + json.dumps(DUNGEON) + "\n```"
+
+def feed_in(parser, text, size):
+    events = []
+    for i in range(0, len(text), size):
+        events += parser.feed(text[i:i + size])
+    return events
+
+@pytest.mark.parametrize("size", [1, 2, 7, 64, len(TEXT)])
+def test_levels_arrive_whatever_the_chunking(size):
+    parser = DungeonStreamParser()
+    events = feed_in(parser, TEXT, size)
+    assert events[0] == ("header", {"title": "Loops", "description": "Practice"})
+    assert [value for kind, value in events[1:]] == DUNGEON["levels"]
+    assert all(kind == "level" for kind, _ in events[1:])
+
+def test_each_level_is_emitted_when_its_brace_closes():
+    parser = DungeonStreamParser()
+    text = json.dumps(DUNGEON)
+    end_of_first = text.index(json.dumps(level(1))) + len(json.dumps(level(1)))
+    assert [kind for kind, _ in parser.feed(text[:end_of_first - 1])] == ["header"]
+    assert parser.feed(text[end_of_first - 1:end_of_first]) == [("level", level(1))]
+
+def test_truncated_stream_keeps_completed_levels():
+    parser = DungeonStreamParser()
+    text = json.dumps(DUNGEON)
+    cut = text.index('"Level 3"')
+    feed_in(parser, text[:cut], 5)
+    assert parser.levels == [level(1), level(2)]
+
+def test_malformed_level_only_loses_itself():
+    text = '{"title": "T", "description": "D", "levels": [' + json.dumps(level(1)) + ', {"title": 3}, ' + json.dumps(level(2)) + "]}"
+    parser = DungeonStreamParser()
+    parser.feed(text)
+    assert parser.levels == [level(1), level(2)]
+    assert parser.malformed == 1
+
+def test_bare_array_is_a_list_of_levels():
+    parser = DungeonStreamParser()
+    events = parser.feed(json.dumps([level(1), level(2)]))
+    assert events == [("header", {}), ("level", level(1)), ("level", level(2))]
+
+class CutOffBackend:
+    """Streams the dungeon until `cut`, then fails; generate() returns the missing levels."""
+
+    def __init__(self, cut, repair):
+        self.cut = cut
+        self.repair = repair
+        self.prompts = []
+
+    async def stream(self, prompt):
+        text = json.dumps(DUNGEON)[:self.cut]
+        for i in range(0, len(text), 16):
+            yield text[i:i + 16]
+        raise GenerationError("stream reset")
+
+    async def generate(self, prompt):
+        self.prompts.append(prompt)
+        return json.dumps(self.repair)
+
+def run_stream(backend):
+    delivered = []
+
+    async def on_header(header):
+        delivered.append(("header", header))
+
+    async def on_level(value):
+        delivered.append(("level", value))
+
+    result = asyncio.run(stream_dungeon(backend, [], on_header, on_level, repair_attempts=1))
+    return result, delivered
+
+def test_interrupted_stream_is_topped_up_with_only_the_missing_levels():
+    backend = CutOffBackend(json.dumps(DUNGEON).index('"Level 2"'), [level(4), level(5)])
+    result, delivered = run_stream(backend)
+    assert [l["title"] for l in result["levels"]] == ["Level 1", "Level 4", "Level 5"]
+    assert result["title"] == "Loops"
+    assert "Create 2 more level(s)" in backend.prompts[0]
+    assert delivered[0][0] == "header"
+
+def test_stream_without_any_level_fails():
+    backend = CutOffBackend(10, [])
+    with pytest.raises(GenerationError):
+        run_stream(backend)
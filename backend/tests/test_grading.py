@@ -0,0 +1,39 @@
+import asyncio
+
+from grading import GRADING_CACHE_MAX_RESULT_CHARS, GradingEngine
+
+class FakePool:
+    def __init__(self, output_chars):
+        self.output_chars = output_chars
+        self.runs = 0
+
+    async def run(self, code, function_name, tests, digest=""):
+        self.runs += 1
+        return {"error": None, "passed": 1, "results": [], "output_chars": self.output_chars}
+
+    def stats(self):
+        return {}
+
+QUESTION = {"id": 1, "tests": [{"input": 1, "output": 1}]}
+
+def grade_twice(pool):
+    engine = GradingEngine(pool)
+
+    async def scenario():
+        await engine.grade(QUESTION, "def solve(x): return x")
+        await engine.grade(QUESTION, "def solve(x): return x")
+    asyncio.run(scenario())
+    return engine
+
+def test_small_results_are_cached():
+    pool = FakePool(output_chars=10)
+    engine = grade_twice(pool)
+    assert pool.runs == 1
+    assert engine.stats()["result_cache"]["hits"] == 1
+
+def test_large_results_are_not_cached():
+    pool = FakePool(output_chars=GRADING_CACHE_MAX_RESULT_CHARS + 1)
+    engine = grade_twice(pool)
+    assert pool.runs == 2
+    assert engine.stats()["result_cache"]["size"] == 0
+    assert engine.stats()["result_cache"]["uncacheable"] == 2
@@ -0,0 +1,55 @@
+import asyncio
+
+from leaderboard import Leaderboard
+
+class FakeUsers:
+    """users collection whose find() runs `during_scan` halfway through the cursor."""
+
+    def __init__(self, docs, during_scan=None):
+        self.docs = docs
+        self.during_scan = during_scan
+
+    def find(self, query, projection):
+        return self._cursor()
+
+    async def _cursor(self):
+        for i, doc in enumerate(list(self.docs)):
+            if i == len(self.docs) // 2 and self.during_scan:
+                self.during_scan()
+            await asyncio.sleep(0)
+            yield dict(doc)
+
+def user(user_id, xp):
+    return {"id": user_id, "username": f"u{user_id}", "level": 1, "xp": xp, "rank": "", "win_streak": 0}
+
+def test_load_ranks_by_xp():
+    board = Leaderboard(FakeUsers([user(1, 10), user(2, 30), user(3, 20)]))
+    asyncio.run(board.load())
+    assert [e["user_id"] for e in board.top(3)] == [2, 3, 1]
+    assert board.rank_of(1) == 3
+
+def test_update_during_load_survives_swap():
+    docs = [user(1, 10), user(2, 30), user(3, 20), user(4, 5)]
+    board = Leaderboard(FakeUsers(docs))
+    asyncio.run(board.load())
+
+    # User 1 is awarded after the scan already read their old document
+    def award():
+        board.update(user(1, 100))
+    board.users.during_scan = award
+    asyncio.run(board.load())
+
+    assert board.rank_of(1) == 1
+    assert board.top(1)[0]["xp"] == 100
+    assert len(board) == 4
+
+def test_update_outside_load_is_not_replayed_later():
+    users = FakeUsers([user(1, 10), user(2, 30)])
+    board = Leaderboard(users)
+    asyncio.run(board.load())
+    board.update(user(1, 50))
+
+    # Mongo is the source of truth once no scan is in flight
+    users.docs = [user(1, 20), user(2, 30)]
+    asyncio.run(board.load())
+    assert board.top(2)[1]["xp"] == 20
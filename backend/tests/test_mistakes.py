@@ -0,0 +1,82 @@
+import asyncio
+
+from pymongo.errors import AutoReconnect
+
+from mistakes import MistakeRecorder
+
+class FakeLogs:
+    """mistake_logs whose insert_many fails while `failing` is set."""
+
+    def __init__(self):
+        self.docs = {}
+        self.failing = False
+
+    async def insert_many(self, docs, ordered=True):
+        if self.failing:
+            raise AutoReconnect("connection refused")
+        for doc in docs:
+            self.docs[doc["_id"]] = doc
+
+    async def count_documents(self, query):
+        return sum(1 for d in self.docs.values() if d["user_id"] == query["user_id"] and d["_id"] != query["_id"]["$ne"])
+
+class FakeCounters:
+    def __init__(self):
+        self.counts = {}
+
+    async def find_one_and_update(self, query, update, upsert, return_document):
+        before = self.counts.get(query["_id"])
+        self.counts[query["_id"]] = (before or 0) + update["$inc"]["count"]
+        return None if before is None else {"_id": query["_id"], "count": before}
+
+    async def update_one(self, query, update):
+        self.counts[query["_id"]] = self.counts.get(query["_id"], 0) + update["$inc"]["count"]
+
+class FakeDb:
+    def __init__(self):
+        self.mistake_logs = FakeLogs()
+        self.mistake_counters = FakeCounters()
+
+async def record_all(recorder, user_ids):
+    recorder._wake = asyncio.Event()
+    for user_id in user_ids:
+        await recorder.record({"user_id": user_id})
+
+def test_failed_flush_requeues_and_retries():
+    db = FakeDb()
+    recorder = MistakeRecorder(db, buffer_size=10, flush_batch=10)
+
+    async def scenario():
+        await record_all(recorder, [1, 1, 2])
+        db.mistake_logs.failing = True
+        assert not await recorder.flush()
+        assert recorder.stats()["buffered"] == 3
+        db.mistake_logs.failing = False
+        assert await recorder.flush()
+
+    asyncio.run(scenario())
+    assert len(db.mistake_logs.docs) == 3
+    assert db.mistake_counters.counts == {1: 2, 2: 1}
+    assert recorder.dropped == 0
+
+def test_overflow_beyond_cap_is_dropped_and_uncounted():
+    db = FakeDb()
+    recorder = MistakeRecorder(db, buffer_size=3, flush_batch=3)
+
+    async def scenario():
+        await record_all(recorder, [1, 1])
+        db.mistake_logs.failing = True
+        # Two more arrive while the failing flush is in flight
+        insert_many = db.mistake_logs.insert_many
+
+        async def slow_failure(docs, ordered=True):
+            await record_all(recorder, [2, 2])
+            await insert_many(docs, ordered)
+        db.mistake_logs.insert_many = slow_failure
+        assert not await recorder.flush()
+
+    asyncio.run(scenario())
+    # The cap keeps the two newer entries and one of the failed ones
+    assert recorder.stats()["buffered"] == 3
+    assert recorder.dropped == 1
+    assert db.mistake_counters.counts == {1: 1, 2: 2}
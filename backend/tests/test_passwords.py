@@ -0,0 +1,51 @@
+import asyncio
+import importlib
+
+import bcrypt
+import pytest
+from dotenv import load_dotenv
+
+import passwords
+from passwords import hash_cost
+
+@pytest.fixture
+def reload_passwords(monkeypatch):
+    """Re-import passwords.py (settings are read at import) and restore it afterwards."""
+    yield lambda: importlib.reload(passwords)
+    monkeypatch.undo()
+    importlib.reload(passwords)
+
+def test_bcrypt_rounds_from_dotenv_loaded_before_import(tmp_path, monkeypatch, reload_passwords):
+    # main.py loads .env before importing the local modules
+    monkeypatch.delenv("BCRYPT_ROUNDS", raising=False)
+    env_file = tmp_path / ".env"
+    env_file.write_text("BCRYPT_ROUNDS=5\n")
+    load_dotenv(env_file)
+    module = reload_passwords()
+
+    hasher = module.PasswordHasher()
+    try:
+        assert hasher.rounds == 5
+        hashed = asyncio.run(hasher.hash("hunter2"))
+        assert hash_cost(hashed) == 5
+        assert asyncio.run(hasher.verify("hunter2", hashed))
+    finally:
+        hasher.close()
+
+def test_raised_cost_flags_existing_hashes_for_rehash(monkeypatch, reload_passwords):
+    old_hash = bcrypt.hashpw(b"hunter2", bcrypt.gensalt(rounds=4)).decode()
+    monkeypatch.setenv("BCRYPT_ROUNDS", "6")
+    hasher = reload_passwords().PasswordHasher()
+    try:
+        assert hasher.needs_rehash(old_hash)
+    finally:
+        hasher.close()
+
+def test_pool_settings_from_env_and_explicit_arguments(monkeypatch, reload_passwords):
+    monkeypatch.setenv("PASSWORD_HASH_WORKERS", "2")
+    monkeypatch.setenv("PASSWORD_HASH_MAX_PENDING", "8")
+    hasher = reload_passwords().PasswordHasher(rounds=4)
+    try:
+        assert (hasher.workers, hasher.max_pending, hasher.rounds) == (2, 8, 4)
+    finally:
+        hasher.close()
@@ -0,0 +1,46 @@
+import gzip
+
+from starlette.datastructures import Headers
+
+from prerender import COMPRESS_MIN_BYTES, RenderedBody, respond
+
+BIG = {"levels": ["x" * 40 for _ in range(COMPRESS_MIN_BYTES // 20)]}
+
+def headers(**values):
+    return Headers({k.replace("_", "-"): v for k, v in values.items()})
+
+def test_tag_is_stable_across_renders_and_changes_with_content():
+    assert RenderedBody(BIG).tag == RenderedBody(dict(BIG)).tag
+    assert RenderedBody(BIG).tag != RenderedBody({"levels": []}).tag
+
+def test_picks_the_best_accepted_encoding():
+    rendered = RenderedBody(BIG)
+    response = respond(rendered, headers(accept_encoding="gzip;q=1, identity"))
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"] == f'"{rendered.tag}-gzip"'
+    assert gzip.decompress(response.body) == rendered.bodies["identity"]
+
+def test_refused_encodings_fall_back_to_identity():
+    rendered = RenderedBody(BIG)
+    response = respond(rendered, headers(accept_encoding="gzip;q=0, br;q=0"))
+    assert "content-encoding" not in response.headers
+    assert response.headers["etag"] == f'"{rendered.tag}"'
+
+def test_small_bodies_are_not_compressed():
+    rendered = RenderedBody({"id": 1})
+    assert set(rendered.bodies) == {"identity"}
+
+def test_matching_if_none_match_gets_an_empty_304():
+    rendered = RenderedBody(BIG)
+    for tag in (f'"{rendered.tag}"', f'W/"{rendered.tag}-gzip"', f'"other", "{rendered.tag}-br"', "*"):
+        response = respond(rendered, headers(if_none_match=tag, accept_encoding="gzip"))
+        assert response.status_code == 304, tag
+        assert response.body == b""
+        assert response.headers["etag"] == f'"{rendered.tag}-gzip"'
+
+def test_stale_tag_gets_the_body():
+    rendered = RenderedBody(BIG)
+    response = respond(rendered, headers(if_none_match='"0123456789abcdef"'))
+    assert response.status_code == 200
+    assert response.body == rendered.bodies["identity"]
@@ -0,0 +1,85 @@
+import asyncio
+from datetime import date, datetime, timedelta
+
+from pipeline_eval import apply_pipeline
+from progress import LEVEL_XP_STEP, award_progress, level_up_stage, streak_stage
+
+class FakeUsers:
+    """users collection holding one document; records the filter of each award."""
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.queries = []
+
+    async def find_one_and_update(self, query, stages, return_document):
+        self.queries.append(query)
+        self.doc = apply_pipeline(self.doc, stages)
+        return self.doc
+
+def award(doc, xp, **options):
+    users = FakeUsers(doc)
+    updated = asyncio.run(award_progress(users, doc["id"], xp, **options))
+    return updated, users.queries[0]
+
+def reference_level_up(xp, level, xp_to_next):
+    """The loop level_up_stage replaces."""
+    while xp >= xp_to_next:
+        level += 1
+        xp_to_next = level * LEVEL_XP_STEP
+    return level, xp_to_next
+
+def test_level_up_matches_the_loop_over_a_run_of_awards():
+    doc = {"id": 1, "xp": 0, "level": 1, "xp_to_next": 100}
+    level, xp_to_next = 1, 100
+    for xp in [50, 49, 1, 400, 999, 2600, 0, 10, 5000, 7]:
+        doc = apply_pipeline(doc, [{"$set": {"xp": {"$add": ["$xp", xp]}}}, level_up_stage()])
+        level, xp_to_next = reference_level_up(doc["xp"], level, xp_to_next)
+        assert (doc["level"], doc["xp_to_next"]) == (level, xp_to_next)
+
+def test_level_up_defaults_for_a_bare_document():
+    doc = apply_pipeline({"xp": 150}, [level_up_stage()])
+    assert (doc["level"], doc["xp_to_next"]) == (2, 2 * LEVEL_XP_STEP)
+
+def streak_after(last_activity, streak=4):
+    today = date(2024, 3, 10)
+    doc = {"win_streak": streak}
+    if last_activity is not None:
+        doc["last_activity_date"] = last_activity.isoformat()
+    stage = streak_stage(today.isoformat(), (today - timedelta(days=1)).isoformat())
+    return apply_pipeline(doc, [stage])
+
+def test_streak_rules():
+    today = date(2024, 3, 10)
+    assert streak_after(today)["win_streak"] == 4
+    assert streak_after(today - timedelta(days=1))["win_streak"] == 5
+    assert streak_after(today - timedelta(days=2))["win_streak"] == 1
+    assert streak_after(None)["win_streak"] == 1
+    assert streak_after(today - timedelta(days=1))["last_activity_date"] == today.isoformat()
+
+def test_award_applies_counters_arrays_and_bits_in_one_write():
+    doc = {"id": 7, "xp": 90, "level": 1, "xp_to_next": 100, "quests_completed": 2,
+           "completed_levels": [1], "completed_dungeons": [3], "progress": 0b001}
+    updated, query = award(
+        doc, 20,
+        guard={"completed_levels": {"$ne": 2}},
+        inc={"quests_completed": 1},
+        append={"completed_levels": 2},
+        union={"completed_dungeons": [3, 4]},
+        bits={"progress": 0b100},
+        touch_streak=False,
+    )
+    assert query == {"id": 7, "completed_levels": {"$ne": 2}}
+    assert updated["xp"] == 110 and updated["level"] == 2
+    assert updated["quests_completed"] == 3
+    assert updated["completed_levels"] == [1, 2]
+    assert updated["completed_dungeons"] == [3, 4]
+    assert updated["progress"] == 0b101
+    assert "win_streak" not in updated
+
+def test_xp_expression_sees_the_updated_streak():
+    yesterday = (datetime.utcnow().date() - timedelta(days=1)).isoformat()
+    doc = {"id": 1, "xp": 0, "level": 1, "xp_to_next": 100, "win_streak": 2, "last_activity_date": yesterday}
+    # e.g. a daily bonus scaled by the streak
+    updated, _ = award(doc, {"$multiply": ["$win_streak", 10]})
+    assert updated["win_streak"] == 3
+    assert updated["xp"] == 30
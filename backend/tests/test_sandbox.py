@@ -0,0 +1,99 @@
+import asyncio
+
+import sandbox
+from sandbox import SandboxPool
+
+# Workers are started with the spawn method and only import sandbox.py, so
+# these tests run real worker processes without a __main__ guard.
+def run(code, tests, **pool_options):
+    async def scenario():
+        pool = SandboxPool(size=1, **pool_options)
+        await pool.start()
+        try:
+            return await pool.run(code, "solve", tests)
+        finally:
+            await pool.close()
+    return asyncio.run(scenario())
+
+ENVIRON_PROBE = """
+def solve(x):
+    for cls in ().__class__.__base__.__subclasses__():
+        if cls.__name__ == "_wrap_close":
+            return dict(cls.__init__.__globals__["environ"])
+    return "os not reachable"
+"""
+
+def test_worker_cannot_see_server_environment(monkeypatch):
+    monkeypatch.setenv("GEMINI_API_KEY", "secret-key")
+    monkeypatch.setenv("MONGO_URI", "mongodb://user:pass@db")
+    outcome = run(ENVIRON_PROBE, [{"input": 0, "output": None}])
+    assert outcome["error"] is None
+    assert outcome["results"][0]["output"] == {}
+
+def test_oversized_output_fails_the_test():
+    code = "def solve(n):\n    return [n] * (6 * 10 ** 6)\n"
+    outcome = run(code, [{"input": 1, "output": [1]}, {"input": 2, "output": [2]}])
+    assert outcome["passed"] == 0
+    assert [r["output"] for r in outcome["results"]] == ["Output too large"] * 2
+
+def test_self_referencing_output_is_rejected_cheaply():
+    code = "def solve(n):\n    out = []\n    out.append(out)\n    return out\n"
+    outcome = run(code, [{"input": 1, "output": []}])
+    assert outcome["results"][0]["output"] == "Output too large"
+
+def test_rendered_size_counts_and_stops_early():
+    assert sandbox._rendered_size([1, "ab", {"k": None}], 100) > 0
+    assert sandbox._rendered_size("x" * 101, 100) == -1
+    assert sandbox._rendered_size(10 ** 1000, 100) == -1
+
+def test_infinite_loop_hits_the_time_limit():
+    code = "def solve(x):\n    while True:\n        pass\n"
+    outcome = run(code, [{"input": 1, "output": 1}, {"input": 2, "output": 2}], cpu_seconds=0.2, wall_seconds=1)
+    assert outcome["passed"] == 0
+    assert [r["output"] for r in outcome["results"]] == ["Time limit exceeded"] * 2
+    assert outcome["cacheable"] is False
+
+def test_worker_that_outlives_its_limits_is_replaced(monkeypatch):
+    # A bare except swallows both one-shot timers; the parent's deadline still applies
+    monkeypatch.setattr(sandbox, "SANDBOX_GRACE_SECONDS", 0.2)
+    code = (
+        "def solve(x):\n"
+        "    while True:\n"
+        "        try:\n"
+        "            while True:\n"
+        "                pass\n"
+        "        except:\n"
+        "            pass\n"
+    )
+
+    async def scenario():
+        pool = SandboxPool(size=1, cpu_seconds=0.1, wall_seconds=0.2)
+        await pool.start()
+        try:
+            outcome = await pool.run(code, "solve", [{"input": 1, "output": 1}])
+            after = await pool.run("def solve(x):\n    return x\n", "solve", [{"input": 1, "output": 1}])
+            return outcome, after, pool.restarts
+        finally:
+            await pool.close()
+
+    outcome, after, restarts = asyncio.run(scenario())
+    assert outcome["error"] == "Execution timed out"
+    assert restarts == 1
+    assert after["passed"] == 1
+
+def test_huge_allocation_hits_the_memory_limit():
+    code = "def solve(x):\n    return len([x] * (10 ** 9))\n"
+    outcome = run(code, [{"input": 1, "output": 1}], memory_mb=128)
+    assert outcome["results"][0]["output"] == "Memory limit exceeded"
+    assert outcome["cacheable"] is False
+
+def test_worker_keeps_serving_after_a_limit():
+    async def scenario():
+        pool = SandboxPool(size=1, cpu_seconds=0.2, wall_seconds=1)
+        await pool.start()
+        try:
+            await pool.run("def solve(x):\n    while True:\n        pass\n", "solve", [{"input": 1, "output": 1}])
+            return await pool.run("def solve(x):\n    return x * 2\n", "solve", [{"input": 2, "output": 4}])
+        finally:
+            await pool.close()
+    assert asyncio.run(scenario())["passed"] == 1
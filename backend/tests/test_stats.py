@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta
+
+from pipeline_eval import apply_pipeline
+from stats import STATS_IDLE_SECONDS, stats_view, submission_event, update_pipeline
+
+START = datetime(2024, 3, 10, 12, 0, 0)
+
+def fold(events):
+    doc = {"_id": 1}
+    for event in events:
+        doc = apply_pipeline(doc, update_pipeline(event))
+    return doc
+
+def event(seconds, success=False, completed=False, kind="question", item_id=5, category="arrays"):
+    e = submission_event(1, kind, item_id, success, completed, category)
+    e["timestamp"] = START + timedelta(seconds=seconds)
+    return e
+
+def test_attempts_time_and_completion():
+    doc = fold([event(0), event(60), event(90, success=True, completed=True)])
+    assert doc["attempts"] == 3
+    assert doc["successes"] == 1
+    assert doc["quests_failed"] == 2
+    assert doc["time_spent_seconds"] == 90
+    assert doc["completions"] == 1
+    # From the first attempt to the completing submit
+    assert doc["completion_seconds"] == 90
+    assert doc["category_counts"] == {"arrays": 1}
+    assert doc["first_attempt"] == {}
+
+def test_idle_gaps_are_not_time_spent():
+    doc = fold([event(0), event(STATS_IDLE_SECONDS + 1), event(STATS_IDLE_SECONDS + 31)])
+    assert doc["time_spent_seconds"] == 30
+
+def test_pending_first_attempts_are_kept_per_item():
+    doc = fold([event(0, item_id=1), event(10, item_id=2), event(20, success=True, completed=True, item_id=1)])
+    assert list(doc["first_attempt"]) == ["q2"]
+    assert doc["completion_seconds"] == 20
+
+def test_stats_view():
+    doc = fold([event(0), event(60, success=True, completed=True)])
+    view = stats_view(doc, {"xp": 120, "level": 2, "rank": "Adept", "win_streak": 3, "quests_completed": 1})
+    assert view["accuracy"] == 50.0
+    assert view["avg_completion_time"] == 60
+    assert view["favorite_category"] == "arrays"
+    assert view["best_streak"] == 3
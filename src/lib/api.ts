@@ -124,7 +124,7 @@ export const api = {
       win_streak: number;
       completed_levels: number[];
       completed_questions: number[];
-      completed_personalized_levels?: string[];
+      personalized_progress?: Record<string, number>;
       avatar?: any;
     }>(`/api/profile/${userId}`),
 
@@ -151,7 +151,7 @@ export const api = {
   getQuestions: (userId?: string | null) =>
     apiRequest<Question[]>(userId ? `/api/questions?user_id=${userId}` : '/api/questions'),
   getQuestion: (id: string) => apiRequest<QuestionDetail>(`/api/questions/${id}`),
-  testQuestion: (id: string, data: { code: string; language: string }) =>
+  testQuestion: (id: string, data: { user_id?: string | null; code: string; language: string }) =>
     apiRequest<TestResult>(`/api/questions/${id}/test`, {
       method: 'POST',
       body: JSON.stringify(data),
@@ -172,16 +172,33 @@ export const api = {
       body: JSON.stringify(data),
     }),
   
-  getPersonalizedDungeons: (userId: string) =>
-    apiRequest<PersonalizedDungeonResponse[]>(`/api/personalized_dungeons/${userId}`),
+  getPersonalizedDungeons: (userId: string, cursor?: string | null) =>
+    apiRequest<PersonalizedDungeonPage>(
+      `/api/personalized_dungeons/${userId}${cursor ? `?cursor=${encodeURIComponent(cursor)}` : ''}`
+    ),
   
   getMistakeCount: (userId: string) =>
     apiRequest<{ count: number; threshold: number }>(`/api/personalized_dungeons/${userId}/count`),
   
-  generatePersonalizedDungeon: (userId: number) =>
-    apiRequest<{ success: boolean; message: string; dungeon: PersonalizedDungeonResponse }>(`/api/personalized_dungeons/generate?user_id=${userId}`, {
-      method: 'POST',
-    }),
+  generatePersonalizedDungeon: async (userId: number) => {
+    // Generation runs as a background job: start it, then long-poll until it finishes
+    const started = await apiRequest<{ success: boolean; message: string; job_id: string; status: string }>(
+      `/api/personalized_dungeons/generate?user_id=${userId}`,
+      { method: 'POST' }
+    );
+    const poll = () => apiRequest<GenerationJob>(`/api/personalized_dungeons/jobs/${started.job_id}?wait=25`);
+    let job = await poll();
+    while (job.status === 'queued' || job.status === 'running') {
+      job = await poll();
+    }
+    if (job.status !== 'done' || !job.dungeon) {
+      throw new APIError(job.error || 'Could not generate dungeon.', 500, job);
+    }
+    return { success: true, message: 'Personalized dungeon generated!', dungeon: job.dungeon };
+  },
+
+  getGenerationJob: (jobId: string, wait = 0) =>
+    apiRequest<GenerationJob>(`/api/personalized_dungeons/jobs/${jobId}?wait=${wait}`),
   
   getPersonalizedDungeon: (dungeonId: string) =>
     apiRequest<PersonalizedDungeonResponse>(`/api/personalized_dungeons/detail/${dungeonId}`),
@@ -310,6 +327,37 @@ export interface PersonalizedDungeonResponse {
   is_completed?: boolean;
 }
 
+// Listing entry: no levels, just progress counts
+export interface PersonalizedDungeonSummary {
+  _id: string;
+  id: number;
+  user_id: number;
+  title: string;
+  description: string;
+  difficulty: string;
+  generated_at: string;
+  status?: string;
+  levels_completed: number;
+  total_levels: number;
+  is_completed: boolean;
+}
+
+export interface PersonalizedDungeonPage {
+  dungeons: PersonalizedDungeonSummary[];
+  next_cursor: string | null;
+}
+
+export interface GenerationJob {
+  job_id: string;
+  user_id: number;
+  status: 'queued' | 'running' | 'done' | 'failed';
+  created_at: string;
+  started_at: string | null;
+  finished_at: string | null;
+  error: string | null;
+  dungeon: PersonalizedDungeonResponse | null;
+}
+
 export interface SubmitResult {
   success: boolean;
   passed: number;
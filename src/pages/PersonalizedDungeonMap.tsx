@@ -36,7 +36,8 @@ const PersonalizedDungeonMap = () => {
   const { dungeonId } = useParams<{ dungeonId: string }>();
   const navigate = useNavigate();
   const [dungeon, setDungeon] = useState<PersonalizedDungeon | null>(null);
-  const [completedLevels, setCompletedLevels] = useState<string[]>([]);
+  // Bit i is set once level i is completed
+  const [completedMask, setCompletedMask] = useState(0);
   const [loading, setLoading] = useState(true);
 
   const userId = getUserId();
@@ -51,7 +52,7 @@ const PersonalizedDungeonMap = () => {
 
         // Fetch user progress
         const profileData = await api.getProfile(userId);
-        setCompletedLevels(profileData.completed_personalized_levels || []);
+        setCompletedMask(profileData.personalized_progress?.[String(dungeonData._id || dungeonData.id)] ?? 0);
       } catch (error) {
         toast({
           title: "Failed to Load",
@@ -69,15 +70,14 @@ const PersonalizedDungeonMap = () => {
   const getLevelStatus = (levelIndex: number): "locked" | "unlocked" | "completed" => {
     if (!dungeon) return "locked";
     
-    const levelKey = `${dungeon._id || dungeon.id}_${levelIndex}`;
-    if (completedLevels.includes(levelKey)) return "completed";
+    const isCompleted = (index: number) => ((completedMask >> index) & 1) === 1;
+    if (isCompleted(levelIndex)) return "completed";
     
     // First level is always unlocked
     if (levelIndex === 0) return "unlocked";
     
     // Level is unlocked if previous level is completed
-    const prevLevelKey = `${dungeon._id || dungeon.id}_${levelIndex - 1}`;
-    if (completedLevels.includes(prevLevelKey)) {
+    if (isCompleted(levelIndex - 1)) {
       return "unlocked";
     }
     
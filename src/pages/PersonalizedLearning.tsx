@@ -5,13 +5,15 @@ import { Progress } from "@/components/ui/progress";
 import { Brain, Sparkles, Lock, CheckCircle2, ChevronRight, Loader2, Zap } from "lucide-react";
 import { useNavigate } from "react-router-dom";
 import { useEffect, useState } from "react";
-import { api, getUserId, type PersonalizedDungeonResponse } from "@/lib/api";
+import { api, getUserId, type PersonalizedDungeonSummary } from "@/lib/api";
 import { toast } from "@/hooks/use-toast";
 import { LoadingSpinner } from "@/components/LoadingSkeleton";
 
 const PersonalizedLearning = () => {
   const navigate = useNavigate();
-  const [dungeons, setDungeons] = useState<PersonalizedDungeonResponse[]>([]);
+  const [dungeons, setDungeons] = useState<PersonalizedDungeonSummary[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [loading, setLoading] = useState(true);
   const [generating, setGenerating] = useState(false);
   const [mistakeCount, setMistakeCount] = useState(0);
@@ -30,12 +32,13 @@ const PersonalizedLearning = () => {
     if (!userId) return;
     
     try {
-      const [dungeonsData, countData] = await Promise.all([
+      const [page, countData] = await Promise.all([
         api.getPersonalizedDungeons(userId),
         api.getMistakeCount(userId),
       ]);
       
-      setDungeons(dungeonsData);
+      setDungeons(page.dungeons);
+      setNextCursor(page.next_cursor);
       setMistakeCount(countData.count);
     } catch (error) {
       toast({
@@ -73,7 +76,26 @@ const PersonalizedLearning = () => {
     }
   };
 
-  const handleDungeonClick = (dungeon: PersonalizedDungeonResponse) => {
+  const handleLoadMore = async () => {
+    if (!userId || !nextCursor) return;
+
+    setLoadingMore(true);
+    try {
+      const page = await api.getPersonalizedDungeons(userId, nextCursor);
+      setDungeons(prev => [...prev, ...page.dungeons]);
+      setNextCursor(page.next_cursor);
+    } catch (error) {
+      toast({
+        title: "Failed to Load",
+        description: "Could not load more dungeons.",
+        variant: "destructive",
+      });
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  const handleDungeonClick = (dungeon: PersonalizedDungeonSummary) => {
     navigate(`/personalized/${dungeon._id || dungeon.id}`);
   };
 
@@ -242,6 +264,26 @@ const PersonalizedLearning = () => {
           </div>
         )}
 
+        {nextCursor && (
+          <div className="flex justify-center mb-8">
+            <Button
+              onClick={handleLoadMore}
+              disabled={loadingMore}
+              variant="outline"
+              className="font-pixel text-xs"
+            >
+              {loadingMore ? (
+                <>
+                  <Loader2 className="w-4 h-4 mr-2 animate-spin" />
+                  Loading...
+                </>
+              ) : (
+                "Load More Dungeons"
+              )}
+            </Button>
+          </div>
+        )}
+
         {/* Empty State */}
         {dungeons.length === 0 && (
           <Card className="p-8 text-center bg-card/50 pixel-border">
@@ -152,6 +152,7 @@ const QuestionDetail = () => {
     
     try {
       const data = await api.testQuestion(id, {
+        user_id: getUserId(),
         code,
         language: "python",
       });